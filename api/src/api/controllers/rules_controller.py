@@ -266,6 +266,18 @@ async def add_rule_component(
     if not Validator.validate_action_name(component.actionname, component.ispredicate):
         raise HTTPException(status_code=400, detail="Invalid action name")
 
+    # Validate values here, once, rather than in the listeners
+    rule = await db.rules.find_one(
+        {"zone": zone, "ruleid": UUID(rule_id)}, {"rulecomponents": 1}
+    )
+    if not Validator.validate_action_value(
+        component.actionname,
+        component.actionvalue,
+        (rule or {}).get("rulecomponents", []),
+        component.ispredicate,
+    ):
+        raise HTTPException(status_code=400, detail="Invalid action value")
+
     new_component = component.dict()
     new_component["componentid"] = uuid4()
 
@@ -304,6 +316,22 @@ async def edit_rule_component(
         )
         raise HTTPException(status_code=403, detail="Forbidden")
 
+    rule = await db.rules.find_one(
+        {"zone": zone, "ruleid": UUID(rule_id)}, {"rulecomponents": 1}
+    )
+    components: list = (rule or {}).get("rulecomponents", [])
+    for existing in components:
+        if existing["componentid"] == UUID(component_id):
+            others = [c for c in components if c is not existing]
+            if not Validator.validate_action_value(
+                existing["actionname"],
+                action_value.actionvalue,
+                others,
+                existing["ispredicate"],
+            ):
+                raise HTTPException(status_code=400, detail="Invalid action value")
+            break
+
     update_result = await db.rules.update_one(
         {
             "zone": zone,
@@ -1,8 +1,108 @@
+import ipaddress
+import json
 import logging
-from typing import Any, Dict
+from typing import Any, Dict, Iterable, Optional
+
+from zentralbibliothek.dnsrecords import ADDRESS_TYPES, RECORD_TYPES
 
 logger = logging.getLogger(__name__)
 
+# record types the DNS listener has an encoder for
+DNS_RECORD_TYPES: tuple = RECORD_TYPES
+
+
+def _is_uint(bits: int):
+    return lambda value: isinstance(value, int) and 0 <= value < 2**bits
+
+
+def _is_ip(value: Any) -> bool:
+    try:
+        ipaddress.ip_address(value)
+        return True
+    except ValueError:
+        return False
+
+
+def _is_name(value: Any) -> bool:
+    return isinstance(value, str) and 0 < len(value) <= 253
+
+
+def _is_text(value: Any) -> bool:
+    return isinstance(value, str)
+
+
+# dns.data fields, and what their values must look like
+DNS_DATA_FIELDS = {
+    "ip": _is_ip,
+    "cname": _is_name,
+    "ns": _is_name,
+    "ptr": _is_name,
+    "name": _is_name,
+    "target": _is_name,
+    "mname": _is_name,
+    "rname": _is_name,
+    "txt": _is_text,
+    "tag": _is_text,
+    "value": _is_text,
+    "params": _is_text,
+    "flags": _is_uint(8),
+    "priority": _is_uint(16),
+    "weight": _is_uint(16),
+    "port": _is_uint(16),
+    "times": lambda value: isinstance(value, list)
+    and len(value) == 5
+    and all(map(_is_uint(32), value)),
+}
+
+
+def _parse_dns_data(value: Any) -> Optional[dict]:
+    try:
+        data = json.loads(value) if isinstance(value, str) else value
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def _answer_types(components: Iterable[dict]) -> set:
+    """
+    The record types a rule with these components can answer with: its dns.type result,
+    or else the types its dns.type predicate matches (answers have the query's type).
+    """
+    results, predicates = set(), set()
+    for component in components:
+        if component.get("actionname") != "dns.type":
+            continue
+        value = str(component.get("actionvalue"))
+        types = {t.strip().upper() for t in value.split(",")}
+        (predicates if component.get("ispredicate") else results).update(types)
+    return results or predicates
+
+
+def _ip_fits(types: set, data: dict) -> bool:
+    """
+    Whether the `ip` in dns.data is of the version every A or AAAA answer needs.
+    """
+    if "ip" not in data:
+        return True
+    try:
+        ip = ipaddress.ip_address(data["ip"])
+    except ValueError:
+        return False
+    return all(isinstance(ip, ADDRESS_TYPES.get(t, object)) for t in types)
+
+
+def _data_fits(types: set, components: Iterable[dict]) -> bool:
+    """
+    Whether the `ip` of every dns.data result in `components` fits answers of `types`.
+    """
+    for component in components:
+        if component.get("actionname") != "dns.data" or component.get("ispredicate"):
+            continue
+        data = _parse_dns_data(component.get("actionvalue"))
+        if data is not None and not _ip_fits(types, data):
+            return False
+    return True
+
 
 class Validator:
     """Helper class to validate all the things"""
@@ -39,6 +139,60 @@ class Validator:
 
         return False
 
+    @staticmethod
+    def validate_action_value(
+        action_name: str,
+        action_value: Any,
+        components: Iterable[dict] = (),
+        is_predicate: bool = False,
+    ) -> bool:
+        """
+        Validates the value of a component, so the listeners can use it as is.
+        dns.type must be a record type we can answer with, and dns.data a json object
+        whose fields are well formed (an IP is an IP, a port fits in 16 bits...).
+        `components` are the rule's other components: an A answer needs an IPv4 `ip`,
+        an AAAA answer an IPv6 one. Of the predicates, only a dns.type is checked,
+        against the `ip` of the rule's dns.data when the rule answers with its types.
+        """
+        components = list(components)
+
+        if is_predicate:
+            if action_name != "dns.type":
+                return True
+            predicate = {
+                "actionname": action_name,
+                "actionvalue": action_value,
+                "ispredicate": True,
+            }
+            if not _data_fits(_answer_types(components + [predicate]), components):
+                logger.debug(f"dns.data doesn't fit dns.type {action_value}")
+                return False
+            return True
+
+        if action_name == "dns.type":
+            rtype = str(action_value).upper()
+            if rtype not in DNS_RECORD_TYPES:
+                return False
+            if not _data_fits({rtype}, components):
+                logger.debug(f"dns.data doesn't fit dns.type {rtype}")
+                return False
+            return True
+
+        if action_name == "dns.data":
+            data = _parse_dns_data(action_value)
+            if data is None:
+                return False
+            for field, value in data.items():
+                check = DNS_DATA_FIELDS.get(field)
+                if check is not None and not check(value):
+                    logger.debug(f"Invalid dns.data field {field}: {value}")
+                    return False
+            if not _ip_fits(_answer_types(components), data):
+                logger.debug(f"dns.data ip doesn't fit the rule's dns.type: {data}")
+                return False
+
+        return True
+
 
 def validate_payload_content(content: Dict[str, Any], payload_type: str) -> bool:
     """Validate payload content based on type"""
@@ -64,6 +64,8 @@ class MongoDBService:
             # Requests indexes
             await self.db.dns_requests.create_index("status")
             await self.db.dns_requests.create_index("created_at")
+            # HTTP interactions that came in on the same (keep-alive) connection
+            await self.db.requests.create_index("connection", sparse=True)
 
             # Payloads indexes
             await self.db.payloads.create_index("status")
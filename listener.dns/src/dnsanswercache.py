@@ -0,0 +1,113 @@
+import threading
+
+from cachetools import TTLCache
+
+HEADER_LEN: int = 12
+
+
+def question_end(packet: bytes) -> int:
+    """
+    Offset just past the (first) question of a DNS packet, or -1 if it can't be walked
+    (truncated, or a compressed name).
+    """
+    offset = HEADER_LEN
+    try:
+        while length := packet[offset]:
+            if length & 0xC0:
+                return -1
+            offset += length + 1
+    except IndexError:
+        return -1
+    offset += 5  # the root label, qtype and qclass
+    return offset if offset <= len(packet) else -1
+
+
+class CachedAnswer:
+    """
+    A packed reply, and what it depends on.
+
+        reply         the reply as sent, its ID and question are patched for every query
+        names         DatabaseClient.names_version() when it was built
+        zone          the zone it was answered for (None for names outside any zone)
+        zone_version  DatabaseClient.rules_version(zone) when it was built
+        interaction   (DnsRequest arguments, DnsResponse) to save for every query, or None
+    """
+
+    __slots__ = ("reply", "qend", "names", "zone", "zone_version", "interaction")
+
+    def __init__(self, reply: bytes, names, zone=None, zone_version=None, interaction=None):
+        self.reply = reply
+        self.qend = question_end(reply)
+        self.names = names
+        self.zone = zone
+        self.zone_version = zone_version
+        self.interaction = interaction
+
+    @property
+    def negative(self) -> bool:
+        """NXDOMAIN or NODATA: no answer records."""
+        return self.reply[6:8] == b"\x00\x00"
+
+    def reply_to(self, query: bytes):
+        """
+        This reply with the ID, RD flag and question (its case included) of `query`,
+        or None if the question doesn't line up.
+        """
+        qend = self.qend
+        if qend < 0 or len(query) < qend:
+            return None
+        question = query[HEADER_LEN:qend]
+        # only case may differ (0x20 randomization), label lengths are never letters
+        if question.lower() != self.reply[HEADER_LEN:qend].lower():
+            return None
+        flags = (self.reply[2] & 0xFE) | (query[2] & 0x01)
+        return b"".join(
+            (query[:2], bytes((flags,)), self.reply[3:HEADER_LEN], question, self.reply[qend:])
+        )
+
+
+class AnswerCache:
+    """
+    LRU of packed replies keyed by (qname, qtype), so repeated queries skip the rule engine,
+    the RR construction and dnslib's packing.
+
+    Entries carry the versions they were built against (see `CachedAnswer`), a stale entry
+    is a miss. They also expire after `ttl` seconds, so defaults that rotate over a domain's
+    public_ips keep rotating.
+    """
+
+    def __init__(self, maxsize: int = 4096, ttl: float = 60):
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, names, rules_version) -> CachedAnswer:
+        """
+        The entry for `key` if it is still current: `names` is the current
+        names_version() and `rules_version(zone)` the current version of a zone.
+        """
+        with self._lock:
+            entry: CachedAnswer = self._entries.get(key)
+        if (
+            entry is None
+            or entry.names != names
+            or (entry.zone is not None and entry.zone_version != rules_version(entry.zone))
+        ):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key: tuple, entry: CachedAnswer):
+        if entry.qend < 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,125 @@
+import atexit
+import logging
+import threading
+import time
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class _Pending:
+    __slots__ = ("req", "response", "count", "first_seen", "last_seen", "due")
+
+    def __init__(self, req, response, now: float, due: float):
+        self.req = req
+        self.response = response
+        self.count = 1
+        self.first_seen = now
+        self.last_seen = now
+        self.due = due
+
+
+class InteractionCoalescer:
+    """
+    Folds repeated DNS interactions into one stored interaction.
+
+    Resolvers retry, so a single callback often reaches us as a burst of identical queries.
+    The first interaction for a (zone, qname, qtype, client) is held for `window` seconds;
+    repeats within that window only bump its `count` and `last_seen`. When the window is up,
+    `save(req, response, extra)` is called once with `count`, `first_seen` and `last_seen`
+    (epoch seconds) in `extra`. Every packet is still answered, only the writes are folded.
+
+    Call `close()` to save whatever is pending; this is registered with atexit as well.
+
+    Every entry is due `window` after it was added, so the pending dict (which keeps
+    insertion order) is also ordered by due time: the next one due is always its first.
+    Adding and flushing are O(1) per interaction, however many are pending.
+    """
+
+    def __init__(self, save: Callable, window: float = 0.5):
+        self._save = save
+        self.window = window
+        self._pending: dict = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        self.folded: int = 0
+        self._thread = threading.Thread(
+            target=self._run, name="dns-interaction-coalescer", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def add(self, req, response):
+        """
+        Record an interaction, saved when its window is up.
+        """
+        key = (req.zone_fqdn, req.req_fqdn, req.RequestType, req.remote_addr)
+        now = time.time()
+        with self._cond:
+            if not self._closed:
+                if (entry := self._pending.get(key)) is not None:
+                    entry.count += 1
+                    entry.last_seen = now
+                    self.folded += 1
+                else:
+                    due = time.monotonic() + self.window
+                    self._pending[key] = _Pending(req, response, now, due)
+                    if len(self._pending) == 1:
+                        # the thread is idle, everything else is due after this one
+                        self._cond.notify()
+                return
+        # closed, nothing would flush it later
+        self._write(_Pending(req, response, now, 0))
+
+    def flush(self, everything: bool = False):
+        """
+        Save the interactions whose window is up (all of them with `everything`).
+        """
+        now = time.monotonic()
+        entries = []
+        with self._cond:
+            if everything:
+                entries = list(self._pending.values())
+                self._pending.clear()
+            # due in insertion order, stop at the first that isn't
+            while self._pending:
+                key = next(iter(self._pending))
+                if self._pending[key].due > now:
+                    break
+                entries.append(self._pending.pop(key))
+        for entry in entries:
+            self._write(entry)
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout=max(self.window * 4, 1.0))
+        self.flush(everything=True)
+
+    def _write(self, entry: _Pending):
+        extra = {
+            "count": entry.count,
+            "first_seen": round(entry.first_seen, 3),
+            "last_seen": round(entry.last_seen, 3),
+            "time": int(entry.first_seen),
+        }
+        try:
+            self._save(entry.req, entry.response, extra)
+        except Exception as ex:
+            logger.critical(f"Unable to save coalesced interaction: {ex}")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                wait = next(iter(self._pending.values())).due - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+            self.flush()
@@ -0,0 +1,97 @@
+import logging
+
+import dnslib
+from models.dnsresponse import DnsResponse
+from zentralbibliothek.dnsrecords import RECORD_TYPES
+
+logger = logging.getLogger(__name__)
+
+# response type -> (QTYPE, encoder), an encoder turns a DnsResponse's data into dnslib
+# record data. There is one for each of zentralbibliothek's RECORD_TYPES, which the API
+# validates rules against when they are stored, so encoders don't check the data again,
+# a bad record just fails to encode.
+ENCODERS: dict = {}
+
+# what an encoder may raise on data it can't encode
+ENCODE_ERRORS: tuple = (KeyError, TypeError, ValueError, dnslib.DNSError)
+
+
+def encoder(rtype: str):
+    """
+    Registers the decorated function as the encoder for `rtype` records.
+    """
+    if rtype not in RECORD_TYPES:
+        # the API would refuse rules with this type
+        raise ValueError(f"{rtype} is not one of the RECORD_TYPES")
+
+    def register(encode):
+        ENCODERS[rtype] = (getattr(dnslib.QTYPE, rtype), encode)
+        return encode
+
+    return register
+
+
+@encoder("A")
+def encode_a(data: dict) -> dnslib.RD:
+    return dnslib.A(data["ip"])
+
+
+@encoder("AAAA")
+def encode_aaaa(data: dict) -> dnslib.RD:
+    return dnslib.AAAA(data["ip"])
+
+
+@encoder("CAA")
+def encode_caa(data: dict) -> dnslib.RD:
+    return dnslib.CAA(flags=data["flags"], tag=data["tag"], value=data["value"])
+
+
+@encoder("CNAME")
+def encode_cname(data: dict) -> dnslib.RD:
+    return dnslib.CNAME(data["cname"])
+
+
+@encoder("MX")
+def encode_mx(data: dict) -> dnslib.RD:
+    return dnslib.MX(label=data["name"], preference=data["priority"])
+
+
+@encoder("NS")
+def encode_ns(data: dict) -> dnslib.RD:
+    return dnslib.NS(data["ns"])
+
+
+@encoder("SOA")
+def encode_soa(data: dict) -> dnslib.RD:
+    # rules usually set just the type, answer with our own SOA then
+    soa = data if "mname" in data else DnsResponse.default_soa_obj()
+    return dnslib.SOA(soa["mname"], soa["rname"], tuple(soa["times"]))
+
+
+@encoder("TXT")
+def encode_txt(data: dict) -> dnslib.RD:
+    return dnslib.TXT(data["txt"])
+
+
+@encoder("SRV")
+def encode_srv(data: dict) -> dnslib.RD:
+    return dnslib.SRV(
+        priority=data["priority"],
+        weight=data["weight"],
+        port=data["port"],
+        target=data["target"],
+    )
+
+
+@encoder("PTR")
+def encode_ptr(data: dict) -> dnslib.RD:
+    return dnslib.PTR(data["ptr"])
+
+
+@encoder("HTTPS")
+def encode_https(data: dict) -> dnslib.RD:
+    # params in zone file notation, e.g. "alpn=h2,h3 port=443"
+    params = data.get("params", "")
+    if isinstance(params, str):
+        params = params.split()
+    return dnslib.HTTPS.fromZone([str(data["priority"]), data["target"], *params])
@@ -0,0 +1,129 @@
+import struct
+
+HEADER = struct.Struct("!HBBHHHH")
+QUESTION_TAIL = struct.Struct("!HH")
+# the EDNS0 OPT pseudo-record: root name, type, UDP payload size (as class), extended rcode
+# and flags (as TTL), and the length of its options
+OPT = struct.Struct("!BHHIH")
+OPT_TYPE: int = 41
+UDP_PAYLOAD: int = 512
+
+# label bytes that read the same in dnslib's presentation format, anything else is escaped
+_PLAIN = bytes(b for b in range(0x21, 0x7F) if b != ord("."))
+
+
+class Query:
+    """
+    What the fast path needs to know about a query, see `parse_query()`.
+
+        id      transaction ID
+        qname   lowercase, with the trailing dot, like str(DNSRecord.q.qname).lower()
+        qtype   numeric type
+        qend    offset just past the question
+        payload UDP payload size the client advertised with EDNS0, None without EDNS0
+    """
+
+    __slots__ = ("id", "flags", "qname", "qtype", "qclass", "qend", "payload")
+
+    def __init__(
+        self,
+        id: int,
+        flags: int,
+        qname: str,
+        qtype: int,
+        qclass: int,
+        qend: int,
+        payload: int = None,
+    ):
+        self.id = id
+        self.flags = flags
+        self.qname = qname
+        self.qtype = qtype
+        self.qclass = qclass
+        self.qend = qend
+        self.payload = payload
+
+
+def parse_query(data: bytes) -> Query:
+    """
+    Parse a standard query with a single question (and at most an OPT record) without
+    building dnslib objects. Returns None for anything else, e.g. responses, other opcodes,
+    compressed or escaped names, which should go through dnslib.DNSRecord.parse.
+    """
+    if len(data) < HEADER.size + 5:
+        return None
+    id, flags_hi, flags_lo, qdcount, ancount, nscount, arcount = HEADER.unpack_from(data)
+    # QR clear and opcode QUERY
+    if flags_hi & 0xF8 or qdcount != 1 or ancount or nscount or arcount > 1:
+        return None
+
+    view = memoryview(data)
+    labels = []
+    offset = HEADER.size
+    end = len(data)
+    while True:
+        if offset >= end:
+            return None
+        length = data[offset]
+        offset += 1
+        if not length:
+            break
+        if length & 0xC0 or offset + length >= end:
+            return None
+        label = view[offset : offset + length]
+        if bytes(label).translate(None, _PLAIN):
+            return None
+        labels.append(label)
+        offset += length
+
+    if offset + QUESTION_TAIL.size > end:
+        return None
+    qtype, qclass = QUESTION_TAIL.unpack_from(data, offset)
+    qend = offset + QUESTION_TAIL.size
+
+    payload = None
+    if arcount:
+        # the only additional record we take is an OPT
+        if qend + OPT.size > end:
+            return None
+        name, rtype, rclass, _, rdlength = OPT.unpack_from(data, qend)
+        if name or rtype != OPT_TYPE or qend + OPT.size + rdlength != end:
+            return None
+        payload = max(rclass, UDP_PAYLOAD)
+
+    qname = b".".join(labels).lower().decode("ascii") + "."
+    flags = flags_hi << 8 | flags_lo
+    return Query(id, flags, qname, qtype, qclass, qend, payload)
+
+
+def error_reply(data: bytes, query: Query, rcode: int) -> bytes:
+    """
+    The packed reply dnslib's DNSRecord.reply() would give, without answers and with `rcode`.
+    """
+    flags_hi = (query.flags >> 8) | 0x84  # QR and AA
+    flags_lo = (query.flags & 0xF0) | 0x80 | rcode  # RA
+    header = HEADER.pack(query.id, flags_hi, flags_lo, 1, 0, 0, 0)
+    return header + data[HEADER.size : query.qend]
+
+
+def add_opt(reply: bytes, payload: int) -> bytes:
+    """
+    `reply` with an OPT record advertising `payload` bytes appended to its additional section.
+    """
+    (arcount,) = struct.unpack_from("!H", reply, 10)
+    opt = OPT.pack(0, OPT_TYPE, payload, 0, 0)
+    return reply[:10] + struct.pack("!H", arcount + 1) + reply[HEADER.size :] + opt
+
+
+def truncate_reply(reply: bytes, qend: int, payload: int = None) -> bytes:
+    """
+    `reply` cut down to its header, with TC set, and question, so the client retries over TCP.
+    With `payload` an OPT record is kept as well.
+    """
+    flags_hi = reply[2] | 0x02  # TC
+    header = reply[:2] + bytes((flags_hi, reply[3]))
+    counts = struct.pack("!HHHH", 1, 0, 0, 0 if payload is None else 1)
+    truncated = header + counts + reply[HEADER.size : qend]
+    if payload is not None:
+        truncated += OPT.pack(0, OPT_TYPE, payload, 0, 0)
+    return truncated
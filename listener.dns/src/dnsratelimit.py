@@ -0,0 +1,154 @@
+import ipaddress
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Callable
+
+from dnslib import DNSError
+
+logger = logging.getLogger(__name__)
+
+ALLOW: int = 0
+SLIP: int = 1
+DROP: int = 2
+
+
+class RateLimited(DNSError):
+    """
+    Raised by a resolver for a query whose response is dropped: dnslib's handler sends
+    nothing for a DNSError (and DnsLogger doesn't log this one).
+    """
+
+
+def client_prefix(client_ip: str) -> str:
+    """
+    The /24 (IPv4) or /56 (IPv6) a client is in, what rate limits are kept per.
+    """
+    if ":" not in client_ip:
+        return client_ip.rpartition(".")[0]
+    try:
+        return ipaddress.IPv6Address(client_ip).packed[:7].hex()
+    except ValueError:
+        return client_ip
+
+
+class ResponseRateLimiter:
+    """
+    Response rate limiting (RRL) for UDP, against reflection floods.
+
+    Every (client prefix, query type) gets a token bucket of `burst` responses that refills
+    at `rate` per second. Once a bucket is empty, responses are dropped, except every
+    `slip`-th one which is sent as an empty reply with TC set (a real client retries over
+    TCP, a spoofed victim gets nothing larger than its query). `slip` 0 drops them all.
+
+    Buckets live in an LRU table of at most `max_entries`, the least recently used (and so
+    long since refilled) are aged out first. What was limited is counted, per client prefix
+    and per zone, and logged as one summary record every `report_interval` seconds, see
+    `stats()`.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float = None,
+        slip: int = 2,
+        max_entries: int = 65536,
+        report_interval: float = 60,
+    ):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate * 2, 1)
+        self.slip = slip
+        self.max_entries = max_entries
+        self.report_interval = report_interval
+        self._buckets: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._limited: int = 0
+        self._counts = Counter()
+        self._prefixes = Counter()
+        self._zones = Counter()
+        self._reported = time.monotonic()
+
+    @classmethod
+    def from_env(cls):
+        """
+        A limiter configured through the LSTNER_DNS_RRL_* environment variables,
+        None when LSTNER_DNS_RRL_RATE isn't set (rate limiting off).
+        """
+        rate = float(os.getenv("LSTNER_DNS_RRL_RATE", 0))
+        if rate <= 0:
+            return None
+        burst = os.getenv("LSTNER_DNS_RRL_BURST")
+        return cls(
+            rate=rate,
+            burst=float(burst) if burst else None,
+            slip=int(os.getenv("LSTNER_DNS_RRL_SLIP", 2)),
+            max_entries=int(os.getenv("LSTNER_DNS_RRL_TABLE", 65536)),
+            report_interval=float(os.getenv("LSTNER_DNS_RRL_REPORT_S", 60)),
+        )
+
+    def check(self, client_ip: str, qtype: int, zone: Callable = None) -> int:
+        """
+        ALLOW, SLIP or DROP the response to a query. `zone()` names the zone the query
+        is for, it's only called for limited queries (to count them per zone).
+        """
+        prefix = client_prefix(client_ip)
+        key = (prefix, qtype)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+                if len(self._buckets) > self.max_entries:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                verdict = ALLOW
+            else:
+                self._limited += 1
+                verdict = SLIP if self.slip and self._limited % self.slip == 0 else DROP
+                self._counts["slipped" if verdict == SLIP else "dropped"] += 1
+                self._prefixes[prefix] += 1
+
+        if verdict != ALLOW and zone is not None:
+            zone_fqdn = zone() or "-"
+            with self._lock:
+                self._zones[zone_fqdn] += 1
+
+        with self._lock:
+            report = now - self._reported >= self.report_interval
+            if report:
+                self._reported = now
+        if report:
+            self._report()
+        return verdict
+
+    def stats(self, reset: bool = False) -> dict:
+        """
+        What was limited since the last report: dropped, slipped, the busiest prefixes and
+        zones ("-" for names outside any zone), and how many buckets are tracked.
+        """
+        with self._lock:
+            stats = {
+                "dropped": self._counts["dropped"],
+                "slipped": self._counts["slipped"],
+                "top_prefixes": dict(self._prefixes.most_common(5)),
+                "top_zones": dict(self._zones.most_common(5)),
+                "buckets": len(self._buckets),
+            }
+            if reset:
+                self._counts.clear()
+                self._prefixes.clear()
+                self._zones.clear()
+        return stats
+
+    def _report(self):
+        stats = self.stats(reset=True)
+        if stats["dropped"] or stats["slipped"]:
+            logger.warning(f"dns.rrl: {stats}")
@@ -1,16 +1,29 @@
-import ipaddress
 import logging
+import os
 import sys
+import threading
 import time
 
 import dnslib
+from cachetools import TTLCache
+from dnsanswercache import AnswerCache, CachedAnswer
+from dnscoalescer import InteractionCoalescer
+from dnsencoders import ENCODE_ERRORS, ENCODERS
 from dnslib import RR
 from dnslib.server import BaseResolver
+from dnsparser import (
+    UDP_PAYLOAD,
+    Query,
+    add_opt,
+    error_reply,
+    parse_query,
+    truncate_reply,
+)
+from dnsratelimit import ALLOW, DROP, RateLimited, ResponseRateLimiter
 from dnsruleengine import get_response
 from models.dnsrequest import DnsRequest
 from models.dnsresponse import DnsResponse
 from zentralbibliothek.dbclient3 import DatabaseClient
-from zentralbibliothek.utils import Utils
 
 DEFAULT_TTL: int = 60 * 30
 NOERROR: int = 0
@@ -26,18 +39,246 @@ class DusseldorfResolver(BaseResolver):
     "auto response" rule, and log it.
 
     To resolve a given request, call the resolve method.
+    Servers that have the raw packet at hand can call resolve_packet instead,
+    which skips dnslib where it can and answers repeated queries from a cache
+    of packed replies.
     """
 
+    def __init__(self):
+        # 0 turns the answer cache off
+        size: int = int(os.getenv("LSTNER_DNS_ANSWER_CACHE", 4096))
+        ttl: float = float(os.getenv("LSTNER_DNS_ANSWER_CACHE_TTL", 60))
+        self.answers: AnswerCache = AnswerCache(size, ttl) if size > 0 else None
+        # version.bind replies, they never change
+        self._static: dict = {}
+        # names answered negatively within the default negative TTL: when upstream resolvers
+        # cache those answers (RFC 2308), repeats should drop
+        negative_ttl: float = float(os.getenv("LSTNER_DNS_NEGATIVE_TTL", 300))
+        self._negatives = TTLCache(maxsize=8192, ttl=negative_ttl)
+        self._negatives_lock = threading.Lock()
+        self.negative_count: int = 0
+        self.negative_repeats: int = 0
+        # the UDP payload size we advertise with EDNS0, and how many replies didn't fit
+        self.edns_payload: int = int(os.getenv("LSTNER_DNS_EDNS_PAYLOAD", 1232))
+        self.truncated: int = 0
+        # opt in: response rate limiting for UDP, see ResponseRateLimiter
+        self.rrl: ResponseRateLimiter = ResponseRateLimiter.from_env()
+        # opt in: fold repeated interactions within this many milliseconds into one
+        coalesce_ms: int = int(os.getenv("LSTNER_DNS_COALESCE_MS", 0))
+        self.coalescer: InteractionCoalescer = None
+        if coalesce_ms > 0:
+            self.coalescer = InteractionCoalescer(self._store_interaction, coalesce_ms / 1000)
+
     def resolve(self, dnsrecord, handler) -> dnslib.DNSRecord:
         """
         This method resolves an incoming DNS query, passed using `dnsrecord` arg.
         If the query is for a host not in the Dusseldorf domain, it will just return an NXDomain response.
         If any rules match this query, the result of the rules will be in the response.
         Otherwise, it will be a default response.
+
+        With rate limiting on, UDP queries over their client's limit get an empty reply with
+        TC set (slipped) or raise RateLimited (dropped), and are neither resolved nor saved.
+        """
+        qname: str = str(dnsrecord.q.qname)
+        if verdict := self._rate_limit(dnsrecord.q.qtype, qname, handler):
+            if verdict == DROP:
+                raise RateLimited(f"rate limited: {qname}")
+            reply = dnsrecord.reply()
+            reply.header.tc = 1
+            return reply
+
+        reply = self._resolve(dnsrecord, handler, {})
+
+        # EDNS0: echo an OPT record, and size UDP replies to what the client can take
+        opt = next((rr for rr in dnsrecord.ar if rr.rtype == dnslib.QTYPE.OPT), None)
+        if opt is not None:
+            reply.add_ar(dnslib.EDNS0(udp_len=self.edns_payload))
+        if handler.protocol == "udp":
+            limit = self._udp_limit(None if opt is None else max(opt.rclass, UDP_PAYLOAD))
+            if len(reply.pack()) > limit:
+                self.truncated += 1
+                truncated = dnslib.DNSRecord(
+                    dnslib.DNSHeader(id=reply.header.id, bitmap=reply.header.bitmap, tc=1),
+                    q=reply.q,
+                )
+                if opt is not None:
+                    truncated.add_ar(dnslib.EDNS0(udp_len=self.edns_payload))
+                return truncated
+        return reply
+
+    def resolve_packet(self, data: bytes, handler) -> bytes:
+        """
+        Like resolve, but takes the raw query and returns the packed reply (None to drop it).
+
+        Standard single-question queries are read by a minimal parser, and answered without
+        building dnslib objects when the name is outside our domains, for version.bind, and
+        from the answer cache. A cached reply is reused as long as the zone's rules and the
+        domains (public_ips included) haven't changed since, only its ID and question are
+        patched. Interactions are saved either way.
+
+        EDNS0 is echoed, and UDP replies larger than the client's payload size (512 bytes
+        without EDNS0) are truncated with TC set, so the client retries over TCP.
+
+        With rate limiting on, UDP queries over their client's limit are dropped or slipped
+        (answered empty with TC set) before they are resolved, so they aren't saved either.
+        """
+        query: Query = parse_query(data)
+        if query is None:
+            # unusual packets take the slow road
+            try:
+                dnsrecord = dnslib.DNSRecord.parse(data)
+            except dnslib.DNSError as ex:
+                logger.debug(f"Invalid DNS packet: {ex}")
+                return None
+            try:
+                return self.resolve(dnsrecord, handler).pack()
+            except RateLimited:
+                return None
+
+        if verdict := self._rate_limit(query.qtype, query.qname, handler):
+            if verdict == DROP:
+                return None
+            return truncate_reply(error_reply(data, query, NOERROR), query.qend)
+
+        rdata = self._reply_packet(data, query, handler)
+        if query.payload is not None:
+            rdata = add_opt(rdata, self.edns_payload)
+        if handler.protocol == "udp" and len(rdata) > self._udp_limit(query.payload):
+            self.truncated += 1
+            payload = None if query.payload is None else self.edns_payload
+            rdata = truncate_reply(rdata, query.qend, payload)
+        return rdata
+
+    def _rate_limit(self, qtype: int, qname: str, handler) -> int:
+        if self.rrl is None or handler.protocol != "udp":
+            return ALLOW
+        return self.rrl.check(
+            str(handler.client_address[0]), qtype, zone=lambda: self._zone_of(qname)
+        )
+
+    @staticmethod
+    def _zone_of(qname: str) -> str:
+        request_fqdn: str = qname.lower().rstrip(".")
+        try:
+            db = DatabaseClient.get_instance()
+            if not db.get_domain_matcher().is_valid(request_fqdn):
+                return None
+            return db.find_zone_for_request(request_fqdn)
+        except Exception as ex:
+            logger.debug(f"No zone for rate limited {request_fqdn}: {ex}")
+            return None
+
+    def _udp_limit(self, payload: int) -> int:
+        if payload is None:
+            return UDP_PAYLOAD
+        return max(UDP_PAYLOAD, min(payload, self.edns_payload))
+
+    def _reply_packet(self, data: bytes, query: Query, handler) -> bytes:
+        """
+        The packed reply to `query`, without EDNS0.
         """
+        key = (query.qname, query.qtype)
+        if query.qname == "version.bind.":
+            if (entry := self._static.get(key)) and (rdata := entry.reply_to(data)):
+                self._count()
+                return rdata
+            rdata = self._resolve(dnslib.DNSRecord.parse(data), handler, {}).pack()
+            self._static[key] = CachedAnswer(rdata, None)
+            return rdata
+
+        db = DatabaseClient.get_instance()
+        request_fqdn: str = query.qname[:-1]
+        if not db.get_domain_matcher().is_valid(request_fqdn):
+            self._count()
+            logger.warning(f"Invalid domain: {request_fqdn}")
+            return error_reply(data, query, NXDOMAIN)
+
+        names = db.names_version() if self.answers is not None else None
+        # without the storage cache there's no telling when an answer goes stale
+        if names is None:
+            return self._resolve(dnslib.DNSRecord.parse(data), handler, {}).pack()
+
+        if entry := self.answers.get(key, names, db.rules_version):
+            if rdata := entry.reply_to(data):
+                self._count()
+                if entry.negative:
+                    self._note_negative(query.qname)
+                if entry.interaction is not None:
+                    request_args, response = entry.interaction
+                    client_ip: str = str(handler.client_address[0])
+                    req = DnsRequest(remote_addr=client_ip, **request_args)
+                    self.save_interaction(req, response)
+                return rdata
+
+        outcome: dict = {}
+        rdata = self._resolve(dnslib.DNSRecord.parse(data), handler, outcome).pack()
+        self.answers.put(key, CachedAnswer(rdata, names, **outcome))
+        return rdata
+
+    def save_interaction(self, req: DnsRequest, response: DnsResponse):
+        """
+        Save an interaction, through the coalescer when that's turned on.
+        """
+        if self.coalescer is not None:
+            self.coalescer.add(req, response)
+        else:
+            self._store_interaction(req, response)
+
+    def _store_interaction(self, req: DnsRequest, response: DnsResponse, extra: dict = None):
+        DatabaseClient.get_instance().save_interaction(req, response, extra)
+
+    def _count(self):
         global count
         count += 1
 
+        COUNT_INTERVAL: int = 1000
+        if count % COUNT_INTERVAL == 0:
+            logger.info(f"dns.requests.count: {count}")
+            logger.info(
+                f"dns.negative.count: {self.negative_count}, dns.negative.repeats: {self.negative_repeats}"
+            )
+
+    def _note_negative(self, qname: str):
+        """
+        Count a negative answer, and whether the same name was answered negatively within
+        the negative TTL already (traffic that negative caching upstream should absorb).
+        """
+        with self._negatives_lock:
+            self.negative_count += 1
+            if qname in self._negatives:
+                self.negative_repeats += 1
+            self._negatives[qname] = True
+
+    def _resolve(self, dnsrecord, handler, outcome: dict) -> dnslib.DNSRecord:
+        """
+        resolve(), also filling `outcome` with what the reply depends on: the zone and its
+        rules version, and the interaction to save (see CachedAnswer).
+        """
+        reply = self._answer(dnsrecord, handler, outcome)
+        # NXDOMAIN and NODATA carry our SOA, so resolvers can cache them (RFC 2308)
+        if not reply.rr and not reply.auth:
+            self.add_negative_soa(reply)
+        return reply
+
+    def add_negative_soa(self, reply: dnslib.DNSRecord):
+        """
+        Add the SOA of the domain the question falls under to the authority section, with its
+        negative TTL as the SOA minimum and the record's TTL. Names outside our domains get none.
+        """
+        qname: str = str(reply.q.qname).lower().rstrip(".")
+        domain = DatabaseClient.get_instance().get_domain_matcher().match(qname)
+        if domain is None:
+            return
+        ttl: int = DnsResponse.negative_ttl(domain)
+        soa = DnsResponse.default_soa_obj()
+        times: tuple = tuple(soa.get("times"))[:4] + (ttl,)
+        rdata = dnslib.SOA(soa.get("mname"), soa.get("rname"), times)
+        reply.add_auth(RR(rname=domain, rtype=dnslib.QTYPE.SOA, rclass=1, ttl=ttl, rdata=rdata))
+        self._note_negative(qname + ".")
+
+    def _answer(self, dnsrecord, handler, outcome: dict) -> dnslib.DNSRecord:
+        self._count()
+
         # qtype_s is always uppercased: "CNAME", "A", ...
         qtype_s: str = str(dnslib.QTYPE[dnsrecord.q.qtype]).upper()
 
@@ -48,10 +289,6 @@ class DusseldorfResolver(BaseResolver):
 
         reply = dnsrecord.reply()
 
-        COUNT_INTERVAL: int = 1000
-        if count % COUNT_INTERVAL == 0:
-            logger.info(f"dns.requests.count: {count}")
-
         # special cases, version.bind:
         if qname_s == "version.bind.":
             staticResponse: str = "dusseldorf"
@@ -71,16 +308,7 @@ class DusseldorfResolver(BaseResolver):
 
         db = DatabaseClient.get_instance()
 
-        domains: [] = db.get_domains()
-        valid_domain: bool = False
-
-        # TODO: make this a method in itself, so we can cache this
-        for domain in domains:
-            if Utils.fqdn_is_valid(fqdn=request_fqdn, domain=domain):
-                valid_domain = True
-                break
-
-        if not valid_domain:
+        if not db.get_domain_matcher().is_valid(request_fqdn):
             logger.warning(f"Invalid domain: {request_fqdn}")
             reply.header.set_rcode(NXDOMAIN)
             return reply
@@ -170,6 +398,10 @@ class DusseldorfResolver(BaseResolver):
         # measure perf from now onwards
         start_of_request = time.perf_counter()
 
+        # read before the rules are, so a reply is never newer than its version
+        outcome["zone"] = zone_fqdn
+        outcome["zone_version"] = db.rules_version(zone_fqdn)
+
         # sent to a valid domain
         req = DnsRequest(
             req_fqdn=request_fqdn,
@@ -197,7 +429,14 @@ class DusseldorfResolver(BaseResolver):
         start_db_write = time.perf_counter()
 
         if response is not None:
-            db.save_interaction(req, response)
+            self.save_interaction(req, response)
+            request_args = dict(
+                req_fqdn=request_fqdn,
+                zone_fqdn=zone_fqdn,
+                reqtype=qtype_s,
+                domain=domain,
+            )
+            outcome["interaction"] = (request_args, response)
 
         end_db_write = time.perf_counter()
 
@@ -215,86 +454,32 @@ class DusseldorfResolver(BaseResolver):
         Makes a (binary) DNS packet based out the (DnsReponse) response
         Parameters:
             response:DnsResponse -- the DNS response we're sending back.
-        Returns: dnslib.RR record (could be A, MX, SOA...)
+        Returns: dnslib.RR record (could be A, MX, SOA...), an empty TXT
+                 record when the type isn't supported or its data doesn't encode.
         """
         if response is None:
             logger.warning("make_resource_record() called with response == None")
             return None
 
-        rtype = None
-
-        def _RR(rdata: any, ttl: int = 60) -> RR:
-            """Embedded method to return dns.RR type"""
-            rname = response.ResponseName
-            return RR(rname=rname, rtype=rtype, rclass=1, ttl=ttl, rdata=rdata)
-
-        # fail quickly
-        supported_types = list(dnslib.QTYPE.forward.values())
-        if response.ResponseType not in supported_types:
-            return _RR(dnslib.TXT(""))
-
-        # ipv4
-        if response.ResponseType == "A":
-            ip = response.ResponseData["ip"]
-            try:
-                data = str(ipaddress.IPv4Address(ip))
-            except ipaddress.AddressValueError:
-                logger.warning("Invalid IPv4 address: %s", ip)
-                data = "0.0.0.0"  # ?
-            rtype = dnslib.QTYPE.A
-            return _RR(dnslib.A(data))
-
-        # ipv6
-        if response.ResponseType == "AAAA":
-            ip = response.ResponseData["ip"]
+        rname = response.ResponseName
+        if (registered := ENCODERS.get(response.ResponseType)) is not None:
+            rtype, encode = registered
             try:
-                data = str(ipaddress.IPv6Address(ip))
-            except ipaddress.AddressValueError:
-                logger.warning("Invalid IPv6 address: %s", ip)
-                data = "::"
-            rtype = dnslib.QTYPE.AAAA
-            return _RR(dnslib.AAAA(data))
-
-        # caa record
-        if response.ResponseType == "CAA":
-            rtype = dnslib.QTYPE.CAA
-            flags = response.ResponseData["flags"]
-            tag = response.ResponseData["tag"]
-            value = response.ResponseData["value"]
-            return _RR(dnslib.CAA(flags=flags, tag=tag, value=value))
-
-        if response.ResponseType == "CNAME":
-            rtype = dnslib.QTYPE.CNAME
-            cname = response.ResponseData["cname"]
-            return _RR(dnslib.CNAME(cname))
-
-        if response.ResponseType == "MX":
-            rtype = dnslib.QTYPE.MX
-            name: str = response.ResponseData["name"]
-            priority: int = response.ResponseData["priority"]
-            return _RR(dnslib.MX(label=name, preference=priority))
-
-        if response.ResponseType == "NS":
-            rtype = dnslib.QTYPE.NS
-            dns_server: str = response.ResponseData["ns"]
-            return _RR(dnslib.NS(dns_server))
-
-        if response.ResponseType == "SOA":
-            rtype = dnslib.QTYPE.SOA
-            soa = DnsResponse.default_soa_obj()
-            mname: str = soa.get("mname")
-            rname: str = soa.get("rname")
-            times: tuple = soa.get("times")
-            return _RR(dnslib.SOA(mname, rname, times))
-
-        if response.ResponseType == "TXT":
-            rtype = dnslib.QTYPE.TXT
-            txt = response.ResponseData["txt"]
-            return _RR(dnslib.TXT(txt))
-
-        logger.warning("Unsupported DNS type: %s", response.ResponseType)
-        rtype = dnslib.QTYPE.TXT
-        return _RR(dnslib.TXT(""))
+                rdata = encode(response.ResponseData)
+                return RR(rname=rname, rtype=rtype, rclass=1, ttl=60, rdata=rdata)
+            except ENCODE_ERRORS as e:
+                logger.warning(
+                    "Invalid %s data %s: %s",
+                    response.ResponseType,
+                    response.ResponseData,
+                    e,
+                )
+        else:
+            logger.warning("Unsupported DNS type: %s", response.ResponseType)
+
+        return RR(
+            rname=rname, rtype=dnslib.QTYPE.TXT, rclass=1, ttl=60, rdata=dnslib.TXT("")
+        )
 
 
 # if called directly, fail.
@@ -1,11 +1,17 @@
+import copy
 import json
 
 from models.dnsrequest import DnsRequest
 from models.dnsresponse import DnsResponse
+from zentralbibliothek.models.matcher import ALWAYS, COST_LOOKUP, Dispatch, Matcher
 from zentralbibliothek.ruleengine import Predicate, Result, RuleEngine
 
 
 # region predicates
+def _request_type(request: DnsRequest) -> str:
+    return request.RequestType.lower()
+
+
 class DnsRequestTypePredicate(Predicate):
     """
     Check if the DNS request type of the request is one of the expected ones in the parameter.
@@ -13,11 +19,19 @@ class DnsRequestTypePredicate(Predicate):
     """
 
     @classmethod
-    def satisfied_by(cls, request: DnsRequest, parameter: str):
+    def compile(cls, parameter: str) -> Matcher:
         if not parameter:  # If we're not requiring anything, then we should let all requests satisfy the predicate.
-            return True
-        reqtypes = parameter.split(",")
-        return request.RequestType.lower() in [rt.lower() for rt in reqtypes]
+            return ALWAYS
+        reqtypes = frozenset(rt.lower() for rt in parameter.split(","))
+        return Matcher(
+            test=lambda request: request.RequestType.lower() in reqtypes,
+            dispatch=Dispatch(key="dns.type", value=_request_type, accepts=reqtypes),
+            cost=COST_LOOKUP,
+        )
+
+    @classmethod
+    def satisfied_by(cls, request: DnsRequest, parameter: str):
+        return cls.compile(parameter)(request)
 
 
 # endregion
@@ -31,9 +45,18 @@ class SetDnsResponseDataResult(Result):
     """
 
     @classmethod
-    def execute(cls, result_data: dict, parameter: str):
+    def parse(cls, parameter: str):
+        return json.loads(parameter)
+
+    @classmethod
+    def deterministic(cls, parameter) -> bool:
+        return True
+
+    @classmethod
+    def execute(cls, result_data: dict, parameter: dict):
         response: DnsResponse = result_data["response"]
-        response._rdata = json.loads(parameter)
+        # copy, the parsed parameter is shared between requests
+        response._rdata = copy.copy(parameter)
         result_data["response"] = response
         return result_data
 
@@ -43,6 +66,10 @@ class SetDnsResponseAnswerTypeResult(Result):
     Sets the Answer Type (SOA, CNAME, etc) of the DNS response
     """
 
+    @classmethod
+    def deterministic(cls, parameter) -> bool:
+        return True
+
     @classmethod
     def execute(cls, result_data: dict, parameter: str):
         response: DnsResponse = result_data["response"]
@@ -57,9 +84,17 @@ class SetDnsResponseTTLResult(Result):
     """
 
     @classmethod
-    def execute(cls, result_data: dict, parameter: str):
+    def parse(cls, parameter: str):
+        return int(parameter)
+
+    @classmethod
+    def deterministic(cls, parameter) -> bool:
+        return True
+
+    @classmethod
+    def execute(cls, result_data: dict, parameter: int):
         response: DnsResponse = result_data["response"]
-        response._ttl = int(parameter)
+        response._ttl = parameter
         result_data["response"] = response
         return result_data
 
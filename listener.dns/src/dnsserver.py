@@ -0,0 +1,299 @@
+import asyncio
+import logging
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dnslib import DNSError, DNSRecord
+from dnslib.server import BaseResolver, DNSLogger
+from dnsratelimit import RateLimited
+from zentralbibliothek.dbclient3 import DatabaseClient
+from zentralbibliothek.workers import run_workers as supervise
+
+logger = logging.getLogger(__name__)
+
+TCP_IDLE_TIMEOUT: float = 10.0
+"""seconds a TCP connection may sit idle between queries"""
+
+SHED_REPORT_INTERVAL: float = 60.0
+"""seconds between the records of queries shed for being over `max_in_flight`"""
+
+SERVFAIL: int = 2
+
+
+class _Handler:
+    """
+    What resolvers get as `handler`, the bits of dnslib's DNSHandler they use.
+    """
+
+    __slots__ = ("client_address", "protocol")
+
+    def __init__(self, client_address: tuple, protocol: str):
+        self.client_address = client_address
+        self.protocol = protocol
+
+
+class DnsLogger(DNSLogger):
+    """
+    dnslib's logger for the threaded servers, quiet about queries dropped by rate limiting
+    (a flood of them is what it's there for).
+    """
+
+    def log_error(self, handler, e):
+        if not isinstance(e, RateLimited):
+            super().log_error(handler, e)
+
+
+class _UdpProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server: "AsyncDnsServer"):
+        self.server = server
+        self.transport: asyncio.DatagramTransport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        if self.server.resolve_inline():
+            # nothing blocking to wait for, skip the executor round trip
+            if rdata := self.server.handle_query(data, addr, "udp"):
+                self.transport.sendto(rdata, addr)
+            return
+        # over the limit the packet is dropped, the client will retry
+        if self.server.acquire_slot():
+            self.server.spawn(self._reply(data, addr))
+
+    async def _reply(self, data: bytes, addr: tuple):
+        if rdata := await self.server.resolve_blocking(data, addr, "udp"):
+            self.transport.sendto(rdata, addr)
+
+    def error_received(self, exc):
+        logger.debug("UDP error: %s", exc)
+
+
+class AsyncDnsServer:
+    """
+    Serves a dnslib resolver (e.g. DusseldorfResolver) over UDP and TCP from one asyncio loop.
+
+    The resolver reads from storage and saves interactions, both of which may block. While the
+    storage cache is loaded and interactions are queued without ever waiting on the database
+    (and `inline_when_cached` is set), queries are resolved on the loop directly; otherwise they
+    go to a thread pool of `executor_threads`. At most `max_in_flight` of those wait for it at
+    a time: past that, UDP queries are dropped and TCP queries answered with SERVFAIL, rather
+    than queueing answers that come long after the client gave up. Shed queries are counted
+    and logged as one dns.shed record every SHED_REPORT_INTERVAL seconds.
+
+    With `reuse_port`, the sockets are bound with SO_REUSEPORT so several processes can serve
+    the same port, see `run_workers()`.
+    """
+
+    def __init__(
+        self,
+        resolver: BaseResolver,
+        address: str = "",
+        port: int = 53,
+        udp: bool = True,
+        tcp: bool = True,
+        executor_threads: int = 8,
+        reuse_port: bool = False,
+        inline_when_cached: bool = True,
+        max_in_flight: int = 1024,
+    ):
+        self.resolver = resolver
+        self.address = address or "0.0.0.0"
+        self.port = port
+        self.udp = udp
+        self.tcp = tcp
+        self.reuse_port = reuse_port
+        self.inline_when_cached = inline_when_cached
+        self.max_in_flight = max_in_flight
+        self.shed: int = 0
+        self._shed_reported: int = 0
+        self._shed_report_at: float = time.monotonic() + SHED_REPORT_INTERVAL
+        self._in_flight: int = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=executor_threads, thread_name_prefix="dns-resolver"
+        )
+        self._tasks: set = set()
+        self._udp_transport: asyncio.DatagramTransport = None
+        self._tcp_server: asyncio.AbstractServer = None
+
+    async def start(self):
+        """
+        Bind the sockets. With port 0, UDP gets a random port and TCP uses the same one.
+        """
+        loop = asyncio.get_running_loop()
+        if self.udp:
+            self._udp_transport, _ = await loop.create_datagram_endpoint(
+                lambda: _UdpProtocol(self),
+                local_addr=(self.address, self.port),
+                reuse_port=self.reuse_port or None,
+            )
+            self.port = self._udp_transport.get_extra_info("sockname")[1]
+        if self.tcp:
+            self._tcp_server = await asyncio.start_server(
+                self._handle_tcp,
+                host=self.address,
+                port=self.port,
+                reuse_port=self.reuse_port or None,
+            )
+            self.port = self._tcp_server.sockets[0].getsockname()[1]
+        protocols = "+".join(p for p, on in (("udp", self.udp), ("tcp", self.tcp)) if on)
+        logger.info(f"Listening on {self.address}:{self.port}/{protocols}")
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._udp_transport is not None:
+            self._udp_transport.close()
+        if self._tcp_server is not None:
+            self._tcp_server.close()
+        self._executor.shutdown(wait=False)
+
+    def spawn(self, coro):
+        # keep a reference, the loop only holds weak ones
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def resolve_inline(self) -> bool:
+        if not self.inline_when_cached:
+            return False
+        db = DatabaseClient.get_instance()
+        # a blocking writer (or none at all) would stall every query on the loop while it saves
+        return db.cache is not None and db.saves_without_blocking
+
+    def acquire_slot(self) -> bool:
+        """
+        Take one of the `max_in_flight` slots for a query that goes to the executor,
+        False (and the query is counted as shed) when they're all taken.
+        """
+        if self._in_flight >= self.max_in_flight:
+            self.shed += 1
+            self._maybe_report_shed()
+            return False
+        self._in_flight += 1
+        return True
+
+    def _maybe_report_shed(self):
+        now = time.monotonic()
+        if now < self._shed_report_at:
+            return
+        self._shed_report_at = now + SHED_REPORT_INTERVAL
+        shed, self._shed_reported = self.shed - self._shed_reported, self.shed
+        stats = {"dropped": shed, "max_in_flight": self.max_in_flight}
+        logger.warning(f"dns.shed: {stats}")
+
+    async def resolve_blocking(self, data: bytes, client_address: tuple, protocol: str):
+        """
+        handle_query() on the executor, for a query holding a slot (released here).
+        """
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self._executor, self.handle_query, data, client_address, protocol
+            )
+        finally:
+            self._in_flight -= 1
+
+    async def answer(self, data: bytes, client_address: tuple, protocol: str):
+        if self.resolve_inline():
+            return self.handle_query(data, client_address, protocol)
+        if not self.acquire_slot():
+            return self._servfail(data)
+        return await self.resolve_blocking(data, client_address, protocol)
+
+    def handle_query(self, data: bytes, client_address: tuple, protocol: str):
+        """
+        Resolve one packet, returns the packed reply or None when there is nothing to send.
+        Mirrors dnslib's DNSHandler: unparsable packets are dropped.
+        """
+        handler = _Handler(client_address, protocol)
+
+        # resolvers that work on the raw packet parse it themselves
+        if resolve_packet := getattr(self.resolver, "resolve_packet", None):
+            try:
+                return resolve_packet(data, handler)
+            except Exception as ex:
+                logger.exception("Failed to resolve a DNS packet", exc_info=ex)
+                return self._servfail(data)
+
+        try:
+            request = DNSRecord.parse(data)
+        except DNSError as ex:
+            logger.debug(f"Invalid DNS packet from {client_address[0]}: {ex}")
+            return None
+
+        try:
+            return self.resolver.resolve(request, handler).pack()
+        except Exception as ex:
+            logger.exception(f"Failed to resolve {request.q.qname}", exc_info=ex)
+            return self._servfail(data)
+
+    @staticmethod
+    def _servfail(data: bytes):
+        try:
+            reply = DNSRecord.parse(data).reply()
+        except DNSError:
+            return None
+        reply.header.rcode = SERVFAIL
+        return reply.pack()
+
+    async def _handle_tcp(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info("peername")
+        try:
+            # a connection can carry several queries, each prefixed with its length
+            while True:
+                header = await asyncio.wait_for(reader.readexactly(2), TCP_IDLE_TIMEOUT)
+                (length,) = struct.unpack("!H", header)
+                data = await asyncio.wait_for(reader.readexactly(length), TCP_IDLE_TIMEOUT)
+                rdata = await self.answer(data, peer, "tcp")
+                if rdata is None:
+                    break
+                writer.write(struct.pack("!H", len(rdata)) + rdata)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+def serve(
+    resolver_class: type,
+    address: str,
+    port: int,
+    udp: bool = True,
+    tcp: bool = True,
+    executor_threads: int = 8,
+    reuse_port: bool = False,
+    max_in_flight: int = 1024,
+):
+    """
+    Run an AsyncDnsServer until interrupted. This is also the entry point of worker processes.
+    """
+    server = AsyncDnsServer(
+        resolver=resolver_class(),
+        address=address,
+        port=port,
+        udp=udp,
+        tcp=tcp,
+        executor_threads=executor_threads,
+        reuse_port=reuse_port,
+        max_in_flight=max_in_flight,
+    )
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+def run_workers(workers: int, **kwargs) -> int:
+    """
+    Run `serve(**kwargs)` in `workers` processes that share the port through SO_REUSEPORT,
+    so the kernel spreads queries over them, see zentralbibliothek's `run_workers()`.
+    """
+    return supervise(serve, workers, name="dns-worker", **kwargs)
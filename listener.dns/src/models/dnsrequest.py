@@ -95,6 +95,11 @@ class DnsRequest(NetworkRequest):
     def json(self):
         return json.dumps({"request_type": self._reqtype, "ttl": self._ttl})
 
+    @property
+    def response_key(self):
+        # what default_response depends on
+        return (self._reqtype, self._req_fqdn, self._ttl)
+
     @property
     def default_response(self):
         data: dict = {}
@@ -146,6 +146,18 @@ class DnsResponse(NetworkResponse):
             ),
         }
 
+    @classmethod
+    @ttl_cache(300, 300)
+    def negative_ttl(cls, domain: str) -> int:
+        """
+        How long resolvers may cache NXDOMAIN/NODATA answers for names under `domain`
+        (RFC 2308): its `negative_ttl`, or LSTNER_DNS_NEGATIVE_TTL.
+        """
+        db = DatabaseClient.get_instance()
+        if (ttl := db.get_negative_ttl(domain)) is not None:
+            return int(ttl)
+        return int(os.getenv("LSTNER_DNS_NEGATIVE_TTL", 300))
+
     @classmethod
     def fromRequest(cls, req):
         """
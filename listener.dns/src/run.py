@@ -3,8 +3,9 @@ import os
 import sys
 import time
 
-from dnslib.server import DNSLogger, DNSServer
+from dnslib.server import DNSServer
 from dnsresolver import DusseldorfResolver
+from dnsserver import DnsLogger, run_workers, serve
 from zentralbibliothek.dbclient3 import DatabaseClient
 from zentralbibliothek.utils import Utils
 
@@ -27,23 +28,50 @@ def main():
     udp: bool = udp_env.lower() in ("true", "1", "on", "y", "yes")
     iface: str = str(os.getenv("LSTNER_DNS_INTERFACE", ""))
 
+    # "threaded" (dnslib, one protocol) or "asyncio" (UDP and TCP, optionally several workers)
+    server_kind: str = os.getenv("LSTNER_DNS_SERVER", "threaded").lower()
+    workers: int = int(os.getenv("LSTNER_DNS_WORKERS", 1))
+    executor_threads: int = int(os.getenv("LSTNER_DNS_EXECUTOR_THREADS", 8))
+    # queries waiting on the executor at most, the rest are shed
+    max_in_flight: int = int(os.getenv("LSTNER_DNS_MAX_IN_FLIGHT", 1024))
+
     # if port is below 1024, we need to be root
     if port < 1024 and os.geteuid() != 0:
         logger.error(f"Listening on port {port} requires root privileges")
         return -1
 
-    dnsserver = DNSServer(
-        resolver=DusseldorfResolver(),
-        port=port,
-        address=iface,
-        logger=DNSLogger("-send,-recv,-request,-reply,-truncated,-data"),
-        tcp=not udp,
-    )
+    if server_kind == "asyncio":
+        logger.info(f"Trying to listen on {port}/udp+tcp with {workers} worker(s)")
+        options = dict(
+            resolver_class=DusseldorfResolver,
+            address=iface,
+            port=port,
+            executor_threads=executor_threads,
+            max_in_flight=max_in_flight,
+        )
+        if workers > 1:
+            return run_workers(workers, **options)
+        serve(**options)
+        return 0
+
+    resolver = DusseldorfResolver()
+    dnsservers = [
+        DNSServer(
+            resolver=resolver,
+            port=port,
+            address=iface,
+            logger=DnsLogger("-send,-recv,-request,-reply,-truncated,-data"),
+            tcp=tcp,
+        )
+        # UDP replies that don't fit are truncated, clients retry those over TCP
+        for tcp in ((False, True) if udp else (True,))
+    ]
 
     try:
-        msg: str = f"Trying to listen on {port}/{'tcp' if not udp else 'udp'}"
+        msg: str = f"Trying to listen on {port}/{'udp+tcp' if udp else 'tcp'}"
         logger.info(msg)
-        dnsserver.start_thread()
+        for dnsserver in dnsservers:
+            dnsserver.start_thread()
 
         while 1:
             time.sleep(10)
@@ -52,7 +80,8 @@ def main():
 
     except Exception as ex:
         logging.exception(ex)
-        dnsserver.stop()
+        for dnsserver in dnsservers:
+            dnsserver.stop()
         return -1
 
 
@@ -0,0 +1,46 @@
+import dnslib
+from dnsanswercache import AnswerCache, CachedAnswer, question_end
+
+
+def make_reply(qname: str = "foo.test.net"):
+    query = dnslib.DNSRecord.question(qname, "A")
+    reply = query.reply()
+    reply.add_answer(
+        dnslib.RR(qname, dnslib.QTYPE.A, rdata=dnslib.A("1.2.3.4"), ttl=60)
+    )
+    return reply.pack()
+
+
+def test_question_end():
+    packet = dnslib.DNSRecord.question("foo.test.net", "A").pack()
+    assert question_end(packet) == len(packet)
+    assert question_end(packet[:-1]) == -1
+
+
+def test_cachedanswer_reply_to():
+    entry = CachedAnswer(make_reply(), names=(1, 1))
+    query = dnslib.DNSRecord.question("FoO.tESt.net", "A")
+    query.header.rd = 0
+
+    reply = dnslib.DNSRecord.parse(entry.reply_to(query.pack()))
+    assert reply.header.id == query.header.id
+    assert reply.header.rd == 0
+    assert str(reply.q.qname) == "FoO.tESt.net."
+    assert str(reply.a.rdata) == "1.2.3.4"
+
+    other = dnslib.DNSRecord.question("bar.test.net", "A")
+    assert entry.reply_to(other.pack()) is None
+
+
+def test_answercache_stale():
+    cache = AnswerCache()
+    versions = {"sahil.test.net": 5}
+    cache.put(("foo.test.net.", 1), CachedAnswer(make_reply(), (1, 1), "sahil.test.net", 5))
+
+    assert cache.get(("foo.test.net.", 1), (1, 1), versions.get) is not None
+    assert cache.get(("foo.test.net.", 28), (1, 1), versions.get) is None
+    # public_ips or zones changed
+    assert cache.get(("foo.test.net.", 1), (2, 1), versions.get) is None
+    # the zone's rules changed
+    versions["sahil.test.net"] = 6
+    assert cache.get(("foo.test.net.", 1), (1, 1), versions.get) is None
@@ -0,0 +1,57 @@
+import time
+
+from dnscoalescer import InteractionCoalescer
+from models.dnsrequest import DnsRequest
+from models.dnsresponse import DnsResponse
+
+resp = DnsResponse(type="A", data={"ip": "1.2.3.4"}, name="x.test.net", ttl=60)
+
+
+def request(client: str = "10.0.0.1", reqtype: str = "A") -> DnsRequest:
+    return DnsRequest("x.sahil.test.net", "sahil.test.net", reqtype, client, "test.net")
+
+
+def test_coalescer_folds_repeats():
+    saved = []
+    coalescer = InteractionCoalescer(lambda *args: saved.append(args), window=0.2)
+    for _ in range(3):
+        coalescer.add(request(), resp)
+    coalescer.add(request(client="10.0.0.2"), resp)
+    coalescer.add(request(reqtype="AAAA"), resp)
+    assert saved == []
+
+    deadline = time.monotonic() + 5
+    while len(saved) < 3 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    counts = sorted(extra["count"] for _, _, extra in saved)
+    assert counts == [1, 1, 3]
+    assert coalescer.folded == 2
+    for _, _, extra in saved:
+        assert extra["first_seen"] <= extra["last_seen"]
+    coalescer.close()
+
+
+def test_coalescer_close_saves_pending():
+    saved = []
+    coalescer = InteractionCoalescer(lambda *args: saved.append(args), window=60)
+    coalescer.add(request(), resp)
+    coalescer.close()
+    assert len(saved) == 1
+    # after closing, interactions are saved right away
+    coalescer.add(request(), resp)
+    assert len(saved) == 2
+
+
+def test_coalescer_flushes_in_due_order():
+    saved = []
+    coalescer = InteractionCoalescer(lambda *args: saved.append(args), window=60)
+    for i in range(5):
+        coalescer.add(request(client=f"10.0.0.{i}"), resp)
+    entries = list(coalescer._pending.values())
+    # only the first two are due, the rest stay pending
+    entries[0].due = entries[1].due = 0
+    coalescer.flush()
+    assert [req.remote_addr for req, _, _ in saved] == ["10.0.0.0", "10.0.0.1"]
+    assert len(coalescer._pending) == 3
+    coalescer.close()
+    assert len(saved) == 5
@@ -0,0 +1,80 @@
+import dnslib
+from dnsparser import add_opt, error_reply, parse_query, truncate_reply
+from dnsresolver import DusseldorfResolver
+
+
+class Handler:
+    client_address = ("127.0.0.1", 5353)
+    protocol = "udp"
+
+
+def test_parse_query():
+    record = dnslib.DNSRecord.question("FoO.Test.NET", "AAAA")
+    query = parse_query(record.pack())
+    assert query.id == record.header.id
+    assert query.qname == "foo.test.net."
+    assert query.qtype == dnslib.QTYPE.AAAA
+    assert query.qend == len(record.pack())
+
+
+def test_parse_query_with_edns():
+    record = dnslib.DNSRecord.question("foo.test.net", "A")
+    assert parse_query(record.pack()).payload is None
+    record.add_ar(dnslib.EDNS0(udp_len=4096))
+    query = parse_query(record.pack())
+    assert query.qname == "foo.test.net."
+    assert query.payload == 4096
+
+
+def test_parse_query_unusual():
+    # responses, escaped names and truncated packets go to dnslib
+    reply = dnslib.DNSRecord.question("foo.test.net").reply()
+    assert parse_query(reply.pack()) is None
+    assert parse_query(dnslib.DNSRecord.question("a b.test.net").pack()) is None
+    assert parse_query(dnslib.DNSRecord.question("foo.test.net").pack()[:-3]) is None
+    assert parse_query(b"\x00" * 5) is None
+
+
+def test_error_reply():
+    record = dnslib.DNSRecord.question("foo.test.net", "A")
+    expected = record.reply()
+    expected.header.set_rcode(3)
+    data = record.pack()
+    assert error_reply(data, parse_query(data), 3) == expected.pack()
+
+
+def test_resolve_packet_version_bind():
+    resolver = DusseldorfResolver()
+    for _ in range(2):
+        record = dnslib.DNSRecord.question("VERSION.bind", "TXT", "CH")
+        reply = dnslib.DNSRecord.parse(resolver.resolve_packet(record.pack(), Handler()))
+        assert reply.header.id == record.header.id
+        assert str(reply.q.qname) == "VERSION.bind."
+        assert str(reply.a.rdata) == '"dusseldorf"'
+
+
+def test_add_opt_and_truncate():
+    record = dnslib.DNSRecord.question("foo.test.net", "TXT")
+    reply = record.reply()
+    for _ in range(4):
+        reply.add_answer(*dnslib.RR.fromZone("foo.test.net IN TXT %s" % ("x" * 255)))
+    data = record.pack()
+    rdata = add_opt(reply.pack(), 1232)
+    assert dnslib.DNSRecord.parse(rdata).ar[0].rclass == 1232
+
+    truncated = dnslib.DNSRecord.parse(truncate_reply(rdata, parse_query(data).qend, 1232))
+    assert truncated.header.tc == 1
+    assert truncated.header.id == record.header.id
+    assert str(truncated.q.qname) == "foo.test.net."
+    assert not truncated.rr
+    assert truncated.ar[0].rtype == dnslib.QTYPE.OPT
+
+
+def test_resolve_packet_echoes_edns():
+    resolver = DusseldorfResolver()
+    record = dnslib.DNSRecord.question("version.bind", "TXT", "CH")
+    record.add_ar(dnslib.EDNS0(udp_len=4096))
+    reply = dnslib.DNSRecord.parse(resolver.resolve_packet(record.pack(), Handler()))
+    assert reply.ar[0].rtype == dnslib.QTYPE.OPT
+    assert reply.ar[0].rclass == resolver.edns_payload
+    assert str(reply.a.rdata) == '"dusseldorf"'
@@ -0,0 +1,83 @@
+import dnslib
+import pytest
+from dnsratelimit import (
+    ALLOW,
+    DROP,
+    SLIP,
+    RateLimited,
+    ResponseRateLimiter,
+    client_prefix,
+)
+from dnsresolver import DusseldorfResolver
+
+TXT: int = dnslib.QTYPE.TXT
+
+
+class Handler:
+    client_address = ("198.51.100.7", 5353)
+    protocol = "udp"
+
+
+def test_client_prefix():
+    assert client_prefix("198.51.100.7") == client_prefix("198.51.100.200")
+    assert client_prefix("198.51.100.7") != client_prefix("198.51.101.7")
+    assert client_prefix("2001:db8:0:1::1") == client_prefix("2001:db8:0:ff::2")
+    assert client_prefix("2001:db8:0:1::1") != client_prefix("2001:db8:0:100::1")
+
+
+def test_rrl_bucket():
+    rrl = ResponseRateLimiter(rate=0.001, burst=3, slip=2)
+    verdicts = [rrl.check("198.51.100.7", TXT) for _ in range(7)]
+    assert verdicts == [ALLOW, ALLOW, ALLOW, DROP, SLIP, DROP, SLIP]
+    # other types and prefixes have their own buckets
+    assert rrl.check("198.51.100.8", dnslib.QTYPE.A) == ALLOW
+    assert rrl.check("203.0.113.1", TXT) == ALLOW
+
+    # counted per zone as well
+    assert rrl.check("198.51.100.7", TXT, zone=lambda: "a.ssrf.ms") == DROP
+    assert rrl.check("198.51.100.7", TXT, zone=lambda: None) == SLIP
+
+    stats = rrl.stats(reset=True)
+    assert (stats["dropped"], stats["slipped"]) == (3, 3)
+    assert stats["top_prefixes"] == {"198.51.100": 6}
+    assert stats["top_zones"] == {"a.ssrf.ms": 1, "-": 1}
+    assert rrl.stats()["dropped"] == 0
+
+
+def test_rrl_table_ages_out():
+    rrl = ResponseRateLimiter(rate=0.001, burst=1, max_entries=2)
+    assert rrl.check("10.0.1.1", TXT) == ALLOW
+    rrl.check("10.0.2.1", TXT)
+    rrl.check("10.0.3.1", TXT)
+    assert rrl.stats()["buckets"] == 2
+    # the first bucket was aged out, so it starts full again
+    assert rrl.check("10.0.1.1", TXT) == ALLOW
+
+
+def test_resolve_packet_rate_limited():
+    resolver = DusseldorfResolver()
+    resolver.rrl = ResponseRateLimiter(rate=0.001, burst=1, slip=2)
+    resolver._zone_of = lambda qname: None
+    query = dnslib.DNSRecord.question("version.bind", "TXT", "CH").pack()
+
+    assert dnslib.DNSRecord.parse(resolver.resolve_packet(query, Handler())).rr
+    assert resolver.resolve_packet(query, Handler()) is None
+    slipped = dnslib.DNSRecord.parse(resolver.resolve_packet(query, Handler()))
+    assert slipped.header.tc == 1
+    assert not slipped.rr
+
+
+def test_resolve_rate_limited():
+    # the threaded server's path, through dnslib's handler
+    resolver = DusseldorfResolver()
+    resolver.rrl = ResponseRateLimiter(rate=0.001, burst=1, slip=2)
+    resolver._zone_of = lambda qname: None
+    query = dnslib.DNSRecord.question("version.bind", "TXT", "CH")
+
+    assert resolver.resolve(query, Handler()).rr
+    with pytest.raises(RateLimited):
+        resolver.resolve(query, Handler())
+    slipped = resolver.resolve(query, Handler())
+    assert slipped.header.tc == 1
+    assert not slipped.rr
+    assert resolver.rrl.stats()["top_zones"] == {"-": 2}
@@ -1,6 +1,10 @@
 import dnslib
+from dnsencoders import ENCODERS
 from dnsresolver import DusseldorfResolver
 from models.dnsresponse import DnsResponse
+from zentralbibliothek.dbclient3 import DatabaseClient
+from zentralbibliothek.dnsrecords import RECORD_TYPES
+from zentralbibliothek.domainmatcher import DomainMatcher
 
 rizz = DusseldorfResolver()
 resp = DnsResponse(type="A", data={"ip": "1.2.3.4"}, name="test.net", ttl=420)
@@ -26,3 +30,59 @@ def test_dnsresolver_values():
     assert rr.rname == "test.net"
     assert rr.rtype == dnslib.QTYPE.A
     assert rr.rclass == 1
+
+
+def test_dnsresolver_new_types():
+    records = [
+        ("SRV", {"priority": 10, "weight": 5, "port": 443, "target": "srv.test.net"}),
+        ("PTR", {"ptr": "host.test.net"}),
+        ("HTTPS", {"priority": 1, "target": ".", "params": "alpn=h2 port=443"}),
+    ]
+    for rtype, data in records:
+        rr = rizz.make_resource_record(DnsResponse(type=rtype, data=data, name="x"))
+        assert rr.rtype == getattr(dnslib.QTYPE, rtype)
+        # and survives the wire
+        reply = dnslib.DNSRecord(rr=[rr])
+        assert dnslib.DNSRecord.parse(reply.pack()).rr[0].rdata == rr.rdata
+
+
+def test_dnsresolver_encoders():
+    # the API accepts exactly the types we can answer with
+    assert sorted(ENCODERS) == sorted(RECORD_TYPES)
+
+
+def test_dnsresolver_bad_data():
+    for rtype, data in [
+        ("A", {"ip": "not-an-ip"}),
+        ("A", {"ip": "::1"}),
+        ("AAAA", {"ip": "1.2.3.4"}),
+        ("NXDOMAIN", {}),
+        ("MX", {}),
+    ]:
+        rr = rizz.make_resource_record(DnsResponse(type=rtype, data=data, name="x"))
+        assert rr.rtype == dnslib.QTYPE.TXT
+
+
+def test_dnsresolver_negative_soa(monkeypatch):
+    db = DatabaseClient.__new__(DatabaseClient)
+    monkeypatch.setattr(DatabaseClient, "_instance", db)
+    monkeypatch.setattr(db, "get_domain_matcher", lambda: DomainMatcher(["test.net"]))
+    soa = {"mname": "ns1.test.net", "rname": "info.test.net", "times": (1, 2, 3, 4, 3600)}
+    monkeypatch.setattr(DnsResponse, "default_soa_obj", classmethod(lambda cls: soa))
+    monkeypatch.setattr(DnsResponse, "negative_ttl", classmethod(lambda cls, domain: 120))
+
+    resolver = DusseldorfResolver()
+    reply = dnslib.DNSRecord.question("nope.test.net").reply()
+    resolver.add_negative_soa(reply)
+    assert reply.auth[0].rtype == dnslib.QTYPE.SOA
+    assert reply.auth[0].rname == "test.net"
+    assert reply.auth[0].ttl == 120
+    assert reply.auth[0].rdata.times[-1] == 120
+
+    # outside our domains there's no SOA to give
+    reply = dnslib.DNSRecord.question("nope.example.com").reply()
+    resolver.add_negative_soa(reply)
+    assert not reply.auth
+
+    resolver.add_negative_soa(dnslib.DNSRecord.question("nope.test.net").reply())
+    assert (resolver.negative_count, resolver.negative_repeats) == (2, 1)
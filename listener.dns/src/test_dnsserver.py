@@ -0,0 +1,97 @@
+import asyncio
+
+import dnslib
+from dnslib.server import BaseResolver
+from dnsserver import AsyncDnsServer
+from zentralbibliothek.dbclient3 import DatabaseClient
+
+
+class FixedResolver(BaseResolver):
+    def resolve(self, request, handler):
+        reply = request.reply()
+        reply.add_answer(
+            dnslib.RR(
+                request.q.qname,
+                dnslib.QTYPE.A,
+                rdata=dnslib.A("1.2.3.4"),
+                ttl=60,
+            )
+        )
+        return reply
+
+
+class FailingResolver(BaseResolver):
+    def resolve(self, request, handler):
+        raise RuntimeError("boom")
+
+
+async def query(resolver, tcp, server=None):
+    server = server or AsyncDnsServer(
+        resolver=resolver, address="127.0.0.1", port=0, inline_when_cached=False
+    )
+    await server.start()
+    try:
+        question = dnslib.DNSRecord.question("foo.test.net", "A")
+        loop = asyncio.get_running_loop()
+        rdata = await loop.run_in_executor(
+            None, lambda: question.send("127.0.0.1", server.port, tcp=tcp, timeout=5)
+        )
+        return dnslib.DNSRecord.parse(rdata)
+    finally:
+        server.close()
+
+
+def test_dnsserver_udp():
+    reply = asyncio.run(query(FixedResolver(), tcp=False))
+    assert str(reply.a.rdata) == "1.2.3.4"
+    assert reply.a.rname == "foo.test.net"
+
+
+def test_dnsserver_tcp():
+    reply = asyncio.run(query(FixedResolver(), tcp=True))
+    assert str(reply.a.rdata) == "1.2.3.4"
+
+
+def test_dnsserver_servfail():
+    reply = asyncio.run(query(FailingResolver(), tcp=False))
+    assert reply.header.rcode == dnslib.RCODE.SERVFAIL
+
+
+def test_dnsserver_sheds_over_max_in_flight():
+    server = AsyncDnsServer(
+        resolver=FixedResolver(),
+        address="127.0.0.1",
+        port=0,
+        inline_when_cached=False,
+        max_in_flight=0,
+    )
+    # no slot for the executor: SERVFAIL over TCP, a UDP packet is just dropped
+    reply = asyncio.run(query(None, tcp=True, server=server))
+    assert reply.header.rcode == dnslib.RCODE.SERVFAIL
+    assert not server.acquire_slot()
+    assert server.shed == 2
+
+    server.max_in_flight = 1
+    assert server.acquire_slot()
+    assert not server.acquire_slot()
+    assert server.shed == 3
+
+
+class FakeDatabase:
+    def __init__(self, cache, saves_without_blocking):
+        self.cache = cache
+        self.saves_without_blocking = saves_without_blocking
+
+
+def test_dnsserver_resolve_inline(monkeypatch):
+    server = AsyncDnsServer(resolver=FixedResolver(), address="127.0.0.1", port=0)
+    for cache, nonblocking, inline in [
+        (object(), True, True),
+        # a writer that may block (or no writer) keeps saves off the loop
+        (object(), False, False),
+        (None, True, False),
+    ]:
+        db = FakeDatabase(cache, nonblocking)
+        monkeypatch.setattr(DatabaseClient, "get_instance", staticmethod(lambda: db))
+        assert server.resolve_inline() is inline
+    server.close()
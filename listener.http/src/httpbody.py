@@ -0,0 +1,227 @@
+import hashlib
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger("listener.http")
+
+CHUNK: int = 64 * 1024
+"""bytes read from a client (or a spill file) at a time"""
+
+KEEP: int = int(os.getenv("LSTNER_HTTP_BODY_PREFIX", 64 * 1024))
+"""bytes of a body kept in memory (and stored with the interaction)"""
+
+SPILL_DIR: str = os.getenv("LSTNER_HTTP_BODY_DIR") or None
+"""where bodies larger than KEEP are kept, by SHA-256; unset: in temp files, not kept"""
+
+
+class BodyCapture:
+    """
+    A request body, captured as it streams in.
+
+    The first `keep` bytes stay in memory, a larger body is spilled (as a whole) to a
+    file. With a `spill_dir` the file is kept there when the body is complete, named
+    after its SHA-256 (so repeated uploads are stored once), and `ref` points to it.
+    Without one, it's an anonymous temp file that is gone after `close()`.
+
+    The size and SHA-256 are computed on the way in, `contains()` scans the body without
+    loading it, only `read()` does.
+    """
+
+    def __init__(self, keep: int = KEEP, spill_dir: str = SPILL_DIR):
+        self.keep = keep
+        self.spill_dir = spill_dir
+        self.prefix: bytes = b""
+        self.size: int = 0
+        self.sha256: str = None
+        self.ref: str = None
+        self._hash = hashlib.sha256()
+        self._file = None
+        self._path: str = None
+
+    @property
+    def spilled(self) -> bool:
+        """Whether the body is larger than the prefix."""
+        return self._file is not None
+
+    def stays_in_memory(self, size: int) -> bool:
+        """Whether `size` more bytes still fit in the prefix, so writing won't block."""
+        return self._file is None and len(self.prefix) + size <= self.keep
+
+    def write(self, chunk: bytes):
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        if self._file is None:
+            room = self.keep - len(self.prefix)
+            if len(chunk) <= room:
+                self.prefix += chunk
+                return
+            self._open()
+            self._file.write(self.prefix)
+            self.prefix += chunk[:room]
+        self._file.write(chunk)
+
+    def _open(self):
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            fd, self._path = tempfile.mkstemp(dir=self.spill_dir, suffix=".part")
+            self._file = os.fdopen(fd, "w+b")
+        else:
+            self._file = tempfile.TemporaryFile()
+
+    def finish(self):
+        """
+        The body is complete: sets `sha256`, and keeps the spill file (see `ref`).
+        """
+        self.sha256 = self._hash.hexdigest()
+        if self._file is None:
+            return self
+        self._file.flush()
+        if self._path is not None:
+            ref = os.path.join(self.spill_dir, self.sha256)
+            try:
+                if os.path.exists(ref):
+                    os.unlink(self._path)  # stored before
+                else:
+                    os.replace(self._path, ref)
+                self.ref = ref
+            except OSError as ex:
+                logger.warning(f"Could not keep the body {self.sha256}: {ex}")
+            self._path = None
+        return self
+
+    def chunks(self, size: int = CHUNK):
+        """
+        The whole body, in chunks.
+        """
+        if self._file is None:
+            yield self.prefix
+            return
+        self._file.seek(0)
+        while chunk := self._file.read(size):
+            yield chunk
+
+    def read(self) -> bytes:
+        """
+        The whole body, in memory.
+        """
+        return b"".join(self.chunks())
+
+    def contains(self, needle: bytes) -> bool:
+        """
+        Whether `needle` is in the body, scanned chunk by chunk.
+        """
+        if not needle:
+            return True
+        overlap = len(needle) - 1
+        tail = b""
+        for chunk in self.chunks():
+            window = tail + chunk
+            if needle in window:
+                return True
+            tail = window[-overlap:] if overlap else b""
+        return False
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._path is not None:
+            # never finished, e.g. the client went away
+            try:
+                os.unlink(self._path)
+            except OSError:
+                pass
+            self._path = None
+
+
+MAX_LINE: int = 4096
+"""longest chunk size or trailer line we accept"""
+
+MAX_TRAILERS: int = 64
+
+_HEXDIGITS: bytes = b"0123456789abcdefABCDEF"
+
+
+class BodyError(ValueError):
+    """
+    A request body that can't be read, and the status code to answer it with.
+    """
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class ChunkedDecoder:
+    """
+    Decodes a body sent with "Transfer-Encoding: chunked" (RFC 9112, 7.1) as it comes
+    in, without reading past its end, so a pipelined request after it stays put.
+
+    The server drives it with what its transport can do: while not `done`, it either
+    reads up to `want()` bytes of chunk data and passes them to `data()` (which returns
+    them decoded), or, when `want()` is 0, reads one line and passes it to `line()`.
+    Chunk extensions are ignored, trailer fields end up in `trailers`. Raises BodyError
+    for a malformed body (400) or one larger than `max_size` (413).
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size: int = 0
+        self.trailers: dict = {}
+        self.done: bool = False
+        self._remaining: int = 0
+        self._state: str = "size"
+
+    def want(self) -> int:
+        """
+        How many bytes of chunk data to read next, 0 when a line is expected.
+        """
+        return self._remaining if self._state == "data" else 0
+
+    def data(self, data: bytes) -> bytes:
+        if len(data) > self._remaining:
+            raise BodyError("chunk data past the chunk size")
+        self._remaining -= len(data)
+        if self._remaining == 0:
+            self._state = "data_end"
+        return data
+
+    def line(self, line: bytes):
+        if not line.endswith(b"\n"):
+            raise BodyError("chunked body cut short")
+        if len(line) > MAX_LINE:
+            raise BodyError("chunk line too long")
+        line = line.rstrip(b"\r\n")
+
+        if self._state == "size":
+            size = line.split(b";", 1)[0].strip()
+            # hex digits only, int() would take signs and underscores as well
+            if not size or len(size) > 16 or size.strip(_HEXDIGITS):
+                raise BodyError(f"invalid chunk size {size[:16]!r}")
+            size = int(size, 16)
+            if size == 0:
+                self._state = "trailer"
+                return
+            self.size += size
+            if self.size > self.max_size:
+                raise BodyError("chunked body too large", 413)
+            self._remaining = size
+            self._state = "data"
+
+        elif self._state == "data_end":
+            if line:
+                raise BodyError("chunk data past the chunk size")
+            self._state = "size"
+
+        elif self._state == "trailer":
+            if not line:
+                self.done = True
+                return
+            name, sep, value = line.decode("latin-1").partition(":")
+            if not sep or not name.strip() or len(self.trailers) >= MAX_TRAILERS:
+                raise BodyError("invalid trailer field")
+            self.trailers[name.strip()] = value.strip()
+
+        else:
+            raise BodyError("chunked body already complete")
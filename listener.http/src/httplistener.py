@@ -1,19 +1,26 @@
 import base64
 import http.server
 import logging
+import os
 import re
 import ssl
 import sys
 import time
+import uuid
 
-from cachetools.func import ttl_cache
+from httpbody import CHUNK, MAX_LINE, BodyCapture, BodyError, ChunkedDecoder
+from httpmetrics import metrics
 from httprules import get_response
 from models.httprequest import HttpRequest
 from models.httpresponse import HttpResponse
 from zentralbibliothek.dbclient3 import DatabaseClient
-from zentralbibliothek.utils import Utils
 
-_timeout = 5
+IDLE_TIMEOUT: float = float(os.getenv("LSTNER_HTTP_IDLE_TIMEOUT", 5))
+"""seconds a connection may sit idle (or a client take to send a request)"""
+
+MAX_REQUESTS: int = int(os.getenv("LSTNER_HTTP_MAX_REQUESTS", 100))
+"""requests served on one keep-alive connection before it's closed"""
+
 sessionsCache = []
 
 logger = logging.getLogger("listener.http")
@@ -22,44 +29,18 @@ logger = logging.getLogger("listener.http")
 class HttpRequestHandler(http.server.SimpleHTTPRequestHandler):
     """
     This object handles a given Http request and defines the response.
+    Connections are kept alive (HTTP/1.1) for up to MAX_REQUESTS requests.
     """
 
-    MAX_CONTENT_LENGTH = 1024 * 1024 * 10  # 10MB
-    ALLOWED_METHODS = ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "HEAD"]
-    PATH_PATTERN = re.compile(
-        r"^/"
-    )  # re.compile(r"^/([a-zA-Z0-9-_]+)(/([a-zA-Z0-9-_]+))?(/([a-zA-Z0-9-_]+))?/?$")
-
-    def validate_request(self):
-        """
-        Validates the request, returns True if valid, False if not.
-        """
-        if self.command not in self.ALLOWED_METHODS:
-            logger.warning("Invalid method %s", self.command)
-            return False, 405
-
-        # Validate path
-        if not self.PATH_PATTERN.match(self.path):
-            logger.warning("Invalid path %s", self.path)
-            return False, 400
-
-        # Validate content length
-        content_length = int(self.headers.get("content-length", 0))
-        if content_length > self.MAX_CONTENT_LENGTH:
-            logger.warning(
-                "Content length %d exceeds maximum %d",
-                content_length,
-                self.MAX_CONTENT_LENGTH,
-            )
-            return False, 413
-
-        return True, None
+    protocol_version = "HTTP/1.1"
 
     def setup(self):
         http.server.SimpleHTTPRequestHandler.setup(self)
         self.server_version = "dusseldorf"
         self.sys_version = "v1"
-        self.request.settimeout(_timeout)
+        self.request.settimeout(IDLE_TIMEOUT)
+        self.connection_id: str = new_connection_id()
+        self.requests_handled: int = 0
 
     # region HTTP Methods
     def do_HEAD(self):
@@ -96,164 +77,380 @@ class HttpRequestHandler(http.server.SimpleHTTPRequestHandler):
         """intercept built in logger and suppress it, it's quite noisy."""
         return
 
-    @ttl_cache(maxsize=1024, ttl=300)
-    def is_valid_domain(self, domains: str, fqdn: str) -> bool:
-        for domain in domains.split(","):
-            if Utils.fqdn_is_valid(fqdn=fqdn, domain=domain):
-                return True
-        return False
-
     def handle_request(self):
         """
         This looks up if we have a matching rule for the current
         request. And if we do, then let's see what to send back.
         """
-        is_valid, status_code = self.validate_request()
-        if not is_valid:
+        self.requests_handled += 1
+        if self.requests_handled >= MAX_REQUESTS:
+            self.close_connection = True
+
+        exchange = HttpExchange(
+            method=self.command,
+            path=self.path,
+            version=self.request_version,
+            headers=self.headers,
+            client_address=self.client_address,
+            tls=isinstance(self.connection, ssl.SSLSocket),
+            connection_id=self.connection_id,
+            connection_seq=self.requests_handled - 1,
+        )
+
+        if status_code := exchange.validate():
             self.send_error(status_code)
+            exchange.finish()
             return
 
-        start_of_req = time.perf_counter()
         logger.debug("handling_request(%s %s)", self.command, self.path)
 
-        req_fqdn = self.headers.get("host", "")
+        if not exchange.route():
+            # the body is left unread, so the next request can't be found
+            if exchange.has_body:
+                self.close_connection = True
+            self.sendHttpResponse(HttpResponse.Empty())
+            exchange.finish()
+            return
 
-        db_client = DatabaseClient.get_instance()
+        try:
+            capture = exchange.read_body(self.rfile.read, self.rfile.readline)
+        except BodyError as e:
+            logger.warning("Invalid body: %s", e)
+            self.send_error(e.status_code)
+            exchange.finish()
+            return
+        except Exception as e:
+            logger.error("Error reading body content")
+            logger.exception(e)
+            exchange.capture.close()
+            capture = None
+            self.close_connection = True
+        exchange.mark("body")
 
-        done_get_db = time.perf_counter()
+        self.sendHttpResponse(exchange.respond(capture))
+        exchange.mark("send")
 
-        domains = ",".join(db_client.get_domains())
-        if not self.is_valid_domain(fqdn=req_fqdn, domains=domains):
-            self.sendHttpResponse(HttpResponse.Empty())
-            return
+        exchange.save()
+        exchange.finish()
+        return
 
-        done_dom_check = time.perf_counter()
+    def sendHttpResponse(self, http_response: HttpResponse = None):
+        """
+        Sends an HTTPResponse onto "the wire"
+        """
+        status_code, headers, body, close = response_parts(http_response)
+        self.send_response(status_code)
+        for hdr, value in headers:
+            self.send_header(hdr, value)
+        # send_header() notices a rule's "connection: close" itself
+        if close or self.close_connection:
+            self.send_header("Connection", "close")
+        elif self.request_version == "HTTP/1.0":
+            self.send_header("Connection", "keep-alive")
+        self.end_headers()
 
-        # Check if the zone exists
-        zone_fqdn = db_client.find_zone_for_request(req_fqdn)
-        if not zone_fqdn:
-            logger.info("zone not found for request %s", req_fqdn)
-            self.sendHttpResponse(HttpResponse.Empty())
-            return
+        if len(body) > 0 and self.command != "HEAD":
+            self.wfile.write(body)
 
-        done_zone_check = time.perf_counter()
+        return
 
-        req_body_bytes: bytes = b""
-        req_body: str = None
-        req_body_b64: str = None
 
-        try:
-            content_len: int = int(self.headers.get("content-length", 0))
-            if content_len > 0:
-                req_body_bytes = self.rfile.read(content_len)
-        except Exception as e:
-            logger.error("Error reading body content")
-            logger.exception(e)
-            content_len = 0
-            req_body_bytes = None
+def response_parts(http_response: HttpResponse = None) -> tuple:
+    """
+    What to put on the wire for an HttpResponse: (status code, [(header, value)], body,
+    close). The status code is kept within 100-599, and content-length is always sent.
+    `close` is set when the connection can't be reused after this response, because
+    a rule set "connection: close" or a content-length that doesn't match the body.
+    """
+    if http_response is None:
+        logger.warning("sendHttpResponse() used with None, setting default reply")
+        http_response = HttpResponse.Empty()
+
+    # ensure the status code is valid,
+    # may change that for future HTTP fuzzing, but let's stick to 100-600 for now.
+    status_code = http_response.status_code
+    if not (status_code > 99 and status_code < 600):
+        logger.warning("Invalid status code %d, setting to default", status_code)
+        status_code = HttpResponse.Empty().status_code
+
+    body: bytes = http_response.body.encode("utf-8", "ignore")
+
+    # skip sending this header, we always send our own
+    headers = [
+        (hdr, value)
+        for hdr, value in http_response.headers.items()
+        if hdr.lower() != "content-length"
+    ]
+    content_len = int(http_response.headers.get("content-length", len(body)))
+    headers.append(("content-length", content_len))
+
+    close = content_len != len(body) or any(
+        hdr.lower() == "connection" and str(value).lower() == "close"
+        for hdr, value in headers
+    )
+    return status_code, headers, body, close
+
+
+def decode_body(data: bytes, partial: bool = False) -> tuple:
+    """
+    (body, body_b64): `data` as text, or base64 encoded if it isn't UTF-8. When `data`
+    is the prefix of a longer body (`partial`), a character cut in half is dropped.
+    """
+    try:
+        return data.decode("utf-8"), None
+    except UnicodeDecodeError as ex:
+        if partial and ex.start >= len(data) - 3:
+            return decode_body(data[: ex.start])
+        # if we can't decode it, let's base64 encode it
+        return None, base64.b64encode(data).decode("utf-8")
+
+
+def new_connection_id() -> str:
+    """
+    An id for a client connection, stored with every interaction that came in on it.
+    """
+    return uuid.uuid4().hex
 
-        if req_body_bytes is not None:
-            # if we have a body, let's decode it.
-            try:
-                req_body = req_body_bytes.decode("utf-8")
-            except UnicodeDecodeError:
-                # if we can't decode it, let's base64 encode it
-                req_body_b64 = base64.b64encode(req_body_bytes).decode("utf-8")
 
-        done_body_read = time.perf_counter()
+class HttpExchange:
+    """
+    One HTTP request and the response to it, independent of the server (threaded or
+    asyncio) that it came in on.
+
+    Servers call `validate()`, `route()`, read the body, `respond()`, send the response,
+    `save()` and `finish()`, in that order. Time spent is recorded per stage (see
+    httpmetrics.STAGES), `mark(stage)` ends a stage.
+    """
+
+    MAX_CONTENT_LENGTH = 1024 * 1024 * 10  # 10MB
+    ALLOWED_METHODS = ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "HEAD"]
+    PATH_PATTERN = re.compile(
+        r"^/"
+    )  # re.compile(r"^/([a-zA-Z0-9-_]+)(/([a-zA-Z0-9-_]+))?(/([a-zA-Z0-9-_]+))?/?$")
+
+    def __init__(
+        self,
+        method: str,
+        path: str,
+        version: str,
+        headers,
+        client_address: tuple,
+        tls: bool,
+        started: float = None,
+        connection_id: str = None,
+        connection_seq: int = 0,
+    ):
+        """
+        headers is an http.client.HTTPMessage (case insensitive), started the
+        time.perf_counter() at which reading the request began. connection_id is the
+        connection it came in on, connection_seq its place there (0 for the first).
+        """
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.client_address = client_address
+        self.tls = tls
+        self.connection_id = connection_id
+        self.connection_seq = connection_seq
+        self.req_fqdn: str = headers.get("host", "")
+        self.zone_fqdn: str = None
+        self.request: HttpRequest = None
+        self.response: HttpResponse = None
+        self.capture: BodyCapture = None
+        self.chunked: bool = False
+        self.content_length: int = 0
+        self.trailers: dict = None
+        self.started = started or time.perf_counter()
+        self.timings: dict = {}
+        self._mark = self.started
+        if started is not None:
+            self.mark("read")
+
+    def mark(self, stage: str):
+        """The `stage` ends now."""
+        now = time.perf_counter()
+        self.timings[stage] = now - self._mark
+        self._mark = now
+
+    def validate(self) -> int:
+        """
+        Validates the request, returns None if valid, else the status code to send.
+        """
+        if self.method not in self.ALLOWED_METHODS:
+            logger.warning("Invalid method %s", self.method)
+            return 405
+
+        # Validate path
+        if not self.PATH_PATTERN.match(self.path):
+            logger.warning("Invalid path %s", self.path)
+            return 400
+
+        # the framing headers must be unambiguous, or a front proxy and we could disagree
+        # on where the body ends (request smuggling)
+        for name in ("transfer-encoding", "content-length"):
+            values = {v.strip().lower() for v in self.headers.get_all(name, [])}
+            if len(values) > 1:
+                logger.warning("Conflicting %s headers %s", name, values)
+                return 400
+
+        # Validate transfer encoding, chunked bodies are checked as they come in
+        if transfer_encoding := self.headers.get("transfer-encoding"):
+            if transfer_encoding.strip().lower() != "chunked":
+                logger.warning("Unsupported transfer encoding %s", transfer_encoding)
+                return 501
+            if "content-length" in self.headers:
+                # which one frames the body? don't guess (request smuggling)
+                logger.warning("Both transfer-encoding and content-length sent")
+                return 400
+            self.chunked = True
+            return None
+
+        # Validate content length: digits only, int() would take signs, underscores and
+        # whitespace as well
+        content_length = self.headers.get("content-length", "0").strip()
+        valid = content_length.isascii() and content_length.isdigit()
+        if not valid or len(content_length) > 18:
+            logger.warning("Invalid content length %s", content_length[:32])
+            return 400
+        self.content_length = int(content_length)
+        if self.content_length > self.MAX_CONTENT_LENGTH:
+            logger.warning(
+                "Content length %d exceeds maximum %d",
+                self.content_length,
+                self.MAX_CONTENT_LENGTH,
+            )
+            return 413
+
+        return None
+
+    @property
+    def has_body(self) -> bool:
+        return self.chunked or self.content_length > 0
+
+    def read_body(self, read, readline) -> BodyCapture:
+        """
+        Reads the body with the blocking `read(n)` and `readline(limit)` of a transport,
+        chunked or of content-length, see `capture_body()`. Raises BodyError when the
+        body is malformed or too large, EOFError when the client went away.
+        """
+        capture = self.capture_body()
+        if self.chunked:
+            decoder = ChunkedDecoder(max_size=self.MAX_CONTENT_LENGTH)
+            while not decoder.done:
+                if wanted := decoder.want():
+                    chunk = read(min(CHUNK, wanted))
+                    if not chunk:
+                        raise EOFError("chunked body cut short")
+                    capture.write(decoder.data(chunk))
+                else:
+                    decoder.line(readline(MAX_LINE + 1))
+            self.trailers = decoder.trailers
+        else:
+            remaining = self.content_length
+            while remaining > 0:
+                chunk = read(min(CHUNK, remaining))
+                if not chunk:
+                    raise EOFError("body cut short")
+                capture.write(chunk)
+                remaining -= len(chunk)
+        return capture.finish()
+
+    def route(self) -> bool:
+        """
+        Whether the request is for one of our zones, sets zone_fqdn if it is.
+        """
+        db_client = DatabaseClient.get_instance()
+        try:
+            if not db_client.get_domain_matcher().is_valid(self.req_fqdn):
+                return False
+
+            # Check if the zone exists
+            self.zone_fqdn = db_client.find_zone_for_request(self.req_fqdn)
+            if not self.zone_fqdn:
+                logger.info("zone not found for request %s", self.req_fqdn)
+                return False
+            return True
+        finally:
+            self.mark("route")
+
+    def capture_body(self) -> BodyCapture:
+        """
+        Where the server streams the request's body to, closed by `finish()`.
+        """
+        self.capture = BodyCapture()
+        return self.capture
+
+    def respond(self, capture: BodyCapture) -> HttpResponse:
+        """
+        Runs the rule engine over the request with the body in `capture` (None if it
+        couldn't be read), returns the response to send.
+        """
+        req_body: str = None
+        req_body_b64: str = None
+        body_info: dict = {}
+        if capture is not None:
+            # if we have a body, let's decode (the prefix of) it.
+            req_body, req_body_b64 = decode_body(capture.prefix, capture.spilled)
+            if capture.size:
+                body_info = dict(
+                    body_size=capture.size,
+                    body_sha256=capture.sha256,
+                    body_ref=capture.ref,
+                    capture=capture,
+                )
 
         # we're good now, handle the http request, make a response
-        req = HttpRequest(
-            req_fqdn=req_fqdn,
-            zone_fqdn=zone_fqdn,
+        self.request = HttpRequest(
+            req_fqdn=self.req_fqdn,
+            zone_fqdn=self.zone_fqdn,
             remote_addr=self.client_address[0],
-            method=self.command,
+            method=self.method,
             path=self.path,
             headers={
                 h: v for h, v in self.headers.items()
             },  # self.headers is not a dict so we need to make it one.
-            version=self.request_version,
+            version=self.version,
             body=req_body,
             body_b64=req_body_b64,
-            tls=isinstance(self.connection, ssl.SSLSocket),
+            tls=self.tls,
+            trailers=self.trailers or None,
+            **body_info,
         )
 
         # gets the response from the rule engine, and check if empty.
-        if response := get_response(req):
-            self.sendHttpResponse(response)
-        else:
+        self.response = get_response(self.request)
+        if self.response is None:
             logger.warning(
                 "get_response() returned None, it's supposed to return a default response"
             )
-            self.sendHttpResponse(HttpResponse.Empty())
-
-        done_send_resp = time.perf_counter()
-
-        db_client.save_interaction(req, response)
+            self.response = HttpResponse.Empty()
 
-        done_db_write = time.perf_counter()
+        self.mark("rules")
+        return self.response
 
-        stop_total_req = time.perf_counter()
-
-        get_db: float = round(done_get_db - start_of_req, 6)
-        dom_check: float = round(done_dom_check - done_get_db, 6)
-        zone_check: float = round(done_zone_check - done_dom_check, 6)
-        body_read: float = round(done_body_read - done_zone_check, 6)
-        send_resp: float = round(done_send_resp - done_body_read, 6)
-        db_write_time: float = round(done_db_write - done_send_resp, 6)
-        request_time: float = round(stop_total_req - start_of_req, 6)
-
-        logger.debug(
-            "request %.3fs, get_db: %.3fs, dom_check: %.3fs, zone_check: %.3fs, body_read: %.3fs, send_resp: %.3fs, db_write: %.3fs",
-            request_time,
-            get_db,
-            dom_check,
-            zone_check,
-            body_read,
-            send_resp,
-            db_write_time,
+    def save(self):
+        extra: dict = None
+        if self.connection_id is not None:
+            extra = {"connection": self.connection_id, "connseq": self.connection_seq}
+        DatabaseClient.get_instance().save_interaction(
+            self.request, self.response, extra
         )
+        self.mark("save")
 
-        # logger.debug("response %.3fs, db %.3fs, total: %.3fs, needle: %.3f", request_time, db_write_time, total_req, total_req2)
-        return
-
-    def sendHttpResponse(self, http_response: HttpResponse = None):
+    def finish(self):
         """
-        Sends an HTTPResponse onto "the wire"
+        Records how long the request took, per stage, and lets go of its body.
         """
-        if http_response is None:
-            logger.warning("sendHttpResponse() used with None, setting default reply")
-            http_response = HttpResponse.Empty()
-
-        # ensure the status code is valid,
-        # may change that for future HTTP fuzzing, but let's stick to 100-600 for now.
-        if http_response.status_code > 99 and http_response.status_code < 600:
-            self.send_response(http_response.status_code)
-        else:
-            logger.warning(
-                "Invalid status code %d, setting to default", http_response.status_code
-            )
-            self.send_response(HttpResponse.Empty().status_code)
-
-        # skip sending this header
-        skip = ["content-length"]
-        for hdr in http_response.headers.keys():
-            if (
-                hdr.lower() not in skip
-            ):  # Convert current header to lowercase for comparison
-                self.send_header(hdr, http_response.headers.get(hdr))
-
-        # always send content-length
-        content_len = int(
-            http_response.headers.get("content-length", len(http_response.body))
+        if self.capture is not None:
+            self.capture.close()
+        self.timings["total"] = time.perf_counter() - self.started
+        metrics.record(self.timings)
+        logger.debug(
+            "request %.3fs, %s",
+            self.timings["total"],
+            ", ".join(f"{stage}: {t:.3f}s" for stage, t in self.timings.items()),
         )
-        self.send_header("content-length", content_len)
-        self.end_headers()
-
-        if len(http_response.body) > 0:
-            self.wfile.write(http_response.body.encode("utf-8", "ignore"))
-
-        return
 
 
 # if called directly, fail.
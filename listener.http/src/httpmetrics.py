@@ -0,0 +1,122 @@
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+
+logger = logging.getLogger("listener.http")
+
+STAGES: tuple = ("read", "route", "body", "rules", "send", "save", "total")
+"""what a request's time is spent on, in order ("total" is all of them)"""
+
+
+class LatencyMetrics:
+    """
+    Per-stage request latencies and per-connection counters of the HTTP listener.
+
+    For every stage we keep a count, the sum and the maximum, and the last `samples`
+    timings to take percentiles from. Connections are counted when they open and close,
+    with how long they lived and how many requests they carried. All of it is logged as
+    one summary record every `report_interval` seconds, see `stats()`.
+    """
+
+    def __init__(self, report_interval: float = 60, samples: int = 1024):
+        self.report_interval = report_interval
+        self.samples = samples
+        self._lock = threading.Lock()
+        self._reported = time.monotonic()
+        self._reset()
+        self.open_connections: int = 0
+
+    @classmethod
+    def from_env(cls):
+        """
+        Metrics reported every LSTNER_HTTP_METRICS_S seconds (default 60).
+        """
+        return cls(report_interval=float(os.getenv("LSTNER_HTTP_METRICS_S", 60)))
+
+    def _reset(self):
+        # stage -> [count, sum, max, recent timings]
+        self._stages: dict = defaultdict(
+            lambda: [0, 0.0, 0.0, deque(maxlen=self.samples)]
+        )
+        self._connections: int = 0
+        self._connection_time: float = 0.0
+        self._connection_requests: int = 0
+        self._peak_connections: int = 0
+
+    def record(self, timings: dict):
+        """
+        Record one request's {stage: seconds}.
+        """
+        with self._lock:
+            for stage, seconds in timings.items():
+                entry = self._stages[stage]
+                entry[0] += 1
+                entry[1] += seconds
+                entry[2] = max(entry[2], seconds)
+                entry[3].append(seconds)
+        self._maybe_report()
+
+    def connection_opened(self):
+        with self._lock:
+            self.open_connections += 1
+            self._peak_connections = max(self._peak_connections, self.open_connections)
+
+    def connection_closed(self, duration: float, requests: int):
+        with self._lock:
+            self.open_connections -= 1
+            self._connections += 1
+            self._connection_time += duration
+            self._connection_requests += requests
+        self._maybe_report()
+
+    def stats(self, reset: bool = False) -> dict:
+        """
+        Latencies in milliseconds per stage (count, mean, p50, p99, max) and the
+        connections closed, open and at most open since the last report.
+        """
+        with self._lock:
+            stages = {}
+            for stage in sorted(self._stages, key=_stage_order):
+                count, total, worst, recent = self._stages[stage]
+                ordered = sorted(recent)
+                stages[stage] = {
+                    "count": count,
+                    "mean_ms": round(total / count * 1000, 3),
+                    "p50_ms": round(ordered[len(ordered) // 2] * 1000, 3),
+                    "p99_ms": round(ordered[int(len(ordered) * 0.99)] * 1000, 3),
+                    "max_ms": round(worst * 1000, 3),
+                }
+            closed = self._connections
+            stats = {
+                "stages": stages,
+                "connections": {
+                    "closed": closed,
+                    "open": self.open_connections,
+                    "peak": max(self._peak_connections, self.open_connections),
+                    "mean_s": round(self._connection_time / closed, 3) if closed else 0,
+                    "requests": self._connection_requests,
+                },
+            }
+            if reset:
+                self._reset()
+        return stats
+
+    def _maybe_report(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._reported < self.report_interval:
+                return
+            self._reported = now
+        stats = self.stats(reset=True)
+        if stats["stages"] or stats["connections"]["closed"]:
+            logger.info(f"http.latency: {stats}")
+
+
+def _stage_order(stage: str) -> int:
+    return STAGES.index(stage) if stage in STAGES else len(STAGES)
+
+
+metrics = LatencyMetrics.from_env()
+"""the listener's metrics, shared by its servers"""
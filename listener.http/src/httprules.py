@@ -8,15 +8,28 @@ import uuid
 from urllib.parse import ParseResult, urlparse
 
 import requests
+from httpupstream import CONNECT_MS, UpstreamError, upstream
 from models.httprequest import HttpRequest
 from models.httpresponse import HttpResponse
+from zentralbibliothek.models.matcher import (
+    ALWAYS,
+    COST_BODY,
+    COST_HEADERS,
+    COST_LOOKUP,
+    COST_REGEX,
+    Dispatch,
+    Matcher,
+    literal_prefix,
+    required_literal,
+)
 from zentralbibliothek.ruleengine import Predicate, Result, RuleEngine
+from zentralbibliothek.saferegex import SafeRegex
 from zentralbibliothek.utils import Utils
 
 logger = logging.getLogger("listener.http")
 
 
-def _is_dangerous_host(cls, url: str) -> bool:
+def _is_dangerous_host(url: str) -> bool:
     """
     Helper function that returns if a URL is dangerous.
     """
@@ -52,6 +65,25 @@ def _is_dangerous_host(cls, url: str) -> bool:
 
 # region predicates
 
+# values the rule engine indexes rules on, see `Dispatch`
+def _request_tls(request: HttpRequest) -> bool:
+    return bool(request.tls)
+
+
+def _request_method(request: HttpRequest) -> str:
+    return request.method.lower()
+
+
+def _request_path(request: HttpRequest) -> str:
+    return request.path
+
+
+def _request_body(request: HttpRequest) -> str:
+    if request.capture is not None and request.capture.spilled:
+        # don't load a large body just to narrow down rules, the predicates scan it
+        raise LookupError("body not in memory")
+    return request.body
+
 
 class HttpTlsPredicate(Predicate):
     """
@@ -59,11 +91,19 @@ class HttpTlsPredicate(Predicate):
     """
 
     @classmethod
-    def satisfied_by(cls, request: HttpRequest, parameter: str):
+    def compile(cls, parameter: str) -> Matcher:
         # If we're not requiring anything, then we should let all requests satisfy the predicate.
         if not parameter:
-            return True
-        return request.tls
+            return ALWAYS
+        return Matcher(
+            test=lambda request: request.tls,
+            dispatch=Dispatch(key="http.tls", value=_request_tls, accepts=frozenset((True,))),
+            cost=COST_LOOKUP,
+        )
+
+    @classmethod
+    def satisfied_by(cls, request: HttpRequest, parameter: str):
+        return cls.compile(parameter)(request)
 
 
 class HttpMethodPredicate(Predicate):
@@ -73,12 +113,20 @@ class HttpMethodPredicate(Predicate):
     """
 
     @classmethod
-    def satisfied_by(cls, request: HttpRequest, parameter: str):
+    def compile(cls, parameter: str) -> Matcher:
         # If we're not requiring anything, then we should let all requests satisfy the predicate.
         if not parameter:
-            return True
-        methods = parameter.split(",")
-        return request.method.lower() in [m.lower() for m in methods]
+            return ALWAYS
+        methods = frozenset(m.lower() for m in parameter.split(","))
+        return Matcher(
+            test=lambda request: request.method.lower() in methods,
+            dispatch=Dispatch(key="http.method", value=_request_method, accepts=methods),
+            cost=COST_LOOKUP,
+        )
+
+    @classmethod
+    def satisfied_by(cls, request: HttpRequest, parameter: str):
+        return cls.compile(parameter)(request)
 
 
 class HttpPathPredicate(Predicate):
@@ -87,13 +135,25 @@ class HttpPathPredicate(Predicate):
     """
 
     @classmethod
-    def satisfied_by(cls, request: HttpRequest, parameter: str):
+    def compile(cls, parameter: str) -> Matcher:
         if not parameter:  # If we're not requiring anything, then we should let all requests satisfy the predicate.
-            return True
+            return ALWAYS
+        regex = SafeRegex(parameter)
+        return Matcher(
+            test=lambda request: type(request) == HttpRequest
+            and regex.found(request.path),
+            dispatch=Dispatch(
+                key="http.path",
+                value=_request_path,
+                prefix=literal_prefix(parameter) or None,
+                contains=required_literal(parameter) or None,
+            ),
+            cost=COST_REGEX,
+        )
 
-        if type(request) != HttpRequest:
-            return False
-        return bool(re.search(parameter, request.path))
+    @classmethod
+    def satisfied_by(cls, request: HttpRequest, parameter: str):
+        return cls.compile(parameter)(request)
 
 
 class HttpBodyPredicate(Predicate):
@@ -102,16 +162,40 @@ class HttpBodyPredicate(Predicate):
     """
 
     @classmethod
-    def satisfied_by(cls, request: HttpRequest, parameter: str):
+    def compile(cls, parameter: str) -> Matcher:
         if not parameter:  # If we're not requiring anything, then we should let all requests satisfy the predicate.
-            return True
+            return ALWAYS
+        regex = SafeRegex(parameter)
+        literal = required_literal(parameter)
+        needle = literal.encode("utf-8") if literal else None
 
-        if type(request) != HttpRequest:
-            return False
+        def test(request: HttpRequest) -> bool:
+            if type(request) != HttpRequest:
+                return False
+            # a large body is only read into memory if it has what the regex needs
+            capture = request.capture
+            if needle and capture is not None and capture.spilled:
+                if not capture.contains(needle):
+                    return False
+            if request.body is None:
+                return False
+            return regex.found(request.body)
+
+        return Matcher(
+            test=test,
+            dispatch=Dispatch(
+                key="http.body",
+                value=_request_body,
+                contains=literal or None,
+            ),
+            cost=COST_BODY,
+        )
 
+    @classmethod
+    def satisfied_by(cls, request: HttpRequest, parameter: str):
         try:
-            return bool(re.search(parameter, request.body))
-        except Exception as ex:
+            return cls.compile(parameter)(request)
+        except ValueError as ex:
             # maybe a bad regex pattern?
             logger.warning(f"Error in http.body predicate: {ex}")
             return False
@@ -123,14 +207,22 @@ class HttpHeaderPredicate(Predicate):
     """
 
     @classmethod
-    def satisfied_by(cls, request: HttpRequest, parameter: str):
+    def compile(cls, parameter: str) -> Matcher:
         # If we're not requiring anything, then we should let all requests satisfy the predicate.
         if not parameter:
-            return True
+            return ALWAYS
 
         # We're going to do a case-insensitive comparison here,
         # so we'll just convert everything to lowercase.
-        return parameter.lower() in [k.lower() for k in request.headers.keys()]
+        header = parameter.lower()
+        return Matcher(
+            test=lambda request: any(k.lower() == header for k in request.headers.keys()),
+            cost=COST_HEADERS,
+        )
+
+    @classmethod
+    def satisfied_by(cls, request: HttpRequest, parameter: str):
+        return cls.compile(parameter)(request)
 
 
 class HttpHeaderKeysPredicate(Predicate):
@@ -140,17 +232,21 @@ class HttpHeaderKeysPredicate(Predicate):
     """
 
     @classmethod
-    def satisfied_by(cls, request: HttpRequest, parameter: str):
+    def compile(cls, parameter: str) -> Matcher:
         if not parameter:  # If we're not requiring anything, then we should let all requests satisfy the predicate.
-            return True
+            return ALWAYS
 
-        required_keys = [k.lower() for k in parameter.split(",") if k != ""]
-        actual_keys = [k.lower() for k in request.headers.keys() if k != ""]
+        required_keys = frozenset(k.lower() for k in parameter.split(",") if k != "")
 
-        if len(required_keys) > len(actual_keys):
-            return False
+        def test(request: HttpRequest) -> bool:
+            actual_keys = {k.lower() for k in request.headers.keys() if k != ""}
+            return required_keys <= actual_keys
+
+        return Matcher(test=test, cost=COST_HEADERS)
 
-        return all(rk in actual_keys for rk in required_keys)
+    @classmethod
+    def satisfied_by(cls, request: HttpRequest, parameter: str):
+        return cls.compile(parameter)(request)
 
 
 class HttpHeaderValuesPredicate(Predicate):
@@ -160,17 +256,28 @@ class HttpHeaderValuesPredicate(Predicate):
     """
 
     @classmethod
-    def satisfied_by(cls, request: HttpRequest, parameter: str):
+    def compile(cls, parameter: str) -> Matcher:
         if not parameter:  # If we're not requiring anything, then we should let all requests satisfy the predicate.
+            return ALWAYS
+
+        try:
+            required_hdrs = tuple(json.loads(parameter).items())
+        except (ValueError, AttributeError) as ex:
+            raise ValueError(f"Invalid http.headers.values parameter: {ex}") from ex
+
+        def test(request: HttpRequest) -> bool:
+            for rk, rv in required_hdrs:
+                if rk not in request.headers.keys():
+                    return False
+                if request.headers[rk] != rv:
+                    return False
             return True
 
-        required_hdrs = json.loads(parameter)
-        for rk, rv in required_hdrs.items():
-            if rk not in request.headers.keys():
-                return False
-            if request.headers[rk] != rv:
-                return False
-        return True
+        return Matcher(test=test, cost=COST_HEADERS)
+
+    @classmethod
+    def satisfied_by(cls, request: HttpRequest, parameter: str):
+        return cls.compile(parameter)(request)
 
 
 class HttpHeaderValueRegexesPredicate(Predicate):
@@ -180,16 +287,29 @@ class HttpHeaderValueRegexesPredicate(Predicate):
     """
 
     @classmethod
-    def satisfied_by(cls, request: HttpRequest, parameter: str):
+    def compile(cls, parameter: str) -> Matcher:
         if not parameter:  # If we're not requiring anything, then we should let all requests satisfy the predicate.
+            return ALWAYS
+
+        try:
+            required_hdrs = json.loads(parameter).items()
+        except (ValueError, AttributeError) as ex:
+            raise ValueError(f"Invalid http.headers.regexes parameter: {ex}") from ex
+        required_regexes = tuple((rk, SafeRegex(rv)) for rk, rv in required_hdrs)
+
+        def test(request: HttpRequest) -> bool:
+            for rk, rv_regex in required_regexes:
+                if rk not in request.headers.keys():
+                    return False
+                if not rv_regex.found(request.headers[rk]):
+                    return False
             return True
-        required_hdrs = json.loads(parameter)
-        for rk, rv_regex in required_hdrs.items():
-            if rk not in request.headers.keys():
-                return False
-            if not bool(re.search(rv_regex, request.headers[rk])):
-                return False
-        return True
+
+        return Matcher(test=test, cost=COST_REGEX)
+
+    @classmethod
+    def satisfied_by(cls, request: HttpRequest, parameter: str):
+        return cls.compile(parameter)(request)
 
 
 # endregion
@@ -202,9 +322,17 @@ class SetHttpResponseCodeResult(Result):
     """
 
     @classmethod
-    def execute(cls, result_data: dict, parameter: str):
+    def parse(cls, parameter: str):
+        return int(parameter)
+
+    @classmethod
+    def deterministic(cls, parameter) -> bool:
+        return True
+
+    @classmethod
+    def execute(cls, result_data: dict, parameter: int):
         response: HttpResponse = result_data["response"]
-        response.status_code = int(parameter)
+        response.status_code = parameter
         result_data["response"] = response
         return result_data
 
@@ -214,6 +342,10 @@ class SetHttpResponseBodyResult(Result):
     Sets the body of the HTTP response.
     """
 
+    @classmethod
+    def deterministic(cls, parameter) -> bool:
+        return True
+
     @classmethod
     def execute(cls, result_data: dict, parameter: str):
         response: HttpResponse = result_data["response"]
@@ -229,11 +361,19 @@ class SetHttpResponseSingleHeaderResult(Result):
     """
 
     @classmethod
-    def execute(cls, result_data: dict, parameter: str):
-        response: HttpResponse = result_data["response"]
+    def parse(cls, parameter: str):
         # split parameter first instance of ":", set that as header name, rest as value
         (header_name, header_value) = parameter.split(":", 1)
-        header_value = header_value.strip()
+        return (header_name, header_value.strip())
+
+    @classmethod
+    def deterministic(cls, parameter) -> bool:
+        return True
+
+    @classmethod
+    def execute(cls, result_data: dict, parameter: tuple):
+        response: HttpResponse = result_data["response"]
+        (header_name, header_value) = parameter
         # TODO replace variables in header value
         response.headers[header_name] = header_value
         result_data["response"] = response
@@ -247,9 +387,18 @@ class SetHttpResponseMultipleHeadersResult(Result):
     """
 
     @classmethod
-    def execute(cls, result_data: dict, parameter: str):
+    def parse(cls, parameter: str):
+        return json.loads(parameter)
+
+    @classmethod
+    def deterministic(cls, parameter) -> bool:
+        return True
+
+    @classmethod
+    def execute(cls, result_data: dict, parameter: dict):
         response: HttpResponse = result_data["response"]
-        response.headers = json.loads(parameter)
+        # copy, the parsed parameter is shared between requests
+        response.headers = dict(parameter)
         result_data["response"] = response
         return result_data
 
@@ -261,9 +410,19 @@ class SetVariableResult(Result):
     """
 
     @classmethod
-    def execute(cls, result_data: dict, parameter: str):
-        current_zone = result_data["zone"]
+    def parse(cls, parameter: str):
         (rename_from, replace_with) = parameter.split(":", 1)
+        return (rename_from, replace_with)
+
+    @classmethod
+    def deterministic(cls, parameter: tuple) -> bool:
+        # zone() is the same for all requests of a rule, uuid() and newzone() aren't
+        return parameter[1] not in ("uuid()", "newzone()")
+
+    @classmethod
+    def execute(cls, result_data: dict, parameter: tuple):
+        current_zone = result_data["zone"]
+        (rename_from, replace_with) = parameter
 
         if rename_from.strip() == "":  # fail quickly
             return result_data
@@ -318,12 +477,12 @@ class GetHTTPPassthruResult(Result):
         target: ParseResult = urlparse(parameter)
 
         # check for valid URL's
-        if _is_dangerous_host(target.netloc) == True:
+        if _is_dangerous_host(target.hostname) == True:
             logger.error(f"Dangerous URL for http.passthru: {parameter}")
             return result_data
 
         if target.scheme not in ["http", "https"]:
-            target.scheme = "http"
+            target = target._replace(scheme="http")
 
         current_zone = result_data["zone"]
 
@@ -352,14 +511,13 @@ class GetHTTPPassthruResult(Result):
 
         try:
             logger.info(f"http.passthru for {target.netloc}{orig_req.path}")
-            resp: requests.Response = requests.request(
+            resp: requests.Response = upstream.request(
                 method,
                 url,
                 headers=headers,
                 data=orig_req.body,
                 allow_redirects=False,
                 verify=True,  # configurable?
-                timeout=2000,  # configurable?
             )
 
             logger.info(
@@ -370,6 +528,8 @@ class GetHTTPPassthruResult(Result):
             result_data["response"].status_code = resp.status_code
             result_data["response"].headers = dict(resp.headers)
             result_data["response"].body = resp.text or None
+        except UpstreamError as ex:
+            logger.warning(f"http.passthru skipped: {ex}")
         except Exception as ex:
             logger.error(f"Invalid response from for http.passthru: {orig_req.method}")
             logger.exception(ex)
@@ -397,6 +557,10 @@ class GetHTTPPassthru2Result(Result):
         }
     """
 
+    @classmethod
+    def parse(cls, parameter):
+        return parameter if isinstance(parameter, dict) else json.loads(parameter)
+
     @classmethod
     def execute(cls, result_data: dict, parameter: dict):
         MAX_TIMEOUT: int = 10000
@@ -417,12 +581,12 @@ class GetHTTPPassthru2Result(Result):
         target: ParseResult = urlparse(url)
 
         # check for valid URL's
-        if _is_dangerous_host(target.netloc) == True:
+        if _is_dangerous_host(target.hostname) == True:
             logger.error(f"Dangerous URL for http.passthru2: {parameter}")
             return result_data
 
         if target.scheme not in ["http", "https"]:
-            target.scheme = "http"
+            target = target._replace(scheme="http")
 
         # request made out of original request
         orig_req: HttpRequest = result_data["request"]
@@ -463,14 +627,15 @@ class GetHTTPPassthru2Result(Result):
 
         try:
             logger.info(f"http.passthru2 for {target.netloc}{orig_req.path}")
-            resp: requests.Response = requests.request(
+            resp: requests.Response = upstream.request(
                 method,
                 url,
                 headers=headers,
                 data=orig_req.body,
                 allow_redirects=False,
                 verify=tls_verify,
-                timeout=timeout,
+                connect_ms=min(timeout, CONNECT_MS),
+                read_ms=timeout,
             )
 
             logger.info(
@@ -481,6 +646,8 @@ class GetHTTPPassthru2Result(Result):
             result_data["response"].status_code = resp.status_code
             result_data["response"].headers = dict(resp.headers)
             result_data["response"].body = resp.text or None
+        except UpstreamError as ex:
+            logger.warning(f"http.passthru skipped: {ex}")
         except Exception as ex:
             logger.error(f"Invalid response from for http.passthru: {orig_req.method}")
             logger.exception(ex)
@@ -510,7 +677,11 @@ class WeightedRandomSelectionResultWrapper(Result):
     """
 
     @classmethod
-    def execute(cls, result_data: dict, parameter: str):
+    def parse(cls, parameter: str):
+        return json.loads(parameter)
+
+    @classmethod
+    def execute(cls, result_data: dict, parameter: dict):
         rule_id = Utils.dig(result_data, ["metadata", "rule_id"])
         component_id = Utils.dig(result_data, ["metadata", "component_id"])
 
@@ -520,8 +691,6 @@ class WeightedRandomSelectionResultWrapper(Result):
 
         # TODO: if they are not guids, fail?
 
-        parameter = json.loads(parameter)
-
         # TODO: make weights optional and default to [ 1, 1, 1 ... ] for N elements.
 
         if ("results" not in parameter.keys()) or ("weights" not in parameter.keys()):
@@ -0,0 +1,406 @@
+import asyncio
+import http.client
+import io
+import logging
+import ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from http import HTTPStatus
+
+from httpbody import CHUNK, BodyCapture, BodyError, ChunkedDecoder
+from httplistener import (
+    IDLE_TIMEOUT,
+    MAX_REQUESTS,
+    HttpExchange,
+    new_connection_id,
+    response_parts,
+)
+from httpmetrics import metrics
+from models.httpresponse import HttpResponse
+from zentralbibliothek.dbclient3 import DatabaseClient
+from zentralbibliothek.workers import run_workers as supervise
+
+logger = logging.getLogger("listener.http")
+
+TIMEOUT: float = 5.0
+"""seconds a client gets for the TLS handshake, the first request head and a body"""
+
+MAX_HEAD: int = 64 * 1024
+"""longest request line plus headers we read"""
+
+SERVER: str = "dusseldorf v1"
+
+
+def tls_context(tls_crt_file: str, tls_key_file: str) -> ssl.SSLContext:
+    """
+    The server side TLS context of the listener, TLS 1.2+ with strong ciphers only.
+    """
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ctx.minimum_version = ssl.TLSVersion.TLSv1_2
+    ctx.load_cert_chain(tls_crt_file, tls_key_file)
+    ctx.options |= (
+        ssl.OP_NO_SSLv2
+        | ssl.OP_NO_SSLv3
+        | ssl.OP_NO_TLSv1
+        | ssl.OP_NO_TLSv1_1
+        | ssl.OP_CIPHER_SERVER_PREFERENCE
+        | ssl.OP_SINGLE_DH_USE
+        | ssl.OP_SINGLE_ECDH_USE
+    )  # Disable weak ciphers
+    ctx.options |= (
+        ssl.OP_NO_COMPRESSION
+    )  # Disable compression (CRIME attack prevention)
+    # ctx.set_ciphers('ECDHE-ECDSA-AES256-GCM-SHA384:ECDHE-RSA-AES256-GCM-SHA384:TLS_AES_128_GCM_SHA256:TLS_AES_256_GCM_SHA384')
+    ctx.set_ciphers(
+        "CDHE-ECDSA-AES256-GCM-SHA384:ECDHE-ECDSA-AES128-GCM-SHA256:ECDHE-RSA-AES256-GCM-SHA384:ECDHE-RSA-AES128-GCM-SHA256:ECDHE-ECDSA-AES256-SHA384:ECDHE-ECDSA-AES128-SHA256:ECDHE-RSA-AES256-SHA384:ECDHE-RSA-AES128-SHA256"
+    )
+    return ctx
+
+
+def render_response(
+    status_code: int,
+    headers: list,
+    body: bytes,
+    head_only: bool = False,
+    connection: str = "close",
+) -> bytes:
+    """
+    The bytes of an HTTP/1.1 response, with a `connection` header unless it's None.
+    """
+    try:
+        reason = HTTPStatus(status_code).phrase
+    except ValueError:
+        reason = ""
+    lines = [
+        f"HTTP/1.1 {status_code} {reason}",
+        f"Server: {SERVER}",
+        f"Date: {formatdate(usegmt=True)}",
+    ]
+    lines += [f"{hdr}: {value}" for hdr, value in headers]
+    if connection:
+        lines.append(f"Connection: {connection}")
+    head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1", "replace")
+    return head if head_only else head + body
+
+
+def error_response(status_code: int) -> bytes:
+    return render_response(status_code, [("content-length", 0)], b"")
+
+
+class AsyncHttpServer:
+    """
+    Serves the HTTP listener (HTTP/1.1, optionally over TLS) from one asyncio loop, so
+    slow clients, handshakes and passthru calls don't hold up anyone else.
+
+    Requests go through the same HttpExchange as the threaded server. The rule engine
+    (which may wait on a passthru upstream) and saving interactions run on a thread pool
+    of `executor_threads`, the domain and zone checks run on the loop while the storage
+    cache is loaded (and `inline_when_cached` is set).
+
+    Connections are kept alive for up to `max_requests` requests, and closed when idle
+    for `idle_timeout` seconds. Pipelined requests are answered in order.
+
+    With `reuse_port`, the socket is bound with SO_REUSEPORT so several processes can
+    serve the same port, see `run_workers()`.
+    """
+
+    def __init__(
+        self,
+        address: str = "",
+        port: int = 443,
+        ssl_context: ssl.SSLContext = None,
+        executor_threads: int = 32,
+        reuse_port: bool = False,
+        inline_when_cached: bool = True,
+        timeout: float = TIMEOUT,
+        idle_timeout: float = IDLE_TIMEOUT,
+        max_requests: int = MAX_REQUESTS,
+    ):
+        self.address = address or "0.0.0.0"
+        self.port = port
+        self.ssl_context = ssl_context
+        self.reuse_port = reuse_port
+        self.inline_when_cached = inline_when_cached
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self._executor = ThreadPoolExecutor(
+            max_workers=executor_threads, thread_name_prefix="http-worker"
+        )
+        self._tasks: set = set()
+        self._server: asyncio.AbstractServer = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle_connection,
+            host=self.address,
+            port=self.port,
+            ssl=self.ssl_context,
+            ssl_handshake_timeout=self.timeout if self.ssl_context else None,
+            reuse_port=self.reuse_port or None,
+            limit=MAX_HEAD,
+            backlog=1024,
+        )
+        self.port = self._server.sockets[0].getsockname()[1]
+        scheme = "https" if self.ssl_context else "http"
+        logger.info(f"Listening on {self.address}:{self.port} ({scheme})")
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        self._executor.shutdown(wait=False)
+
+    def spawn(self, coro):
+        # keep a reference, the loop only holds weak ones
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def in_memory(self) -> bool:
+        db_client = DatabaseClient.get_instance()
+        return self.inline_when_cached and db_client.cache is not None
+
+    async def run_blocking(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ):
+        opened = time.perf_counter()
+        metrics.connection_opened()
+        connection_id = new_connection_id()
+        requests = 0
+        try:
+            # pipelined requests wait in the reader's buffer, they're answered in order
+            keep_alive = True
+            while keep_alive and requests < self.max_requests:
+                keep_alive = await self._handle_request(
+                    reader, writer, connection_id, requests
+                )
+                requests += 1
+        except (
+            asyncio.IncompleteReadError,
+            asyncio.TimeoutError,
+            ConnectionError,
+            ssl.SSLError,
+        ):
+            pass
+        except Exception as ex:
+            logger.exception("Failed to handle an HTTP request", exc_info=ex)
+        finally:
+            writer.close()
+            metrics.connection_closed(time.perf_counter() - opened, requests)
+
+    async def _handle_request(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        connection_id: str,
+        seq: int,
+    ) -> bool:
+        """
+        Reads, answers and saves the `seq`th request of a connection, returns whether
+        the connection may carry another one.
+        """
+        # the first request is timed from the accept, later ones once they're in
+        started = time.perf_counter() if seq == 0 else None
+        try:
+            head = await asyncio.wait_for(
+                reader.readuntil(b"\r\n\r\n"),
+                self.timeout if seq == 0 else self.idle_timeout,
+            )
+        except asyncio.LimitOverrunError:
+            writer.write(error_response(431))
+            await writer.drain()
+            return False
+
+        request_line, _, raw_headers = head.partition(b"\r\n")
+        parts = request_line.decode("latin-1").split()
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            writer.write(error_response(400))
+            await writer.drain()
+            return False
+        method, path, version = parts
+
+        exchange = HttpExchange(
+            method=method,
+            path=path,
+            version=version,
+            headers=http.client.parse_headers(io.BytesIO(raw_headers)),
+            client_address=writer.get_extra_info("peername"),
+            tls=writer.get_extra_info("sslcontext") is not None,
+            started=started,
+            connection_id=connection_id,
+            connection_seq=seq,
+        )
+
+        # finished here, unless it's handed to _save() which finishes it once saved
+        saving = False
+        try:
+            if status_code := exchange.validate():
+                writer.write(error_response(status_code))
+                await writer.drain()
+                return False
+
+            logger.debug("handling_request(%s %s)", method, path)
+
+            connection = exchange.headers.get("connection", "").lower()
+            if version == "HTTP/1.0":
+                keep_alive = "keep-alive" in connection
+            else:
+                keep_alive = "close" not in connection
+            keep_alive = keep_alive and seq + 1 < self.max_requests
+
+            # domain and zone checks are in memory with the storage cache, else block
+            if self.in_memory():
+                routed = exchange.route()
+            else:
+                routed = await self.run_blocking(exchange.route)
+            if not routed:
+                # the body is left unread, so the next request can't be found
+                keep_alive = keep_alive and not exchange.has_body
+                return await self._send(
+                    writer, exchange, HttpResponse.Empty(), keep_alive
+                )
+
+            try:
+                capture = await self._read_body(reader, exchange)
+            except BodyError as ex:
+                logger.warning("Invalid body: %s", ex)
+                writer.write(error_response(ex.status_code))
+                await writer.drain()
+                return False
+            exchange.mark("body")
+
+            response = await self.run_blocking(exchange.respond, capture)
+            keep_alive = await self._send(writer, exchange, response, keep_alive)
+            exchange.mark("send")
+
+            # the client has its answer, saving doesn't hold up the connection
+            self.spawn(self._save(exchange))
+            saving = True
+            return keep_alive
+        finally:
+            if not saving:
+                exchange.finish()
+
+    async def _read_body(
+        self, reader: asyncio.StreamReader, exchange: HttpExchange
+    ) -> BodyCapture:
+        """
+        Like HttpExchange.read_body(), only a prefix of the body stays in memory.
+        """
+
+        async def read(size: int) -> bytes:
+            chunk = await asyncio.wait_for(reader.read(size), self.timeout)
+            if not chunk:
+                raise asyncio.IncompleteReadError(b"", size)
+            return chunk
+
+        capture = exchange.capture_body()
+
+        async def write(data: bytes):
+            # past the in-memory prefix the body is spilled to disk, off the loop
+            if capture.stays_in_memory(len(data)):
+                capture.write(data)
+            else:
+                await self.run_blocking(capture.write, data)
+
+        if exchange.chunked:
+            decoder = ChunkedDecoder(max_size=exchange.MAX_CONTENT_LENGTH)
+            while not decoder.done:
+                if wanted := decoder.want():
+                    await write(decoder.data(await read(min(CHUNK, wanted))))
+                    continue
+                try:
+                    line = await asyncio.wait_for(
+                        reader.readuntil(b"\n"), self.timeout
+                    )
+                except asyncio.LimitOverrunError:
+                    raise BodyError("chunk line too long")
+                decoder.line(line)
+            exchange.trailers = decoder.trailers
+        else:
+            remaining = exchange.content_length
+            while remaining > 0:
+                chunk = await read(min(CHUNK, remaining))
+                await write(chunk)
+                remaining -= len(chunk)
+        if capture.spilled:
+            return await self.run_blocking(capture.finish)
+        return capture.finish()
+
+    async def _send(
+        self,
+        writer: asyncio.StreamWriter,
+        exchange: HttpExchange,
+        response: HttpResponse,
+        keep_alive: bool,
+    ) -> bool:
+        """
+        Writes the response, returns whether the connection stays open after it.
+        """
+        status_code, headers, body, close = response_parts(response)
+        # we decide on the connection header, a rule's "close" is honoured though
+        headers = [(hdr, v) for hdr, v in headers if hdr.lower() != "connection"]
+        keep_alive = keep_alive and not close
+        if not keep_alive:
+            connection = "close"
+        else:
+            connection = "keep-alive" if exchange.version == "HTTP/1.0" else None
+        writer.write(
+            render_response(
+                status_code, headers, body, exchange.method == "HEAD", connection
+            )
+        )
+        await writer.drain()
+        return keep_alive
+
+    async def _save(self, exchange: HttpExchange):
+        try:
+            await self.run_blocking(exchange.save)
+        except Exception as ex:
+            logger.exception("Failed to save an HTTP interaction", exc_info=ex)
+        exchange.finish()
+
+
+def serve(
+    address: str,
+    port: int,
+    tls_crt_file: str = None,
+    tls_key_file: str = None,
+    executor_threads: int = 32,
+    reuse_port: bool = False,
+):
+    """
+    Run an AsyncHttpServer until interrupted, with TLS when a cert and key are given.
+    This is also the entry point of worker processes.
+    """
+    server = AsyncHttpServer(
+        address=address,
+        port=port,
+        ssl_context=tls_context(tls_crt_file, tls_key_file) if tls_crt_file else None,
+        executor_threads=executor_threads,
+        reuse_port=reuse_port,
+    )
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+def run_workers(workers: int, **kwargs) -> int:
+    """
+    Run `serve(**kwargs)` in `workers` processes that share the port through SO_REUSEPORT,
+    so the kernel spreads connections over them, see zentralbibliothek's `run_workers()`.
+    """
+    return supervise(serve, workers, name="http-worker", **kwargs)
@@ -0,0 +1,192 @@
+import logging
+import os
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
+import requests
+from cachetools import LRUCache
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger("listener.http")
+
+CONNECT_MS: int = int(os.getenv("LSTNER_HTTP_UPSTREAM_CONNECT_MS", 2000))
+"""how long to wait for a connection to (or a free slot for) an upstream"""
+
+READ_MS: int = int(os.getenv("LSTNER_HTTP_UPSTREAM_READ_MS", 5000))
+"""how long an upstream may go quiet while we wait for its response"""
+
+CONCURRENCY: int = int(os.getenv("LSTNER_HTTP_UPSTREAM_CONCURRENCY", 8))
+"""requests in flight per upstream, and connections kept alive to it"""
+
+FAILURES: int = int(os.getenv("LSTNER_HTTP_UPSTREAM_FAILURES", 5))
+"""consecutive failures after which an upstream's circuit opens"""
+
+OPEN_S: float = float(os.getenv("LSTNER_HTTP_UPSTREAM_OPEN_S", 30))
+"""how long an open circuit fails fast before the upstream is tried again"""
+
+HOSTS: int = 256
+"""upstreams we keep pools and circuits for"""
+
+
+class UpstreamError(Exception):
+    """
+    An upstream that wasn't asked: its circuit is open or it has no free slot.
+    """
+
+
+class CircuitBreaker:
+    """
+    Counts an upstream's consecutive failures. After `failures` of them the circuit
+    opens and `allow()` refuses calls for `open_s` seconds, then lets one through
+    (half-open): it closes the circuit again if it succeeds, reopens it if it fails.
+    """
+
+    def __init__(
+        self, failures: int = FAILURES, open_s: float = OPEN_S, clock=time.monotonic
+    ):
+        self.failures = failures
+        self.open_s = open_s
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._count: int = 0
+        self._opened: float = None
+        self._trial: bool = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened is None:
+                return "closed"
+            if self._trial or self._clock() - self._opened < self.open_s:
+                return "open"
+            return "half-open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._trial or self._clock() - self._opened < self.open_s:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self._count = 0
+            self._opened = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._count += 1
+            if self._trial or self._count >= self.failures:
+                self._opened = self._clock()
+                self._trial = False
+
+
+class UpstreamClient:
+    """
+    Sends the passthru results' requests to their upstreams over one shared session.
+
+    Connections are kept alive in a pool per upstream (scheme, host and port), and at
+    most `concurrency` requests are in flight to one upstream: a caller that gets no
+    slot within the connect timeout fails instead of tying up another listener thread.
+    A call still blocks its own thread (a worker thread of the asyncio server) for up
+    to the connect plus read timeout, the cap is what keeps a slow upstream from taking
+    all of them. Transport errors (refused, reset, timed out) count towards the
+    upstream's CircuitBreaker, and while that is open calls fail right away with
+    UpstreamError.
+    """
+
+    def __init__(
+        self,
+        connect_ms: int = CONNECT_MS,
+        read_ms: int = READ_MS,
+        concurrency: int = CONCURRENCY,
+        failures: int = FAILURES,
+        open_s: float = OPEN_S,
+        hosts: int = HOSTS,
+    ):
+        self.connect_ms = connect_ms
+        self.read_ms = read_ms
+        self.concurrency = concurrency
+        self.failures = failures
+        self.open_s = open_s
+
+        self.session = requests.Session()
+        # never send one upstream's cookies along with the next request
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(
+            pool_connections=hosts, pool_maxsize=concurrency, max_retries=0
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        # upstream -> (slots, breaker)
+        self._upstreams: LRUCache = LRUCache(maxsize=hosts)
+
+    def _upstream(self, key: str) -> tuple:
+        with self._lock:
+            upstream = self._upstreams.get(key)
+            if upstream is None:
+                upstream = (
+                    threading.BoundedSemaphore(self.concurrency),
+                    CircuitBreaker(self.failures, self.open_s),
+                )
+                self._upstreams[key] = upstream
+            return upstream
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        connect_ms: int = None,
+        read_ms: int = None,
+        **kwargs,
+    ) -> requests.Response:
+        """
+        Like `requests.request` (but not following redirects unless asked to), with
+        timeouts in milliseconds, None for the client's. Raises UpstreamError when the
+        upstream isn't asked at all.
+        """
+        key = upstream_key(url)
+        slots, breaker = self._upstream(key)
+        connect = (self.connect_ms if connect_ms is None else connect_ms) / 1000
+        read = (self.read_ms if read_ms is None else read_ms) / 1000
+        # a redirect would go to another upstream, past its slots and breaker
+        kwargs.setdefault("allow_redirects", False)
+
+        if not slots.acquire(timeout=connect):
+            raise UpstreamError(f"no free connection to {key}")
+        try:
+            if not breaker.allow():
+                raise UpstreamError(f"circuit open for {key}")
+            try:
+                response = self.session.request(
+                    method, url, timeout=(connect, read), **kwargs
+                )
+            except requests.RequestException:
+                breaker.failure()
+                if breaker.state == "open":
+                    logger.warning(f"http.upstream: circuit open for {key}")
+                raise
+            breaker.success()
+            return response
+        finally:
+            slots.release()
+
+
+def upstream_key(url: str) -> str:
+    """
+    The upstream a URL is sent to, e.g. "https://example.com:443".
+    """
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    return f"{parts.scheme}://{parts.hostname}:{port}"
+
+
+upstream = UpstreamClient()
+"""the listener's upstream client, shared by the passthru results"""
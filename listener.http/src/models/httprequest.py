@@ -4,6 +4,8 @@ from zentralbibliothek.models.networkrequest import NetworkRequest
 
 from models.httpresponse import HttpResponse
 
+_UNREAD = object()
+
 
 class HttpRequest(NetworkRequest):
     """
@@ -22,12 +24,27 @@ class HttpRequest(NetworkRequest):
     headers: dict
     """A `dict` of HTTP request headers"""
 
-    body: str
-    """A string representing the body"""
-
     body_b64: str
     """A string representing a base64 encoded body, if the body is binary or not UTF-8 encoded"""
 
+    body_size: int
+    """The size of the body in bytes, when it was captured"""
+
+    body_sha256: str
+    """The SHA-256 of the body, when it was captured"""
+
+    body_ref: str
+    """Where a body larger than its stored prefix is kept, if it is"""
+
+    trailers: dict
+    """A `dict` of trailer fields, sent after a chunked body"""
+
+    capture = None
+    """The `BodyCapture` the body came from, if any"""
+
+    _body: str = None
+    _whole = _UNREAD
+
     tls: bool
     """Whether this request was done over a TLS protected connection"""
 
@@ -51,31 +68,66 @@ class HttpRequest(NetworkRequest):
             "body",
             "body_b64",
             "tls",
+            "body_size",
+            "body_sha256",
+            "body_ref",
+            "trailers",
+            "capture",
         ]
         for key in allowed_keys:
             self.__setattr__(key, kwargs.get(key))
 
+    @property
+    def body(self) -> str:
+        """
+        A string representing the body. For a body larger than the prefix it was
+        created with, the whole body is read from its capture on first use.
+        """
+        if self.capture is None or not self.capture.spilled:
+            return self._body
+        if self._whole is _UNREAD:
+            try:
+                self._whole = self.capture.read().decode("utf-8")
+            except UnicodeDecodeError:
+                self._whole = None
+        return self._whole
+
+    @body.setter
+    def body(self, value: str):
+        self._body = value
+
     @property
     def json(self):
-        """Returns a JSON alike representation of the HTTP Request"""
-        return json.dumps(
-            dict(
-                {
-                    "method": self.method,
-                    "path": self.path,
-                    "version": self.version,
-                    "headers": self.headers,
-                    "body": self.body,
-                    "body_b64": self.body_b64,
-                    "tls": self.tls,
-                }
-            )
-        )
+        """
+        Returns a JSON alike representation of the HTTP Request.
+        Of a large body only the prefix is in there, with its size, hash and ref.
+        """
+        blob = {
+            "method": self.method,
+            "path": self.path,
+            "version": self.version,
+            "headers": self.headers,
+            "body": self._body,
+            "body_b64": self.body_b64,
+            "tls": self.tls,
+        }
+        if self.body_size is not None:
+            blob["body_size"] = self.body_size
+            blob["body_sha256"] = self.body_sha256
+            blob["body_ref"] = self.body_ref
+        if self.trailers:
+            blob["trailers"] = self.trailers
+        return json.dumps(blob)
 
     @property
     def default_response(self):
         return HttpResponse(status_code=200, headers={}, body="")
 
+    @property
+    def response_key(self):
+        # the default response is always the same
+        return ()
+
     @property
     def summary(self):
         maxpath: str = (self.path[:20] + "..") if len(self.path) > 20 else self.path
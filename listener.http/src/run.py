@@ -2,11 +2,11 @@ import logging
 import os
 import ssl
 import sys
-from socketserver import TCPServer
-from ssl import SSLContext
+from socketserver import ThreadingTCPServer
 
 from azure.monitor.opentelemetry import configure_azure_monitor
 from httplistener import HttpRequestHandler
+from httpserver import run_workers, serve, tls_context
 from zentralbibliothek.dbclient3 import DatabaseClient
 from zentralbibliothek.utils import Utils
 
@@ -34,6 +34,11 @@ def main():
     tls_crt_file: str = os.environ.get("DSSLDRF_TLS_CRT_FILE", None)
     tls_key_file: str = os.environ.get("DSSLDRF_TLS_KEY_FILE", None)
 
+    # "threaded" (a thread per connection) or "asyncio" (optionally several workers)
+    server_kind: str = os.getenv("LSTNER_HTTP_SERVER", "threaded").lower()
+    workers: int = int(os.getenv("LSTNER_HTTP_WORKERS", 1))
+    executor_threads: int = int(os.getenv("LSTNER_HTTP_EXECUTOR_THREADS", 32))
+
     if "DSSLDRF_CONNSTR" not in os.environ:
         logger.critical(
             f"{LISTENER_NAME} DSSLDRF_CONNSTR not found in environment variables"
@@ -43,57 +48,55 @@ def main():
     # wake up the DB
     _ = DatabaseClient.get_instance()
 
-    try:
-        server = TCPServer((iface, port), HttpRequestHandler)
-        if tls is True:
-            # if this is an HTTP server, load the cert and keyfile
-            if tls_crt_file is None:
-                logger.critical(
-                    f"{LISTENER_NAME} DSSLDRF_TLS_CRT_FILE not found in environment variables"
-                )
-                return -1
-            if tls_key_file is None:
-                logger.critical(
-                    f"{LISTENER_NAME} DSSLDRF_TLS_KEY_FILE not found in environment variables"
-                )
-                return -1
-
-            # but check if they exist on filesystem
-            if not os.path.isfile(tls_crt_file):
-                logger.critical(
-                    f"{LISTENER_NAME} TLS cert file {tls_crt_file} not found"
-                )
-                return -1
-            if not os.path.isfile(tls_key_file):
-                logger.critical(
-                    f"{LISTENER_NAME} TLS key file {tls_key_file} not found"
-                )
-                return -1
-
-            ctx = SSLContext(ssl.PROTOCOL_TLS_SERVER)
-            ctx.minimum_version = ssl.TLSVersion.TLSv1_2
-            ctx.load_cert_chain(tls_crt_file, tls_key_file)
-            ctx.options |= (
-                ssl.OP_NO_SSLv2
-                | ssl.OP_NO_SSLv3
-                | ssl.OP_NO_TLSv1
-                | ssl.OP_NO_TLSv1_1
-                | ssl.OP_CIPHER_SERVER_PREFERENCE
-                | ssl.OP_SINGLE_DH_USE
-                | ssl.OP_SINGLE_ECDH_USE
-            )  # Disable weak ciphers
-            ctx.options |= (
-                ssl.OP_NO_COMPRESSION
-            )  # Disable compression (CRIME attack prevention)
-            # ctx.set_ciphers('ECDHE-ECDSA-AES256-GCM-SHA384:ECDHE-RSA-AES256-GCM-SHA384:TLS_AES_128_GCM_SHA256:TLS_AES_256_GCM_SHA384')
-            ctx.set_ciphers(
-                "CDHE-ECDSA-AES256-GCM-SHA384:ECDHE-ECDSA-AES128-GCM-SHA256:ECDHE-RSA-AES256-GCM-SHA384:ECDHE-RSA-AES128-GCM-SHA256:ECDHE-ECDSA-AES256-SHA384:ECDHE-ECDSA-AES128-SHA256:ECDHE-RSA-AES256-SHA384:ECDHE-RSA-AES128-SHA256"
+    if tls is True:
+        # if this is an HTTP server, load the cert and keyfile
+        if tls_crt_file is None:
+            logger.critical(
+                f"{LISTENER_NAME} DSSLDRF_TLS_CRT_FILE not found in environment variables"
+            )
+            return -1
+        if tls_key_file is None:
+            logger.critical(
+                f"{LISTENER_NAME} DSSLDRF_TLS_KEY_FILE not found in environment variables"
+            )
+            return -1
+
+        # but check if they exist on filesystem
+        if not os.path.isfile(tls_crt_file):
+            logger.critical(
+                f"{LISTENER_NAME} TLS cert file {tls_crt_file} not found"
+            )
+            return -1
+        if not os.path.isfile(tls_key_file):
+            logger.critical(
+                f"{LISTENER_NAME} TLS key file {tls_key_file} not found"
             )
+            return -1
+
+    if server_kind == "asyncio":
+        logger.info(f"{LISTENER_NAME} Listening on {port} with {workers} worker(s)")
+        options = dict(
+            address=iface,
+            port=port,
+            tls_crt_file=tls_crt_file if tls else None,
+            tls_key_file=tls_key_file if tls else None,
+            executor_threads=executor_threads,
+        )
+        if workers > 1:
+            return run_workers(workers, **options)
+        serve(**options)
+        return 0
 
+    try:
+        server = ThreadingTCPServer((iface, port), HttpRequestHandler)
+        server.daemon_threads = True
+        if tls is True:
+            ctx = tls_context(tls_crt_file, tls_key_file)
+            # handshake in the connection's thread, not while accepting
             server.socket = ctx.wrap_socket(
                 server.socket,
                 server_side=True,
-                do_handshake_on_connect=True,
+                do_handshake_on_connect=False,
                 suppress_ragged_eofs=True,
             )
 
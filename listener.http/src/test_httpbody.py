@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+
+import pytest
+from httpbody import BodyCapture, BodyError, ChunkedDecoder
+from httplistener import decode_body
+from httprules import HttpBodyPredicate
+from models.httprequest import HttpRequest
+
+
+def capture(data: bytes, keep: int = 8, spill_dir: str = None, chunk: int = 5):
+    body = BodyCapture(keep=keep, spill_dir=spill_dir)
+    for i in range(0, len(data), chunk):
+        body.write(data[i : i + chunk])
+    return body.finish()
+
+
+def test_body_capture_in_memory():
+    body = capture(b"hello")
+    assert not body.spilled
+    assert (body.prefix, body.size, body.ref) == (b"hello", 5, None)
+    assert body.sha256 == hashlib.sha256(b"hello").hexdigest()
+
+
+def test_body_capture_spills():
+    data = b"0123456789abcdefghij"
+    body = capture(data)
+    assert body.spilled
+    assert body.prefix == b"01234567"
+    assert body.size == len(data)
+    assert body.read() == data
+    # across chunk boundaries
+    assert body.contains(b"789a")
+    assert body.contains(b"hij")
+    assert not body.contains(b"ji")
+    body.close()
+
+
+def test_body_capture_kept_by_hash(tmp_path):
+    data = b"x" * 100
+    first = capture(data, spill_dir=str(tmp_path))
+    second = capture(data, spill_dir=str(tmp_path))
+    assert first.ref == second.ref == os.path.join(tmp_path, first.sha256)
+    assert os.listdir(tmp_path) == [first.sha256]
+    with open(first.ref, "rb") as f:
+        assert f.read() == data
+    first.close()
+    second.close()
+
+    # a body that never completes leaves nothing behind
+    partial = BodyCapture(keep=8, spill_dir=str(tmp_path))
+    partial.write(data)
+    partial.close()
+    assert os.listdir(tmp_path) == [first.sha256]
+
+
+def test_decode_body_prefix():
+    data = "grüße".encode("utf-8")
+    assert decode_body(data) == ("grüße", None)
+    # the prefix ends halfway through the ß
+    assert decode_body(data[:-3], partial=True) == ("grü", None)
+    assert decode_body(b"\xff\xfe") == (None, "//4=")
+
+
+def _request(body: BodyCapture) -> HttpRequest:
+    text, text_b64 = decode_body(body.prefix, body.spilled)
+    return HttpRequest(
+        req_fqdn="test.dusseldorf.local",
+        zone_fqdn="dusseldorf.local",
+        remote_addr="127.0.0.1",
+        method="POST",
+        path="/",
+        version="HTTP/1.1",
+        headers={},
+        body=text,
+        body_b64=text_b64,
+        tls=False,
+        body_size=body.size,
+        body_sha256=body.sha256,
+        body_ref=body.ref,
+        capture=body,
+    )
+
+
+def test_http_request_large_body():
+    data = b"a" * 20 + b"needle" + b"b" * 20
+    request = _request(capture(data))
+    stored = json.loads(request.json)
+    assert stored["body"] == "aaaaaaaa"
+    assert stored["body_size"] == len(data)
+    assert stored["body_sha256"] == hashlib.sha256(data).hexdigest()
+    # predicates see the whole body
+    assert request.body == data.decode()
+    assert json.loads(request.json)["body"] == "aaaaaaaa"
+
+
+def test_http_body_predicate_scans_capture():
+    matcher = HttpBodyPredicate.compile("needle[0-9]")
+    assert matcher(_request(capture(b"a" * 20 + b"needle7")))
+    assert not matcher(_request(capture(b"a" * 20 + b"needle")))
+
+    # without the literal the body isn't read into memory
+    request = _request(capture(b"a" * 40))
+    request.capture.read = lambda: pytest.fail("the whole body was read")
+    assert not matcher(request)
+
+
+def decode_chunked(raw: bytes, max_size: int = 1024, read: int = 3):
+    """Drives a ChunkedDecoder like a server does, returns (body, decoder, rest)."""
+    decoder = ChunkedDecoder(max_size=max_size)
+    body = b""
+    while not decoder.done:
+        if wanted := decoder.want():
+            data, raw = raw[: min(read, wanted)], raw[min(read, wanted) :]
+            if not data:
+                raise EOFError()
+            body += decoder.data(data)
+        else:
+            line, sep, raw = raw.partition(b"\n")
+            decoder.line(line + sep)
+    return body, decoder, raw
+
+
+def test_chunked_decoder():
+    raw = b"5;ext=1\r\nhello\r\nA\r\n, world!!!\r\n0\r\nX-Sum: 42\r\n\r\nGET /next"
+    body, decoder, rest = decode_chunked(raw)
+    assert body == b"hello, world!!!"
+    assert decoder.size == 15
+    assert decoder.trailers == {"X-Sum": "42"}
+    # what comes after the body is left alone
+    assert rest == b"GET /next"
+
+
+def test_chunked_decoder_errors():
+    for raw in [
+        b"zz\r\nhello\r\n0\r\n\r\n",  # not hex
+        b"-5\r\nhello\r\n0\r\n\r\n",
+        b"1_0\r\n" + b"x" * 16 + b"\r\n0\r\n\r\n",
+        b"3\r\nhello\r\n0\r\n\r\n",  # longer than its size
+        b"0\r\nno colon\r\n\r\n",
+        b"0\r\nX-Sum: 42",  # cut short
+    ]:
+        with pytest.raises(BodyError) as ex:
+            decode_chunked(raw)
+        assert ex.value.status_code == 400
+
+    with pytest.raises(EOFError):
+        decode_chunked(b"5\r\nhel")
+
+    with pytest.raises(BodyError) as ex:
+        decode_chunked(b"400\r\n", max_size=1000)
+    assert ex.value.status_code == 413
@@ -0,0 +1,72 @@
+import pytest
+from httprules import (
+    GetHTTPPassthruResult,
+    HttpBodyPredicate,
+    HttpHeaderValueRegexesPredicate,
+    HttpMethodPredicate,
+    HttpPathPredicate,
+    SetHttpResponseBodyResult,
+    SetVariableResult,
+)
+from models.httprequest import HttpRequest
+
+
+def _get_http_request(**kwargs):
+    values = dict(
+        method="POST",
+        path="/api/callback?x=1",
+        version="1.1",
+        headers={"User-Agent": "curl/8.0"},
+        body="hello world",
+        tls=False,
+    )
+    values.update(kwargs)
+    return HttpRequest(
+        req_fqdn="test.dusseldorf.local",
+        zone_fqdn="dusseldorf.local",
+        remote_addr="127.0.0.1",
+        **values,
+    )
+
+
+def test_http_method_predicate_compiled():
+    matcher = HttpMethodPredicate.compile("get,Post")
+    assert matcher(_get_http_request())
+    assert not matcher(_get_http_request(method="PUT"))
+
+
+def test_http_path_predicate_compiled():
+    matcher = HttpPathPredicate.compile("^/api/")
+    assert matcher(_get_http_request())
+    assert not matcher(_get_http_request(path="/other"))
+
+
+def test_http_body_predicate_without_body():
+    matcher = HttpBodyPredicate.compile("world")
+    assert matcher(_get_http_request())
+    assert not matcher(_get_http_request(body=None))
+
+
+def test_http_header_regexes_predicate_compiled():
+    matcher = HttpHeaderValueRegexesPredicate.compile('{"User-Agent": "^curl/"}')
+    assert matcher(_get_http_request())
+    assert not matcher(_get_http_request(headers={"User-Agent": "wget"}))
+
+
+def test_http_predicates_reject_invalid_parameters():
+    with pytest.raises(ValueError):
+        HttpPathPredicate.compile("(unclosed")
+    with pytest.raises(ValueError):
+        HttpHeaderValueRegexesPredicate.compile("not json")
+
+
+def test_http_empty_parameter_always_matches():
+    assert HttpPathPredicate.compile("")(_get_http_request())
+    assert HttpMethodPredicate.satisfied_by(_get_http_request(), "")
+
+
+def test_http_results_deterministic():
+    assert SetHttpResponseBodyResult.deterministic("hello")
+    assert SetVariableResult.deterministic(SetVariableResult.parse("$zone:zone()"))
+    assert not SetVariableResult.deterministic(SetVariableResult.parse("$id:uuid()"))
+    assert not GetHTTPPassthruResult.deterministic("https://example.com")
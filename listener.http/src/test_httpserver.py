@@ -0,0 +1,250 @@
+import asyncio
+
+import httplistener
+from httpmetrics import LatencyMetrics
+from httpserver import AsyncHttpServer
+from models.httpresponse import HttpResponse
+from zentralbibliothek.dbclient3 import DatabaseClient
+from zentralbibliothek.domainmatcher import DomainMatcher
+
+
+class FakeDatabase:
+    cache = None
+
+    def __init__(self):
+        self.saved = []
+
+    def get_domain_matcher(self):
+        return DomainMatcher(["dusseldorf.local"])
+
+    def find_zone_for_request(self, fqdn):
+        if fqdn.endswith("test.dusseldorf.local"):
+            return "test.dusseldorf.local"
+        return None
+
+    def save_interaction(self, req, resp, extra=None):
+        self.saved.append((req, resp, extra))
+
+
+def echo(request):
+    return HttpResponse(
+        status_code=201, headers={"X-Echo": request.method}, body=request.body
+    )
+
+
+async def exchange(raw: bytes) -> bytes:
+    server = AsyncHttpServer(address="127.0.0.1", port=0)
+    await server.start()
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+        writer.write(raw)
+        await writer.drain()
+        reply = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        # let the interaction be saved
+        while server._tasks:
+            await asyncio.sleep(0.01)
+        return reply
+    finally:
+        server.close()
+
+
+def setup_fakes(monkeypatch) -> FakeDatabase:
+    db = FakeDatabase()
+    monkeypatch.setattr(DatabaseClient, "get_instance", staticmethod(lambda: db))
+    monkeypatch.setattr(httplistener, "get_response", echo)
+    return db
+
+
+def test_httpserver_rules_and_save(monkeypatch):
+    db = setup_fakes(monkeypatch)
+    reply = asyncio.run(
+        exchange(
+            b"POST /x HTTP/1.1\r\nHost: a.test.dusseldorf.local\r\n"
+            b"Content-Length: 5\r\nConnection: close\r\n\r\nhello"
+        )
+    )
+    head, _, body = reply.partition(b"\r\n\r\n")
+    assert head.startswith(b"HTTP/1.1 201 Created\r\n")
+    assert b"X-Echo: POST" in head
+    assert b"content-length: 5" in head
+    assert body == b"hello"
+
+    req, resp, _ = db.saved[0]
+    assert (req.zone_fqdn, req.path, req.body, req.tls) == (
+        "test.dusseldorf.local",
+        "/x",
+        "hello",
+        False,
+    )
+
+
+def test_httpserver_other_zone_and_invalid(monkeypatch):
+    db = setup_fakes(monkeypatch)
+    reply = asyncio.run(exchange(b"GET / HTTP/1.0\r\nHost: elsewhere.com\r\n\r\n"))
+    assert reply.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert reply.endswith(b"content-length: 0\r\nConnection: close\r\n\r\n")
+
+    reply = asyncio.run(exchange(b"TRACE / HTTP/1.1\r\nHost: elsewhere.com\r\n\r\n"))
+    assert reply.startswith(b"HTTP/1.1 405 ")
+    reply = asyncio.run(exchange(b"garbage\r\n\r\n"))
+    assert reply.startswith(b"HTTP/1.1 400 ")
+    assert db.saved == []
+
+
+def test_httpserver_keep_alive_pipelined(monkeypatch):
+    db = setup_fakes(monkeypatch)
+    request = (
+        b"PUT /%d HTTP/1.1\r\nHost: a.test.dusseldorf.local\r\nContent-Length: 2\r\n"
+    )
+    # three requests in one go, the last one closes the connection
+    reply = asyncio.run(
+        exchange(
+            request % 1
+            + b"\r\nhi"
+            + request % 2
+            + b"\r\nho"
+            + request % 3
+            + b"Connection: close\r\n\r\nhu"
+        )
+    )
+    assert reply.count(b"HTTP/1.1 201 Created") == 3
+    assert reply.index(b"\r\n\r\nhi") < reply.index(b"\r\n\r\nho")
+    assert reply.endswith(b"Connection: close\r\n\r\nhu")
+
+    saved = sorted(db.saved, key=lambda saved: saved[2]["connseq"])
+    assert [req.path for req, _, _ in saved] == ["/1", "/2", "/3"]
+    assert [extra["connseq"] for _, _, extra in saved] == [0, 1, 2]
+    assert len({extra["connection"] for _, _, extra in saved}) == 1
+
+
+def test_httpserver_max_requests(monkeypatch):
+    setup_fakes(monkeypatch)
+    server = AsyncHttpServer(address="127.0.0.1", port=0, max_requests=2)
+
+    async def pipeline():
+        await server.start()
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            writer.write(b"GET / HTTP/1.1\r\nHost: elsewhere.com\r\n\r\n" * 3)
+            return await asyncio.wait_for(reader.read(), 5)
+        finally:
+            server.close()
+
+    reply = asyncio.run(pipeline())
+    assert reply.count(b"HTTP/1.1 200 OK") == 2
+    assert reply.endswith(b"Connection: close\r\n\r\n")
+
+
+def test_httpserver_chunked(monkeypatch):
+    db = setup_fakes(monkeypatch)
+    chunked = (
+        b"POST /c HTTP/1.1\r\nHost: a.test.dusseldorf.local\r\n"
+        b"Transfer-Encoding: chunked\r\n\r\n"
+        b"4\r\nwiki\r\n5;x=y\r\npedia\r\n0\r\nX-Trailer: 1\r\n\r\n"
+    )
+    # a pipelined request right after the chunked body
+    reply = asyncio.run(
+        exchange(
+            chunked + b"GET / HTTP/1.1\r\nHost: other.com\r\nConnection: close\r\n\r\n"
+        )
+    )
+    assert reply.count(b"HTTP/1.1 ") == 2
+    assert b"\r\n\r\nwikipedia" in reply
+
+    req, _, _ = db.saved[0]
+    assert (req.body, req.trailers) == ("wikipedia", {"X-Trailer": "1"})
+
+
+def test_httpserver_chunked_invalid(monkeypatch):
+    db = setup_fakes(monkeypatch)
+    head = b"POST / HTTP/1.1\r\nHost: a.test.dusseldorf.local\r\n"
+    reply = asyncio.run(
+        exchange(head + b"Transfer-Encoding: chunked\r\n\r\nnope\r\n")
+    )
+    assert reply.startswith(b"HTTP/1.1 400 ")
+    # both framings, a request smuggling attempt
+    reply = asyncio.run(
+        exchange(
+            head + b"Transfer-Encoding: chunked\r\nContent-Length: 3\r\n\r\n0\r\n\r\n"
+        )
+    )
+    assert reply.startswith(b"HTTP/1.1 400 ")
+    reply = asyncio.run(exchange(head + b"Transfer-Encoding: gzip\r\n\r\n"))
+    assert reply.startswith(b"HTTP/1.1 501 ")
+    assert db.saved == []
+
+
+def test_httpserver_content_length_invalid(monkeypatch):
+    db = setup_fakes(monkeypatch)
+    head = b"POST / HTTP/1.1\r\nHost: a.test.dusseldorf.local\r\n"
+    smuggled = b"GET /smuggled HTTP/1.1\r\nHost: a.test.dusseldorf.local\r\n\r\n"
+    for framing in [
+        b"Content-Length: -1\r\n",
+        b"Content-Length: +5\r\n",
+        b"Content-Length: 1_0\r\n",
+        b"Content-Length: 5\r\nContent-Length: 6\r\n",
+        b"Transfer-Encoding: chunked\r\nTransfer-Encoding: identity\r\n",
+    ]:
+        # the pipelined request must not be read from the body
+        reply = asyncio.run(exchange(head + framing + b"\r\n" + smuggled))
+        assert reply.startswith(b"HTTP/1.1 400 "), framing
+        assert reply.count(b"HTTP/1.1 ") == 1
+        assert reply.endswith(b"Connection: close\r\n\r\n")
+    assert db.saved == []
+
+    # the same length twice is unambiguous
+    reply = asyncio.run(
+        exchange(
+            head + b"Content-Length: 2\r\nContent-Length: 2\r\n"
+            b"Connection: close\r\n\r\nhi"
+        )
+    )
+    assert reply.startswith(b"HTTP/1.1 201 ")
+
+
+def test_httpserver_records_failed_requests(monkeypatch):
+    setup_fakes(monkeypatch)
+    metrics = LatencyMetrics(report_interval=3600)
+    monkeypatch.setattr(httplistener, "metrics", metrics)
+    head = b"POST / HTTP/1.1\r\nHost: a.test.dusseldorf.local\r\n"
+    # an invalid body, and one the client gives up on halfway
+    asyncio.run(exchange(head + b"Transfer-Encoding: chunked\r\n\r\nnope\r\n"))
+
+    async def give_up():
+        server = AsyncHttpServer(address="127.0.0.1", port=0)
+        await server.start()
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            writer.write(head + b"Content-Length: 10\r\n\r\nhalf")
+            writer.write_eof()
+            assert await asyncio.wait_for(reader.read(), 5) == b""
+            writer.close()
+        finally:
+            server.close()
+
+    asyncio.run(give_up())
+    assert metrics.stats()["stages"]["total"]["count"] == 2
+
+
+def test_latency_metrics():
+    metrics = LatencyMetrics(report_interval=3600)
+    for ms in range(1, 101):
+        metrics.record({"rules": ms / 1000, "total": ms / 500})
+    metrics.connection_opened()
+    metrics.connection_opened()
+    metrics.connection_closed(0.5, 3)
+
+    stats = metrics.stats(reset=True)
+    assert list(stats["stages"]) == ["rules", "total"]
+    assert stats["stages"]["rules"]["count"] == 100
+    assert stats["stages"]["rules"]["max_ms"] == 100
+    assert stats["stages"]["rules"]["p50_ms"] == 51
+    assert stats["connections"] == {
+        "closed": 1,
+        "open": 1,
+        "peak": 2,
+        "mean_s": 0.5,
+        "requests": 3,
+    }
+    assert metrics.stats()["stages"] == {}
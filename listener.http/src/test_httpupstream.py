@@ -0,0 +1,109 @@
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+from httpupstream import CircuitBreaker, UpstreamClient, UpstreamError, upstream_key
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.peers.add(self.client_address)
+        if self.path == "/moved":
+            self.send_response(302)
+            self.send_header("Location", "/x")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = b"hello"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Set-Cookie", "session=secret")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def origin():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.daemon_threads = True
+    server.peers = set()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _closed_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_upstream_keeps_connections_alive(origin):
+    client = UpstreamClient()
+    url = f"http://127.0.0.1:{origin.server_port}/x"
+    for _ in range(3):
+        resp = client.request("GET", url)
+        assert (resp.status_code, resp.text) == (200, "hello")
+    # one connection, and no cookies carried over
+    assert len(origin.peers) == 1
+    assert not client.session.cookies
+    # redirects are passed on, not followed
+    resp = client.request("GET", f"http://127.0.0.1:{origin.server_port}/moved")
+    assert (resp.status_code, resp.headers["Location"]) == (302, "/x")
+
+
+def test_upstream_circuit_breaker():
+    client = UpstreamClient(connect_ms=200, failures=2, open_s=60)
+    url = f"http://127.0.0.1:{_closed_port()}/"
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            client.request("GET", url)
+    with pytest.raises(UpstreamError):
+        client.request("GET", url)
+
+
+def test_upstream_busy(origin):
+    client = UpstreamClient(concurrency=1)
+    url = f"http://127.0.0.1:{origin.server_port}/"
+    slots, _ = client._upstream(upstream_key(url))
+    slots.acquire()
+    started = time.monotonic()
+    with pytest.raises(UpstreamError):
+        client.request("GET", url, connect_ms=50)
+    # no time at all means no time, not the default
+    with pytest.raises(UpstreamError):
+        client.request("GET", url, connect_ms=0)
+    assert time.monotonic() - started < 1
+    slots.release()
+    assert client.request("GET", url).status_code == 200
+
+
+def test_circuit_breaker_half_open():
+    now = [0.0]
+    breaker = CircuitBreaker(failures=2, open_s=10, clock=lambda: now[0])
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert (breaker.state, breaker.allow()) == ("open", False)
+
+    now[0] = 11
+    assert breaker.state == "half-open"
+    # a single trial call, which fails and reopens the circuit
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open"
+
+    now[0] = 22
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed"
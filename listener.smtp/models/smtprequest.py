@@ -53,3 +53,8 @@ class SmtpRequest(NetworkRequest):
         The default is "250 OK".
         """
         return SmtpResponse(code=250, message="OK")
+
+    @property
+    def response_key(self):
+        # the default response is always the same
+        return ()
@@ -31,6 +31,10 @@ class SmtpHandler:
 
         # Check if the domain is valid and if we have a zone for it
         # This mirrors the domain/zone check in DusseldorfResolver
+        if not self.db.get_domain_matcher().is_valid(domain):
+            logger.debug(f"Denying relay for {address} (not our domain)")
+            return "550 Relay access denied"
+
         zone_fqdn = self.db.find_zone_for_request(domain)
 
         if zone_fqdn is None:
@@ -2,7 +2,9 @@ import re
 
 from models.smtprequest import SmtpRequest
 from models.smtpresponse import SmtpResponse
+from zentralbibliothek.models.matcher import ALWAYS, COST_BODY, COST_REGEX, Matcher
 from zentralbibliothek.ruleengine import Predicate, Result, RuleEngine
+from zentralbibliothek.saferegex import SafeRegex
 
 # region predicates
 
@@ -14,10 +16,18 @@ class SmtpMailFromPredicate(Predicate):
     """
 
     @classmethod
-    def satisfied_by(cls, request: SmtpRequest, parameter: str):
+    def compile(cls, parameter: str) -> Matcher:
         if not parameter:
-            return True
-        return re.search(parameter, request.mail_from, re.IGNORECASE) is not None
+            return ALWAYS
+        regex = SafeRegex(parameter, re.IGNORECASE)
+        return Matcher(
+            test=lambda request: regex.found(request.mail_from),
+            cost=COST_REGEX,
+        )
+
+    @classmethod
+    def satisfied_by(cls, request: SmtpRequest, parameter: str):
+        return cls.compile(parameter)(request)
 
 
 class SmtpRcptToPredicate(Predicate):
@@ -27,13 +37,18 @@ class SmtpRcptToPredicate(Predicate):
     """
 
     @classmethod
-    def satisfied_by(cls, request: SmtpRequest, parameter: str):
+    def compile(cls, parameter: str) -> Matcher:
         if not parameter:
-            return True
-        for rcpt in request.rcpt_tos:
-            if re.search(parameter, rcpt, re.IGNORECASE):
-                return True
-        return False
+            return ALWAYS
+        regex = SafeRegex(parameter, re.IGNORECASE)
+        return Matcher(
+            test=lambda request: any(regex.found(rcpt) for rcpt in request.rcpt_tos),
+            cost=COST_REGEX,
+        )
+
+    @classmethod
+    def satisfied_by(cls, request: SmtpRequest, parameter: str):
+        return cls.compile(parameter)(request)
 
 
 class SmtpDataContainsPredicate(Predicate):
@@ -43,11 +58,18 @@ class SmtpDataContainsPredicate(Predicate):
     """
 
     @classmethod
-    def satisfied_by(cls, request: SmtpRequest, parameter: str):
+    def compile(cls, parameter: str) -> Matcher:
         if not parameter:
-            return True
+            return ALWAYS
         # Using re.DOTALL to make '.' match newlines
-        return re.search(parameter, request.data, re.IGNORECASE | re.DOTALL) is not None
+        regex = SafeRegex(parameter, re.IGNORECASE | re.DOTALL)
+        return Matcher(
+            test=lambda request: regex.found(request.data), cost=COST_BODY
+        )
+
+    @classmethod
+    def satisfied_by(cls, request: SmtpRequest, parameter: str):
+        return cls.compile(parameter)(request)
 
 
 # endregion
@@ -61,6 +83,10 @@ class SetSmtpResponseCodeResult(Result):
     Parameter: The integer code as a string (e.g., "550").
     """
 
+    @classmethod
+    def deterministic(cls, parameter) -> bool:
+        return True
+
     @classmethod
     def execute(cls, result_data: dict, parameter: str):
         response: SmtpResponse = result_data["response"]
@@ -78,6 +104,10 @@ class SetSmtpResponseMessageResult(Result):
     Parameter: The message string (e.g., "User unknown").
     """
 
+    @classmethod
+    def deterministic(cls, parameter) -> bool:
+        return True
+
     @classmethod
     def execute(cls, result_data: dict, parameter: str):
         response: SmtpResponse = result_data["response"]
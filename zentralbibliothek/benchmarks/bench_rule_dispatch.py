@@ -0,0 +1,110 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+# aka.ms/dusseldorf
+
+"""
+Match latency of a zone's rules, as the number of rules per zone grows: a linear scan over
+every rule versus the dispatch index of the rule bundle.
+
+Every rule requires an HTTP method and a path under its own prefix (e.g. `^/r42/`), the way
+people set up lots of endpoints in one zone, or (unanchored) a path containing its own file
+name anywhere (e.g. `/r42\\.json`). Requests hit the last rule (worst case for the scan) or
+no rule at all.
+
+    python benchmarks/bench_rule_dispatch.py [rules ...]
+"""
+
+import sys
+import time
+
+from zentralbibliothek.models.matcher import Dispatch, Matcher, compile_regex, literal_prefix, required_literal
+from zentralbibliothek.models.predicate import Predicate
+from zentralbibliothek.models.result import Result
+from zentralbibliothek.rulebundle import RuleBundle
+
+class Request:
+    zone_fqdn = "bench.test.net"
+
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+
+    @property
+    def default_response(self):
+        return {}
+
+def _method(request):
+    return request.method
+
+def _path(request):
+    return request.path
+
+class Method(Predicate):
+    @classmethod
+    def compile(cls, parameter):
+        methods = frozenset(parameter.split(","))
+        return Matcher(test=lambda request: request.method in methods,
+                       dispatch=Dispatch(key="method", value=_method, accepts=methods))
+
+class Path(Predicate):
+    @classmethod
+    def compile(cls, parameter):
+        regex = compile_regex(parameter)
+        prefix = literal_prefix(parameter)
+        return Matcher(test=lambda request: regex.search(request.path) is not None,
+                       dispatch=Dispatch(key="path", value=_path, prefix=prefix or None, contains=required_literal(parameter) or None))
+
+class Body(Result):
+    @classmethod
+    def execute(cls, result_data, parameter):
+        result_data["response"]["body"] = parameter
+
+def _rules(count, anchored):
+    methods = ("get", "post", "put", "get,head")
+    return [{
+        "ruleid": f"r{i}",
+        "priority": i,
+        "rulecomponents": [
+            {"componentid": 1, "ispredicate": True, "actionname": "http.method", "actionvalue": methods[i % len(methods)]},
+            {"componentid": 2, "ispredicate": True, "actionname": "http.path", "actionvalue": f"^/r{i}/.*\\.json$" if anchored else f"/r{i}\\.json"},
+            {"componentid": 3, "ispredicate": False, "actionname": "http.body", "actionvalue": str(i)},
+        ],
+    } for i in range(count)]
+
+def _linear(bundle, request):
+    for rule in bundle.rules:
+        if rule.satisfied_by(request):
+            return rule
+    return None
+
+def _time(match, bundle, requests, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for request in requests:
+            match(bundle, request)
+    return (time.perf_counter() - start) / (rounds * len(requests)) * 1e6
+
+def main(sizes):
+    print(f"{'rules':>7} {'paths':>10} {'case':>5} {'linear us':>10} {'indexed us':>11} {'speedup':>8}")
+    for anchored in (True, False):
+        for count in sizes:
+            bundle = RuleBundle.compile("bench.test.net", "http", _rules(count, anchored),
+                                        {"http.method": Method, "http.path": Path}, {"http.body": Body})
+            last = count - 1
+            method = ("get", "post", "put", "get")[last % 4]
+            path = f"/r{last}/x.json" if anchored else f"/files/r{last}.json"
+            cases = {
+                "last": [Request(method, path)],
+                "miss": [Request("delete", path), Request("get", "/nothing/here")],
+            }
+            rounds = max(1, 20000 // count)
+            for case, requests in cases.items():
+                assert all(bundle.match(r) is _linear(bundle, r) for r in requests)
+                linear = _time(_linear, bundle, requests, rounds)
+                indexed = _time(RuleBundle.match, bundle, requests, rounds)
+                print(f"{count:>7} {'anchored' if anchored else 'unanchored':>10} {case:>5} "
+                      f"{linear:>10.2f} {indexed:>11.2f} {linear / indexed:>7.1f}x")
+
+if __name__ == "__main__":
+    main([int(n) for n in sys.argv[1:]] or [10, 100, 1000, 5000])
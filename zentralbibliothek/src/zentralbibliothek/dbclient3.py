@@ -5,10 +5,17 @@ import logging
 import random
 import os
 import string
+import threading
 import time
+from datetime import timedelta
+from bson import ObjectId
 from pymongo import MongoClient, errors
 from cachetools.func import ttl_cache
 # from .config import Config
+from .domainmatcher import DomainMatcher
+from .interactionwriter import POLICY_BLOCK, InteractionWriter
+from .storagecache import StorageCache
+from .zoneindex import ZoneIndex
 from .models.networkrequest import NetworkRequest
 from .models.networkresponse import NetworkResponse
 from azure.monitor.opentelemetry import configure_azure_monitor
@@ -28,6 +35,22 @@ class DatabaseClient:
     _instance = None
     _client = None
     _db = None
+    _writer:InteractionWriter = None
+    _cache:StorageCache = None
+
+    # in-memory index of all zones, see find_zone_for_request()
+    ZONE_INDEX_REBUILD_INTERVAL:float = 30  # full reload, this is what picks up deleted zones
+    ZONE_INDEX_UPDATE_INTERVAL:float = 1    # at most this often, a miss fetches newly created zones
+    # ObjectIds only grow per second (and per process), so newly created zones are fetched from
+    # this long before the newest one we know of
+    ZONE_INDEX_OVERLAP:timedelta = timedelta(seconds=10)
+    _zone_index:ZoneIndex = None
+    _zone_index_lock = threading.Lock()
+    _zone_index_last_id = None
+    _zone_index_rebuilt:float = 0
+    _zone_index_updated:float = 0
+    _domain_matcher:DomainMatcher = None
+    _domain_matcher_source = None
 
     def __init__(self) -> None:
         raise RuntimeError("This is a singleton class. Don't instantiate it, call get_instance instead.")
@@ -56,6 +79,25 @@ class DatabaseClient:
         self._client = MongoClient(connstr)
         self._db = self._client.get_database(dbname)
 
+        # interactions are written in batches from a background thread, unless disabled.
+        async_writes:str = os.environ.get("DSSLDRF_WRITER_ASYNC", "1")
+        if self._writer is None and async_writes.lower() in ("true", "1", "on", "y", "yes"):
+            self._writer = InteractionWriter.from_env(self._insert_interactions)
+
+        # domains, zones and rules are served from memory and kept current by a change stream, unless disabled.
+        use_cache:str = os.environ.get("DSSLDRF_CACHE", "1")
+        if self._cache is None and use_cache.lower() in ("true", "1", "on", "y", "yes"):
+            self._cache = StorageCache(lambda: self._db, resync_interval=float(os.environ.get("DSSLDRF_CACHE_RESYNC_S", 5)),
+                                      full_resync_interval=float(os.environ.get("DSSLDRF_CACHE_FULL_RESYNC_S", 300)))
+            self._cache.start()
+
+    @property
+    def cache(self) -> StorageCache:
+        """
+        The in-process storage cache, or None when it's disabled or not loaded (yet).
+        """
+        return self._cache if self._cache is not None and self._cache.ready else None
+
     def test_connectivity(self) -> bool:
         """
         Test connectivity to the database, Returns true if succeeded, false if not. 
@@ -83,7 +125,6 @@ class DatabaseClient:
                 logger.critical(f'Unable to connect to database: {ex}')
                 raise RuntimeError('Unable to connect to database')
 
-    @ttl_cache(maxsize=256, ttl=5) 
     def domain_exists(self, domain_fqdn:str) -> bool:
         """
         Indicator method to tell if a domain exists in the database. 
@@ -94,6 +135,12 @@ class DatabaseClient:
         Returns:
             bool
         """
+        if cache := self.cache:
+            return cache.get_domain(domain_fqdn) is not None
+        return self._domain_exists(domain_fqdn)
+
+    @ttl_cache(maxsize=256, ttl=5)
+    def _domain_exists(self, domain_fqdn:str) -> bool:
         self.guarantee_connectivity()
         try:
             count = self._db.domains.count_documents({"domain": domain_fqdn})
@@ -102,7 +149,6 @@ class DatabaseClient:
             logger.critical(f"Unable to check if domain exists in database: {ex}")
             return False
 
-    @ttl_cache(maxsize=256, ttl=5)
     def zone_exists(self, zone_fqdn:str) -> bool:
         """
         Indicator method to tell if a zone exists in the database.
@@ -117,7 +163,13 @@ class DatabaseClient:
         """
         if zone_fqdn == "":
             return False
-        
+
+        if cache := self.cache:
+            return cache.get_zone(zone_fqdn) is not None
+        return self._zone_exists(zone_fqdn)
+
+    @ttl_cache(maxsize=256, ttl=5)
+    def _zone_exists(self, zone_fqdn:str) -> bool:
         self.guarantee_connectivity()
         try:
             count = self._db.zones.count_documents({"fqdn": zone_fqdn})
@@ -126,37 +178,83 @@ class DatabaseClient:
             logger.critical(f"Unable to check if zone exists in database: {ex}")
             return False
 
-    def save_interaction(self, req:NetworkRequest, resp:NetworkResponse) -> str:
+    def save_interaction(self, req:NetworkRequest, resp:NetworkResponse, extra:dict = None) -> str:
         """
         Log a request (and its response) in the database.
+        When the background writer is enabled, the document is only queued here and the
+        id is assigned client side, so this never waits on a database round trip.
 
         Arguments:
             req:NetworkRequest
                 The request. What else would it be? 
             resp:NetworkResponse
                 The response.
+            extra:dict
+                Optional fields to store with (or override in) the document, e.g. the
+                `count`, `first_seen` and `last_seen` of coalesced duplicates.
         Returns:
-            str: The timestamp that the db assigned to this request.
-        """
+            str: The id that was assigned to this request.
+        """
+        doc = {
+            "_id": ObjectId(),
+            "zone": req.zone_fqdn,
+            "fqdn": req.req_fqdn,
+            "protocol": req.protocol,
+            "clientip": req.remote_addr,
+            "request": req.json,
+            "response": resp.json,
+            "reqsummary": req.summary,
+            "respsummary": resp.summary,
+            "time": int(time.time())
+        }
+        if extra:
+            doc.update(extra)
+
+        if self._writer is not None:
+            return str(doc["_id"]) if self._writer.submit(doc) else ''
+
         self.guarantee_connectivity()
         try:
-            result = self._db.requests.insert_one({
-                "zone": req.zone_fqdn,
-                "fqdn": req.req_fqdn,
-                "protocol": req.protocol,
-                "clientip": req.remote_addr,
-                "request": req.json,
-                "response": resp.json,
-                "reqsummary": req.summary,
-                "respsummary": resp.summary,
-                "time": int(time.time())
-            })
+            result = self._db.requests.insert_one(doc)
             return str(result.inserted_id)
         except Exception as ex:
             logger.critical(f"Unable to save request/response to database: {ex}")
             return ''
 
-    @ttl_cache(maxsize=64, ttl=1)
+    def _insert_interactions(self, docs:list) -> int:
+        """
+        Internal. Used by the background writer to store a batch of interactions.
+        Returns the number of documents that were written.
+        """
+        self.guarantee_connectivity()
+        try:
+            result = self._db.requests.insert_many(docs, ordered=False)
+            return len(result.inserted_ids)
+        except errors.BulkWriteError as ex:
+            logger.critical(f"Unable to save some requests/responses to database: {ex}")
+            return ex.details.get("nInserted", 0)
+
+    def flush_interactions(self):
+        """
+        Write out all queued interactions now. Call this before shutting down a listener.
+        """
+        if self._writer is not None:
+            self._writer.flush()
+
+    def writer_stats(self) -> dict:
+        """
+        Queue depth and flush latency counters of the background writer (empty if disabled).
+        """
+        return self._writer.stats() if self._writer is not None else {}
+
+    @property
+    def saves_without_blocking(self) -> bool:
+        """
+        Whether save_interaction() returns right away: interactions are queued for the background
+        writer, and a full queue drops or samples them instead of making the caller wait.
+        """
+        return self._writer is not None and self._writer.policy != POLICY_BLOCK
+
     def get_rules(self, zone_fqdn:str):
         """
         Get all the rules for the given zone FQDN, as a list of dictionaries. 
@@ -167,6 +265,12 @@ class DatabaseClient:
         Returns:
             list[dict]
         """
+        if cache := self.cache:
+            return list(cache.get_rules(zone_fqdn))[:1000]
+        return self._get_rules(zone_fqdn)
+
+    @ttl_cache(maxsize=64, ttl=1)
+    def _get_rules(self, zone_fqdn:str):
         self.guarantee_connectivity()
         try:
             rules = list(self._db.rules.find({"zone": zone_fqdn}).limit(1000))
@@ -175,13 +279,52 @@ class DatabaseClient:
             logger.critical(f"Unable to get rules from database: {ex}")
             return []
 
-    @ttl_cache(maxsize=256, ttl=30)
+    def get_rules_for_zone(self, network_protocol:str, zone_fqdn:str) -> list:
+        """
+        Get the full rule documents of a zone for one network protocol, in a single query,
+        sorted by priority.
+        """
+        if cache := self.cache:
+            rules = [rule for rule in cache.get_rules(zone_fqdn) if rule.get("networkprotocol") == network_protocol]
+            return sorted(rules, key=lambda rule: rule["priority"] if isinstance(rule.get("priority"), int) else 1 << 31)
+
+        self.guarantee_connectivity()
+        try:
+            return list(self._db.rules.find({"networkprotocol": network_protocol, "zone": zone_fqdn}).sort("priority", 1))
+        except Exception as ex:
+            logger.critical(f"Unable to get rules from database: {ex}")
+            return []
+
+    def rules_version(self, zone_fqdn:str):
+        """
+        An opaque version that changes whenever the zone or its rules change, or None when
+        that can't be told (without the storage cache).
+        """
+        if cache := self.cache:
+            return cache.zone_version(zone_fqdn)
+        return None
+
+    def names_version(self):
+        """
+        An opaque version that changes whenever what a name resolves to can change: a domain
+        (its public_ips included) or the set of zones. None when that can't be told (without the
+        storage cache).
+        """
+        if cache := self.cache:
+            return (cache.domains_version, cache.zones_version)
+        return None
+
     def find_zone_for_request(self, request_fqdn):
         """
         Find the Zone FQDN for a given request's FQDN e.g. if a zone exists with FQDN `sahil.ssrf.ms` 
         and a request comes in on `hello.sahil.ssrf.ms`, this can help you find the zone.
         If this returns an fqdn, that means the zone, and therefore the domain, are guaranteed to exist. 
 
+        Lookups are answered from an in-memory reverse-label index of all zones (longest match wins).
+        With the storage cache enabled it is kept current by the cache, otherwise the index is reloaded every ZONE_INDEX_REBUILD_INTERVAL seconds, and a miss fetches zones
+        created since the last load (at most every ZONE_INDEX_UPDATE_INTERVAL seconds). Names outside our domains can't be in a
+        zone that was created since, so they are a definite miss that never touches the database.
+
         Arguments: 
             zone_fqdn:str
                 The FQDN of the zone to check.
@@ -189,29 +332,78 @@ class DatabaseClient:
             str: the fqdn of the zone.
             None: when no zone is found.
         """
-        self.guarantee_connectivity()
-        try:
-            request_fqdn = request_fqdn.lower()
-            # first try a direct match
-            zone = self._db.zones.find_one({"fqdn": request_fqdn})
-            if zone:
-                return zone["fqdn"]
-
-            # else, iterate through all zones and check if request_fqdn ends with zone fqdn
-            zones = self._db.zones.find({}, {"_id": 0, "fqdn": 1})
-            for zone_it in zones:
-                if request_fqdn.endswith("." + zone_it["fqdn"].lower()):
-                    return zone_it["fqdn"]
+        request_fqdn = request_fqdn.lower()
+        if cache := self.cache:
+            return cache.find_zone(request_fqdn)
 
+        now = time.monotonic()
+        if self._zone_index is None or now - self._zone_index_rebuilt > self.ZONE_INDEX_REBUILD_INTERVAL:
+            self._rebuild_zone_index()
+
+        zone = self._zone_index.find(request_fqdn) if self._zone_index is not None else None
+        if zone is None and now - self._zone_index_updated > self.ZONE_INDEX_UPDATE_INTERVAL \
+                and self.get_domain_matcher().is_valid(request_fqdn):
+            self._update_zone_index()
+            zone = self._zone_index.find(request_fqdn) if self._zone_index is not None else None
+
+        if zone is None:
             # if we're here, we couldn't find a zone
             logger.debug(f"No zone found for fqdn: {request_fqdn}")
-            return None
-        
+        return zone
+
+    def _rebuild_zone_index(self):
+        """
+        Internal. Load all zone FQDNs into the zone index.
+        Only one thread reloads at a time, the others keep using the current index.
+        """
+        if not self._zone_index_lock.acquire(blocking=self._zone_index is None):
+            return
+        try:
+            self.guarantee_connectivity()
+            fqdns = []
+            last_id = None
+            for zone in self._db.zones.find({}, {"_id": 1, "fqdn": 1}).sort("_id", 1):
+                fqdns.append(zone["fqdn"])
+                last_id = zone["_id"]
+
+            if self._zone_index is None:
+                self._zone_index = ZoneIndex(fqdns)
+            else:
+                self._zone_index.rebuild(fqdns)
+            self._zone_index_last_id = last_id
+            self._zone_index_rebuilt = self._zone_index_updated = time.monotonic()
+        except Exception as ex:
+            logger.critical(f"Unable to load zones from database: {ex}")
+        finally:
+            self._zone_index_lock.release()
+
+    def _update_zone_index(self):
+        """
+        Internal. Add the zones that were created since the index was last loaded.
+        Another process can create a zone with a lower ObjectId in the same second as the newest
+        one we have, so this fetches from ZONE_INDEX_OVERLAP before it; adding a zone twice is a no-op.
+        """
+        if self._zone_index is None or not self._zone_index_lock.acquire(blocking=False):
+            return
+        try:
+            self.guarantee_connectivity()
+            last_id = self._zone_index_last_id
+            query = {}
+            if isinstance(last_id, ObjectId):
+                query = {"_id": {"$gte": ObjectId.from_datetime(last_id.generation_time - self.ZONE_INDEX_OVERLAP)}}
+            elif last_id is not None:
+                query = {"_id": {"$gt": last_id}}
+            for zone in self._db.zones.find(query, {"_id": 1, "fqdn": 1}).sort("_id", 1):
+                self._zone_index.add(zone["fqdn"])
+                if last_id is None or zone["_id"] > last_id:
+                    last_id = zone["_id"]
+            self._zone_index_last_id = last_id
+            self._zone_index_updated = time.monotonic()
         except Exception as ex:
             logger.critical(f"Unable to find zone for request: {ex}")
-            return None
+        finally:
+            self._zone_index_lock.release()
 
-    @ttl_cache(maxsize=256, ttl=1)
     def get_aggregated_rule_predicates_for_zone(self, network_protocol:str, zone_fqdn:str):
         """
         Returns a list of tuples with three elements each: rule id, list of action names, and list of corresponding action values. 
@@ -223,50 +415,76 @@ class DatabaseClient:
         <<<     ('rule-id-2', ['http.body'], ['.*'])
         <<< ]
         """
+        if cache := self.cache:
+            rules = [rule for rule in cache.get_rules(zone_fqdn) if rule.get("networkprotocol") == network_protocol]
+            return self._aggregate_rule_predicates(rules)
+        return self._get_aggregated_rule_predicates_for_zone(network_protocol, zone_fqdn)
+
+    @classmethod
+    def _aggregate_rule_predicates(cls, rules) -> list:
+        result = []
+        for rule in rules:
+            predicates = [(comp["actionname"], comp["actionvalue"]) for comp in rule["rulecomponents"] if comp["ispredicate"]]
+            if predicates:
+                action_names, action_values = zip(*predicates)
+                result.append((rule["ruleid"], list(action_names), list(action_values)))
+        return result
+
+    @ttl_cache(maxsize=256, ttl=1)
+    def _get_aggregated_rule_predicates_for_zone(self, network_protocol:str, zone_fqdn:str):
         self.guarantee_connectivity()
         try:
             rules = self._db.rules.find({"networkprotocol": network_protocol, "zone": zone_fqdn})
-            result = []
-            for rule in rules:
-                predicates = [(comp["actionname"], comp["actionvalue"]) for comp in rule["rulecomponents"] if comp["ispredicate"]]
-                if predicates:
-                    action_names, action_values = zip(*predicates)
-                    result.append((rule["ruleid"], list(action_names), list(action_values)))
-            return result
+            return self._aggregate_rule_predicates(rules)
         except Exception as ex:
             logger.critical(f"Unable to get rule preds from database: {ex}")
             return []
 
-    @ttl_cache(maxsize=256, ttl=1)
     def get_aggregated_rule_results(self, rule_id:str):
         """
         Returns a tuple describing all the results of a given rule. 
 
         Sample output: ('rule-id-here', ['action_name_1', ...], ['action_value_1', ...])
         """
+        if cache := self.cache:
+            return self._aggregate_rule_results(rule_id, cache.get_rule(rule_id))
+        return self._get_aggregated_rule_results(rule_id)
+
+    @classmethod
+    def _aggregate_rule_results(cls, rule_id:str, rule) -> tuple:
+        if not rule:
+            return (rule_id, [], [], [])
+        results = [(comp["componentid"], comp["actionname"], comp["actionvalue"]) for comp in rule["rulecomponents"] if not comp["ispredicate"]]
+        if results:
+            component_ids, action_names, action_values = zip(*results)
+            return (rule_id, list(component_ids), list(action_names), list(action_values))
+        return (rule_id, [], [], [])
+
+    @ttl_cache(maxsize=256, ttl=1)
+    def _get_aggregated_rule_results(self, rule_id:str):
         self.guarantee_connectivity()
         try:
             rule = self._db.rules.find_one({"ruleid": rule_id})
-            if not rule:
-                return (rule_id, [], [], [])
-            results = [(comp["componentid"], comp["actionname"], comp["actionvalue"]) for comp in rule["rulecomponents"] if not comp["ispredicate"]]
-            if results:
-                component_ids, action_names, action_values = zip(*results)
-                return (rule_id, list(component_ids), list(action_names), list(action_values))
-            return (rule_id, [], [], [])
+            return self._aggregate_rule_results(rule_id, rule)
         except Exception as ex:
             logger.critical(f"Unable to get rule results from database: {ex}")
             return (rule_id, [], [], [])
 
 
-    @ttl_cache(maxsize=256, ttl=30)
     def get_domain_from_zone(self, zone_fqdn:str):
         """
         Get the domain FQDN from a zone FQDN. 
         """
         if zone_fqdn == "":
             raise ValueError("zone_fqdn cannot be empty")
-                
+
+        if cache := self.cache:
+            zone = cache.get_zone(zone_fqdn)
+            return zone["domain"] if zone else ""
+        return self._get_domain_from_zone(zone_fqdn)
+
+    @ttl_cache(maxsize=256, ttl=30)
+    def _get_domain_from_zone(self, zone_fqdn:str):
         self.guarantee_connectivity()
         try:
             zone = self._db.zones.find_one({"fqdn": zone_fqdn})
@@ -276,11 +494,16 @@ class DatabaseClient:
             return ""
 
 
-    @ttl_cache(maxsize=256, ttl=30)
     def get_domains(self) -> list:
         """
         Get all the domains in the database. 
         """
+        if cache := self.cache:
+            return cache.get_domains()
+        return self._get_domains()
+
+    @ttl_cache(maxsize=256, ttl=30)
+    def _get_domains(self) -> list:
         self.guarantee_connectivity()
         try:
             domains = self._db.domains.find()
@@ -289,11 +512,31 @@ class DatabaseClient:
             logger.critical(f"Unable to get domains from database: {ex}")
             return []
 
+    def get_domain_matcher(self) -> DomainMatcher:
+        """
+        A DomainMatcher over all the domains, to tell whether a request is for one of them.
+        It is only rebuilt when the domains change.
+        """
+        domains = self.get_domains()
+        matcher = self._domain_matcher
+        # get_domains() hands out the same object until something changes
+        if matcher is None or (domains is not self._domain_matcher_source and matcher.domains != tuple(domains)):
+            matcher = self._domain_matcher = DomainMatcher(domains)
+        self._domain_matcher_source = domains
+        return matcher
+
 
     def get_public_ips(self, domain:str="") -> list:
         """
         Get all the public IPs in the database. 
         """
+        if cache := self.cache:
+            if domain != "":
+                rec = cache.get_domain(domain)
+            else:
+                rec = next((cache.get_domain(d) for d in cache.get_domains()), None)
+            return rec["public_ips"] if rec and "public_ips" in rec else []
+
         self.guarantee_connectivity()
         rec = None
         try:
@@ -309,6 +552,22 @@ class DatabaseClient:
             logger.critical(f"Unable to get public IPs from database: {ex}")
         return []   
 
+    def get_negative_ttl(self, domain:str):
+        """
+        The negative caching TTL (RFC 2308) configured for a domain in its `negative_ttl`
+        field, or None when it isn't set.
+        """
+        if cache := self.cache:
+            rec = cache.get_domain(domain)
+        else:
+            self.guarantee_connectivity()
+            try:
+                rec = self._db.domains.find_one({"domain": domain})
+            except Exception as ex:
+                logger.critical(f"Unable to get negative TTL from database: {ex}")
+                rec = None
+        return rec.get("negative_ttl") if rec else None
+
 
     @PendingDeprecationWarning
     def create_zone(self, zone_prefix:str = "", parent_zone:str = "") -> str:
@@ -334,11 +593,16 @@ class DatabaseClient:
 
         self.guarantee_connectivity()
         try:
-            self._db.zones.insert_one({"fqdn": new_zone, "domain": domain, "parent_zone": parent_zone})
+            zone_doc = {"fqdn": new_zone, "domain": domain, "parent_zone": parent_zone}
+            self._db.zones.insert_one(zone_doc)
             self._db.zones.insert_many([
                 {"fqdn": new_zone, "authz.alias": authz["alias"], "authz.authzlevel": authz["authzlevel"]}
                 for authz in self._db.zones.find({"fqdn": parent_zone})
             ])
+            if self._zone_index is not None:
+                self._zone_index.add(new_zone)
+            if self._cache is not None:
+                self._cache.put("zones", zone_doc)
             return new_zone
         except Exception as ex:
             logger.critical(f"Failed to create zone: {ex}")
@@ -371,7 +635,10 @@ class DatabaseClient:
         """
         self.guarantee_connectivity()
         try:
-            self._db.domains.insert_one({"domain": domain})
+            domain_doc = {"domain": domain}
+            self._db.domains.insert_one(domain_doc)
+            if self._cache is not None:
+                self._cache.put("domains", domain_doc)
             return domain
         except Exception as ex:
             logger.critical(f"Failed to create domain: {ex}")
@@ -383,6 +650,8 @@ class DatabaseClient:
         """
         self.guarantee_connectivity()
         try:
+            if self._cache is not None and (cached := self._cache.get_domain(domain)):
+                self._cache.delete("domains", cached["_id"])
             return self._db.domains.delete_one({"domain": domain})
         except Exception as ex:
             logger.critical(f"Failed to delete domain: {ex}")
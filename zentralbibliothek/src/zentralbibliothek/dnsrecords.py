@@ -0,0 +1,28 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+# aka.ms/dusseldorf
+
+import ipaddress
+
+# record types the DNS listener can answer with: it has an encoder for each of these (and
+# refuses to register one for anything else), the API only accepts these for `dns.type`.
+RECORD_TYPES:tuple = (
+    "A",
+    "AAAA",
+    "CAA",
+    "CNAME",
+    "HTTPS",
+    "MX",
+    "NS",
+    "PTR",
+    "SOA",
+    "SRV",
+    "TXT",
+)
+
+# record types whose `ip` must be an address of a particular version
+ADDRESS_TYPES:dict = {
+    "A": ipaddress.IPv4Address,
+    "AAAA": ipaddress.IPv6Address,
+}
@@ -0,0 +1,65 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+# aka.ms/dusseldorf
+
+import re
+from typing import Iterable
+from .utils import Utils
+
+# what Utils.valid_dns_label accepts for plain ASCII names: labels of 1 to 62 letters, digits
+# and hyphens, not starting or ending with a hyphen, and an optional trailing period.
+_LABEL = r"[a-z0-9](?:[a-z0-9-]{0,60}[a-z0-9])?"
+_ASCII_NAME = re.compile(rf"(?:{_LABEL}\.)*{_LABEL}\.?", re.IGNORECASE)
+
+class DomainMatcher:
+    """
+    Decides whether a name is one of our domains or falls under one, the check every
+    listener does before looking for a zone.
+
+    Domains are kept in a set and a name is matched by looking up each of its suffixes, so a
+    lookup is O(labels) whatever the number of domains. Names are validated like
+    `Utils.valid_dns_label()`, with a precompiled pattern for plain ASCII names; only names
+    that need IDNA checks (non-ASCII, or `--` in a label) go through the slow path.
+
+    A matcher is immutable, `DatabaseClient.get_domain_matcher()` builds a new one when the
+    domains change.
+    """
+    def __init__(self, domains:Iterable[str] = ()) -> None:
+        self.domains:tuple = tuple(domains)
+        self._suffixes:frozenset = frozenset(d.lower().rstrip(".") for d in self.domains if d)
+
+    def __len__(self) -> int:
+        return len(self._suffixes)
+
+    @staticmethod
+    def valid_name(fqdn:str) -> bool:
+        """
+        Whether `fqdn` is a well formed host name, same as `Utils.valid_dns_label(fqdn)`.
+        """
+        if not fqdn or len(fqdn) > 255:
+            return False
+        if fqdn.isascii() and "--" not in fqdn:
+            return _ASCII_NAME.fullmatch(fqdn) is not None
+        return Utils.valid_dns_label(fqdn)
+
+    def match(self, fqdn:str):
+        """
+        The domain `fqdn` is or falls under (the longest one when domains nest), or None.
+        """
+        if not self._suffixes or not self.valid_name(fqdn):
+            return None
+        name = fqdn.lower().rstrip(".")
+        while True:
+            if name in self._suffixes:
+                return name
+            dot = name.find(".")
+            if dot < 0:
+                return None
+            name = name[dot + 1:]
+
+    def is_valid(self, fqdn:str) -> bool:
+        """
+        Whether `fqdn` is one of our domains or falls under one.
+        """
+        return self.match(fqdn) is not None
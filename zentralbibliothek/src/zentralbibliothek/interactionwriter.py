@@ -0,0 +1,226 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+# aka.ms/dusseldorf
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable
+
+logger = logging.getLogger('dssldrf.interactionwriter')
+
+POLICY_BLOCK = "block"
+POLICY_DROP_OLDEST = "drop_oldest"
+POLICY_SAMPLE = "sample"
+
+class InteractionWriter:
+    """
+    Background writer that batches interaction documents before they hit the database.
+
+    Listeners hand documents to `submit()`, which only appends to a bounded in-memory queue.
+    A daemon thread drains the queue and hands batches to `sink` (e.g. an `insert_many` wrapper)
+    when either `batch_size` documents are waiting or `flush_interval` seconds have passed.
+
+    When the queue is full, `policy` decides what happens:
+        block        the caller waits until there is room (at most `block_timeout` seconds,
+                     after which the document is dropped)
+        drop_oldest  the oldest queued document is discarded to make room
+        sample       only every `sample_every`-th overflowing document is kept (replacing
+                     the oldest one), the others are dropped
+
+    Call `close()` to flush whatever is left; this is registered with atexit as well.
+    """
+    def __init__(self, sink:Callable[[list], int], batch_size:int = 100, flush_interval:float = 0.25,
+                 max_queue:int = 10000, policy:str = POLICY_BLOCK, sample_every:int = 10,
+                 block_timeout:float = 5.0, stats_interval:float = 60.0) -> None:
+        if policy not in (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_SAMPLE):
+            raise ValueError(f"Unknown backpressure policy `{policy}`")
+        if batch_size < 1 or max_queue < 1:
+            raise ValueError("batch_size and max_queue must be positive")
+
+        self._sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.policy = policy
+        self.sample_every = max(1, sample_every)
+        self.block_timeout = block_timeout
+        self.stats_interval = stats_interval
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._overflow_seen = 0
+        self._last_stats_log = time.monotonic()
+
+        # counters, see stats()
+        self._submitted = 0
+        self._written = 0
+        self._dropped = 0
+        self._failed = 0
+        self._flushes = 0
+        self._max_depth = 0
+        self._last_flush_ms = 0.0
+        self._max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+        self._thread = threading.Thread(target=self._run, name="dssldrf-interaction-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_env(cls, sink:Callable[[list], int]):
+        """
+        Build a writer configured through the DSSLDRF_WRITER_* environment variables.
+        """
+        return cls(
+            sink,
+            batch_size=int(os.environ.get("DSSLDRF_WRITER_BATCH_SIZE", 100)),
+            flush_interval=int(os.environ.get("DSSLDRF_WRITER_FLUSH_MS", 250)) / 1000,
+            max_queue=int(os.environ.get("DSSLDRF_WRITER_QUEUE_SIZE", 10000)),
+            policy=os.environ.get("DSSLDRF_WRITER_POLICY", POLICY_BLOCK).lower(),
+            sample_every=int(os.environ.get("DSSLDRF_WRITER_SAMPLE_EVERY", 10)),
+        )
+
+    def submit(self, doc:dict) -> bool:
+        """
+        Queue a document for writing. Returns False if the document was dropped.
+        """
+        with self._cond:
+            if self._closed:
+                self._dropped += 1
+                return False
+
+            if len(self._queue) >= self.max_queue:
+                if self.policy == POLICY_BLOCK:
+                    deadline = time.monotonic() + self.block_timeout
+                    while len(self._queue) >= self.max_queue and not self._closed:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.notify_all()
+                        self._cond.wait(remaining)
+                    if len(self._queue) >= self.max_queue or self._closed:
+                        self._dropped += 1
+                        return False
+                elif self.policy == POLICY_DROP_OLDEST:
+                    self._queue.popleft()
+                    self._dropped += 1
+                else:
+                    self._overflow_seen += 1
+                    if self._overflow_seen % self.sample_every != 0:
+                        self._dropped += 1
+                        return False
+                    self._queue.popleft()
+                    self._dropped += 1
+
+            self._queue.append(doc)
+            self._submitted += 1
+            depth = len(self._queue)
+            if depth > self._max_depth:
+                self._max_depth = depth
+            if depth >= self.batch_size:
+                self._cond.notify_all()
+        return True
+
+    def flush(self) -> None:
+        """
+        Synchronously write everything that is currently queued.
+        """
+        while True:
+            with self._cond:
+                batch = self._take_batch()
+            if not batch:
+                return
+            self._write(batch)
+
+    def close(self) -> None:
+        """
+        Stop accepting documents, flush the queue and stop the background thread.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout=max(self.flush_interval * 4, 1.0))
+        self.flush()
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def stats(self) -> dict:
+        """
+        Counters to help tune the batch size, flush interval and queue size.
+        """
+        with self._cond:
+            return {
+                "queue_depth": len(self._queue),
+                "max_queue_depth": self._max_depth,
+                "submitted": self._submitted,
+                "written": self._written,
+                "dropped": self._dropped,
+                "failed": self._failed,
+                "flushes": self._flushes,
+                "last_flush_ms": round(self._last_flush_ms, 3),
+                "max_flush_ms": round(self._max_flush_ms, 3),
+                "avg_flush_ms": round(self._total_flush_ms / self._flushes, 3) if self._flushes else 0.0,
+            }
+
+    def _take_batch(self) -> list:
+        """
+        Internal. Pop up to batch_size documents, caller must hold the lock.
+        """
+        count = min(self.batch_size, len(self._queue))
+        batch = [self._queue.popleft() for _ in range(count)]
+        if batch:
+            # wake up producers that are blocked on a full queue
+            self._cond.notify_all()
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while len(self._queue) < self.batch_size and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._closed:
+                    return
+                batch = self._take_batch()
+
+            if batch:
+                self._write(batch)
+            self._maybe_log_stats()
+
+    def _write(self, batch:list) -> None:
+        start = time.perf_counter()
+        written = 0
+        try:
+            written = self._sink(batch)
+        except Exception as ex:
+            logger.critical(f"Unable to write batch of {len(batch)} interactions: {ex}")
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        with self._cond:
+            self._flushes += 1
+            self._written += written
+            self._failed += len(batch) - written
+            self._last_flush_ms = elapsed_ms
+            self._total_flush_ms += elapsed_ms
+            if elapsed_ms > self._max_flush_ms:
+                self._max_flush_ms = elapsed_ms
+
+    def _maybe_log_stats(self) -> None:
+        now = time.monotonic()
+        if now - self._last_stats_log < self.stats_interval:
+            return
+        self._last_stats_log = now
+        logger.info(f"interaction writer stats: {self.stats()}")
@@ -0,0 +1,141 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+# aka.ms/dusseldorf
+
+import re
+from typing import Callable
+try:
+    import re._parser as _sre_parse
+except ImportError: # python < 3.11
+    import sre_parse as _sre_parse
+from attr import dataclass
+
+# rough relative cost of evaluating a matcher. Rules evaluate their cheapest predicates first,
+# so most requests that don't match are turned down before anything expensive runs.
+COST_NONE = 0
+"""doesn't look at the request at all"""
+COST_LOOKUP = 10
+"""a flag, or membership of a set"""
+COST_HEADERS = 20
+"""walks the request headers"""
+COST_DEFAULT = 25
+"""unknown, e.g. the default `Predicate.compile()`"""
+COST_REGEX = 30
+"""a regex over a short field, such as the path"""
+COST_BODY = 40
+"""a scan of the request body"""
+
+
+@dataclass(frozen=True, slots=True)
+class Dispatch:
+    """
+    A cheap discriminator a predicate can expose, so the rule engine can skip rules that can't
+    possibly match without evaluating them. The predicate only holds if `value(request)` is in
+    `accepts`, or (for strings) starts with `prefix` or contains `contains`.
+    Predicates on the same `key` must use the same `value` function.
+    """
+    key:str
+    """what is being looked at, e.g. `http.method`"""
+    value:Callable
+    """takes the request, returns the value to look up"""
+    accepts:frozenset = None
+    prefix:str = None
+    contains:str = None
+    """a literal; those of all rules in a zone are looked for in a single scan"""
+
+
+@dataclass(frozen=True, slots=True)
+class Matcher:
+    """
+    A compiled predicate: everything that can be worked out from the parameter alone has been
+    done already, so evaluating it against a request is a plain call.
+    Build these with `Predicate.compile()`.
+
+    >>> matcher = HttpMethodPredicate.compile("GET,POST")
+    >>> matcher(request)
+    <<< True
+    """
+    test:Callable
+    """takes the request, returns whether the predicate holds"""
+    dispatch:Dispatch = None
+    """optional, a necessary condition for `test` that's cheap to index"""
+    cost:int = COST_DEFAULT
+    """estimated cost of `test`, one of the COST_ constants"""
+
+    def __call__(self, request) -> bool:
+        return self.test(request)
+
+
+ALWAYS = Matcher(test=lambda request: True, cost=COST_NONE)
+"""Matcher for predicates that don't require anything (e.g. an empty parameter)."""
+
+
+def compile_regex(pattern:str, flags:int = 0) -> re.Pattern:
+    """
+    Compile a user supplied regular expression, raising ValueError when it's invalid.
+    """
+    try:
+        return re.compile(pattern, flags)
+    except (re.error, TypeError) as ex:
+        raise ValueError(f"Invalid regular expression `{pattern}`: {ex}") from ex
+
+
+_REGEX_SPECIAL = set(".^$*+?{}[]\\|()")
+_ESCAPED_LITERALS = set("./-_~:=&%@!,;'\"#<> ")
+_QUANTIFIERS = set("*+?{")
+
+def literal_prefix(pattern:str) -> str:
+    """
+    The literal text every match of `pattern` has to start with, if the pattern is anchored
+    with `^` (e.g. `^/api/v1/.*` gives `/api/v1/`), else "". Conservative: anything unusual,
+    such as alternations, gives "".
+    """
+    if not pattern.startswith("^") or "|" in pattern:
+        return ""
+    prefix = []
+    i = 1
+    while i < len(pattern):
+        char = pattern[i]
+        width = 1
+        if char == "\\":
+            if i + 1 < len(pattern) and pattern[i + 1] in _ESCAPED_LITERALS:
+                char = pattern[i + 1]
+                width = 2
+            else:
+                break
+        elif char in _REGEX_SPECIAL:
+            break
+        # a quantifier makes this character optional (or repeatable), so stop before it
+        if i + width < len(pattern) and pattern[i + width] in _QUANTIFIERS:
+            break
+        prefix.append(char)
+        i += width
+    return "".join(prefix)
+
+
+def required_literal(pattern:str, flags:int = 0, min_length:int = 2) -> str:
+    """
+    The longest literal text every match of `pattern` has to contain (e.g. `.json` for
+    `/files/.*\\.json$`), or "" when there's none of at least `min_length` characters.
+    Case insensitive patterns have none, since the literal has to appear as is.
+    """
+    try:
+        parsed = _sre_parse.parse(pattern, flags)
+    except Exception:
+        return ""
+    if parsed.state.flags & re.IGNORECASE:
+        return ""
+
+    # only the top level sequence is guaranteed to be part of every match,
+    # runs of literals there are broken up by anything else (repeats, groups, classes...)
+    longest = ""
+    run = []
+    for op, av in list(parsed) + [(None, None)]:
+        if op is _sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        if len(run) > len(longest):
+            longest = "".join(run)
+        run = []
+    return longest if len(longest) >= min_length else ""
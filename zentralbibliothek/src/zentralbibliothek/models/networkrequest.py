@@ -67,6 +67,14 @@ class NetworkRequest(ABC):
         '''
         pass
 
+    @property
+    def response_key(self):
+        '''Return the fields of this request that `default_response` depends on, as something
+        hashable, so responses of deterministic rules can be reused across requests with the same
+        key. The default, None, never reuses responses.
+        '''
+        return None
+
     @property
     @abstractmethod
     def default_response(self):
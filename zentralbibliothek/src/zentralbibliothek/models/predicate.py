@@ -1,5 +1,5 @@
-
 from abc import ABC, abstractmethod
+from .matcher import Matcher
 from .networkrequest import NetworkRequest
 
 class Predicate(ABC):
@@ -9,4 +9,16 @@ class Predicate(ABC):
     @classmethod
     @abstractmethod
     def satisfied_by(cls, request:NetworkRequest, parameter:str):
-        pass
\ No newline at end of file
+        pass
+
+    @classmethod
+    def compile(cls, parameter:str) -> Matcher:
+        """
+        Turn the parameter into a `Matcher`, once per rule version rather than on every request.
+        Override this to do the parsing up front (split lists, compile regexes, decode JSON...),
+        and raise ValueError for a parameter that can never be evaluated, such as an invalid
+        regex: the rule is then rejected when it's compiled.
+
+        The default simply defers to `satisfied_by`.
+        """
+        return Matcher(test=lambda request: cls.satisfied_by(request, parameter))
@@ -23,4 +23,30 @@ class Result(ABC):
         :return: The "updated" common result_data to pass to the next result.
         :rtype: dict
         '''
-        pass
\ No newline at end of file
+        pass
+
+    @classmethod
+    def parse(cls, parameter:str):
+        '''Turn the stored parameter into what `execute` receives. This runs once when a rule is
+        compiled rather than on every request, so do any decoding (e.g. JSON) here. Raise if the
+        parameter is invalid; the result will be left out of the rule.
+
+        Whatever is returned is shared by all requests, so `execute` must not modify it.
+
+        :param parameter: The parameter as stored in the rule.
+        :type parameter: str
+        :return: The parameter to pass to `execute`.
+        '''
+        return parameter
+
+    @classmethod
+    def deterministic(cls, parameter) -> bool:
+        '''Return True when `execute` with this (parsed) parameter always does the same thing to the
+        same default response: no randomness, no network calls, nothing taken from the request but
+        the zone. When all results of a rule are deterministic, the response it builds is reused
+        for requests with the same `NetworkRequest.response_key`.
+
+        :param parameter: The parameter as returned by `parse`.
+        :return: False by default, results have to opt in.
+        '''
+        return False
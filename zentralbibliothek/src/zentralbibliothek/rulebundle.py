@@ -0,0 +1,416 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+# aka.ms/dusseldorf
+
+import itertools
+import logging
+import os
+import re
+import time
+from typing import Callable
+from attr import Factory, dataclass
+from .models.matcher import COST_DEFAULT, Dispatch
+from .models.networkrequest import NetworkRequest
+from .models.predicate import Predicate
+from .models.result import Result
+
+logger = logging.getLogger('dssldrf.ruleengine')
+
+# results with these action names run after all the others
+DEFERRED_RESULTS = ('var',)
+
+# rules without a priority go last
+DEFAULT_PRIORITY = 1 << 31
+
+# responses kept per deterministic rule, e.g. one per DNS name and type, and for how long:
+# default responses can change too (e.g. the default IP of a domain)
+MAX_MEMOIZED_RESPONSES = 1024
+MEMOIZED_RESPONSE_TTL = 60
+
+class PredicateTimings:
+    """
+    Measured evaluation time per predicate (by action name), as an exponentially weighted
+    moving average. Rules compiled afterwards use it to order predicates that have the same
+    estimated cost class.
+
+    Timing every call would cost more than it saves, so this is off unless
+    DSSLDRF_PREDICATE_TIMING is set, and then only 1 in `sample_every` matches is timed.
+    """
+    def __init__(self, enabled:bool = False, sample_every:int = 64, alpha:float = 0.1) -> None:
+        self.enabled = enabled
+        self.sample_every = max(1, sample_every)
+        self.alpha = alpha
+        self._averages:dict = {}
+        self._counter = itertools.count()
+
+    @classmethod
+    def from_env(cls) -> "PredicateTimings":
+        enabled:str = os.environ.get("DSSLDRF_PREDICATE_TIMING", "0")
+        return cls(
+            enabled=enabled.lower() in ("true", "1", "on", "y", "yes"),
+            sample_every=int(os.environ.get("DSSLDRF_PREDICATE_TIMING_SAMPLE", 64)),
+        )
+
+    def should_sample(self) -> bool:
+        return self.enabled and next(self._counter) % self.sample_every == 0
+
+    def record(self, action_name:str, seconds:float) -> None:
+        average = self._averages.get(action_name)
+        self._averages[action_name] = seconds if average is None else average + self.alpha * (seconds - average)
+
+    def estimate(self, action_name:str) -> float:
+        """
+        Average seconds per evaluation, 0 when it was never measured.
+        """
+        return self._averages.get(action_name, 0.0)
+
+    def stats(self) -> dict:
+        return {name: round(seconds * 1e6, 3) for name, seconds in self._averages.items()}
+
+
+PREDICATE_TIMINGS = PredicateTimings.from_env()
+
+
+@dataclass(frozen=True, slots=True)
+class CompiledRule:
+    """
+    A rule with its predicates compiled into matchers and its result parameters parsed,
+    ready to be evaluated without going back to the database.
+    """
+    rule_id:str
+    priority:int
+    predicates:tuple
+    """(action name, predicate class, compiled matcher) for every known predicate, cheapest first"""
+    results:tuple
+    """(component id, action name, result class, parsed parameter), deferred results last"""
+    deterministic:bool = False
+    """all results are deterministic, so built responses are memoized"""
+    responses:dict = Factory(dict)
+    """NetworkRequest.response_key -> (response, expiry), for deterministic rules"""
+
+    def satisfied_by(self, request:NetworkRequest) -> bool:
+        for _, _, matcher in self.predicates:
+            if not matcher(request):
+                return False
+        return True
+
+    def satisfied_by_timed(self, request:NetworkRequest, timings:PredicateTimings) -> bool:
+        for action_name, _, matcher in self.predicates:
+            start = time.perf_counter()
+            satisfied = matcher(request)
+            timings.record(action_name, time.perf_counter() - start)
+            if not satisfied:
+                return False
+        return True
+
+    def make_response(self, request:NetworkRequest):
+        """
+        Build the response to `request`. Responses of deterministic rules are built once per
+        response key and then shared, so callers must not modify them.
+        """
+        if not self.deterministic:
+            return self._build_response(request)
+        key = request.response_key
+        if key is None:
+            return self._build_response(request)
+
+        now = time.monotonic()
+        memoized = self.responses.get(key)
+        if memoized is not None and memoized[1] > now:
+            return memoized[0]
+
+        response = self._build_response(request)
+        if len(self.responses) >= MAX_MEMOIZED_RESPONSES:
+            self.responses.clear()
+        self.responses[key] = (response, now + MEMOIZED_RESPONSE_TTL)
+        return response
+
+    def _build_response(self, request:NetworkRequest):
+        response_obj = request.default_response
+        result_data = {
+            'response': response_obj,
+            'zone': request.zone_fqdn,
+            'metadata': {
+                'rule_id': self.rule_id
+            },
+            'request': request
+        }
+
+        for component_id, action_name, result_class, parameter in self.results:
+            if action_name not in DEFERRED_RESULTS:
+                result_data['metadata']['component_id'] = component_id
+            result_class.execute(result_data, parameter)
+
+        return result_data['response']
+
+
+# a scan stops counting after this many occurrences and can't rule anything out, so a body
+# full of one common literal doesn't cost more than evaluating the rules would
+SCAN_MAX_HITS = 1000
+
+
+def _exact_lookup(by_value:dict, hinted:int) -> Callable:
+    def lookup(value) -> int:
+        try:
+            return by_value.get(value, 0)
+        except TypeError:
+            return hinted
+    return lookup
+
+
+def _prefix_lookup(by_length:tuple, hinted:int) -> Callable:
+    def lookup(value) -> int:
+        if not isinstance(value, str):
+            return hinted
+        mask = 0
+        for length, by_prefix in by_length:
+            if length > len(value):
+                break
+            mask |= by_prefix.get(value[:length], 0)
+        return mask
+    return lookup
+
+
+def _scan_lookup(scanner:re.Pattern, masks:dict, hinted:int) -> Callable:
+    def lookup(value) -> int:
+        if not isinstance(value, str):
+            return hinted
+        mask = 0
+        for hits, found in enumerate(scanner.finditer(value)):
+            mask |= masks[found.group(1)]
+            if mask == hinted or hits >= SCAN_MAX_HITS:
+                return hinted
+        return mask
+    return lookup
+
+
+def compile_scanner(literals:dict):
+    """
+    Build a scanner that finds which of the `literals` ({literal: mask}) a text contains, in a
+    single pass.
+
+    The scanner is a lookahead over an alternation of all literals, longest first, so at every
+    position it reports the longest literal found there. Every literal that is a prefix of that
+    one was found at the same position as well, so their masks are folded into its mask.
+    There's a single capturing group on purpose: sre saves all group marks on every branch, so a
+    named group per literal makes the scan quadratic in the number of literals.
+
+    Returns:
+        (scanner, masks): the compiled scanner, and the mask for every literal it can report.
+    """
+    ordered = sorted(literals, key=len, reverse=True)
+    masks = {}
+    for literal in ordered:
+        mask = 0
+        for other, other_mask in literals.items():
+            if literal.startswith(other):
+                mask |= other_mask
+        masks[literal] = mask
+    alternation = "|".join(re.escape(literal) for literal in ordered)
+    return re.compile(f"(?=({alternation}))"), masks
+
+
+class RuleIndex:
+    """
+    Narrows down the rules of a bundle to the ones that can match a request, using the
+    `Dispatch` hints of their predicates (HTTP method, TLS, DNS type, path prefix, ...).
+
+    Candidate sets are bitmasks over rule positions. Per key, the value of the request is
+    looked up once: in a dict for accepted values, by length for literal prefixes, and with a
+    single scan for the literals that regexes require. Only the remaining candidates are
+    evaluated, still in priority order. Rules without a hint for a key are candidates for every
+    value of that key.
+    """
+    __slots__ = ("_all", "_keys")
+
+    def __init__(self, rules:tuple) -> None:
+        self._all = (1 << len(rules)) - 1
+
+        # key -> (value function, {position: dispatch})
+        hints:dict = {}
+        for position, rule in enumerate(rules):
+            for _, _, matcher in rule.predicates:
+                dispatch:Dispatch = getattr(matcher, "dispatch", None)
+                if dispatch is None or (dispatch.accepts is None and not dispatch.prefix and not dispatch.contains):
+                    continue
+                # one necessary condition per key and rule is enough to narrow things down,
+                # the full predicates are evaluated on the candidates anyway
+                hints.setdefault(dispatch.key, (dispatch.value, {}))[1].setdefault(position, dispatch)
+
+        # (key, value function, ((rules without this kind of hint, lookup), ...))
+        keys = []
+        for key, (get_value, by_position) in hints.items():
+            exact:dict = {}
+            prefixes:dict = {}
+            literals:dict = {}
+            for position, dispatch in by_position.items():
+                bit = 1 << position
+                if dispatch.accepts is not None:
+                    for value in dispatch.accepts:
+                        exact[value] = exact.get(value, 0) | bit
+                elif dispatch.prefix:
+                    by_prefix = prefixes.setdefault(len(dispatch.prefix), {})
+                    by_prefix[dispatch.prefix] = by_prefix.get(dispatch.prefix, 0) | bit
+                elif dispatch.contains:
+                    literals[dispatch.contains] = literals.get(dispatch.contains, 0) | bit
+
+            filters = []
+            if exact:
+                hinted = self._union(exact.values())
+                filters.append((self._all & ~hinted, _exact_lookup(exact, hinted)))
+            if prefixes:
+                hinted = self._union(m for by_prefix in prefixes.values() for m in by_prefix.values())
+                filters.append((self._all & ~hinted, _prefix_lookup(tuple(sorted(prefixes.items())), hinted)))
+            if literals:
+                hinted = self._union(literals.values())
+                scanner, masks = compile_scanner(literals)
+                filters.append((self._all & ~hinted, _scan_lookup(scanner, masks, hinted)))
+            if filters:
+                keys.append((key, get_value, tuple(filters)))
+
+        self._keys = tuple(keys)
+
+    @staticmethod
+    def _union(masks) -> int:
+        union = 0
+        for mask in masks:
+            union |= mask
+        return union
+
+    def __bool__(self) -> bool:
+        return bool(self._keys)
+
+    def candidates(self, request:NetworkRequest) -> int:
+        """
+        The bitmask of rules that might match `request`.
+        """
+        mask = self._all
+        for _, get_value, filters in self._keys:
+            try:
+                value = get_value(request)
+            except Exception:
+                # can't tell, so don't rule anything out
+                continue
+            for unhinted, lookup in filters:
+                mask &= unhinted | lookup(value)
+            if not mask:
+                break
+        return mask
+
+
+@dataclass(frozen=True, slots=True)
+class RuleBundle:
+    """
+    All the rules of one zone for one network protocol, sorted by priority.
+    Built from a single query and cached (and invalidated) as a unit.
+    """
+    zone:str
+    protocol:str
+    rules:tuple
+    version:object
+    """the storage cache's zone version at build time, or None when there is no cache"""
+    built:float
+    index:RuleIndex = None
+
+    def match(self, request:NetworkRequest):
+        """
+        The first rule, by priority, that `request` satisfies, or None.
+        """
+        rules = self.rules
+        timed = PREDICATE_TIMINGS.enabled and PREDICATE_TIMINGS.should_sample()
+        if not self.index:
+            for rule in rules:
+                if rule.satisfied_by_timed(request, PREDICATE_TIMINGS) if timed else rule.satisfied_by(request):
+                    return rule
+            return None
+
+        mask = self.index.candidates(request)
+        while mask:
+            lowest = mask & -mask
+            rule = rules[lowest.bit_length() - 1]
+            if rule.satisfied_by_timed(request, PREDICATE_TIMINGS) if timed else rule.satisfied_by(request):
+                return rule
+            mask ^= lowest
+        return None
+
+    @classmethod
+    def compile(cls, zone:str, protocol:str, rule_docs:list, predicate_class_mappings:dict,
+                result_class_mappings:dict, version=None) -> "RuleBundle":
+        """
+        Compile the rule documents of a zone, as stored in the `rules` collection.
+        """
+        compiled = []
+        for position, doc in enumerate(rule_docs):
+            rule = cls._compile_rule(doc, predicate_class_mappings, result_class_mappings)
+            if rule is not None:
+                compiled.append((rule.priority, position, rule))
+
+        compiled.sort(key=lambda item: (item[0], item[1]))
+        rules = tuple(rule for _, _, rule in compiled)
+        return cls(zone=zone, protocol=protocol, rules=rules, version=version,
+                   built=time.monotonic(), index=RuleIndex(rules))
+
+    @classmethod
+    def _compile_rule(cls, doc:dict, predicate_class_mappings:dict, result_class_mappings:dict):
+        components = doc.get("rulecomponents") or []
+        predicate_components = [c for c in components if c.get("ispredicate")]
+
+        # a rule without predicates never matches
+        if not predicate_components:
+            return None
+
+        predicates = []
+        for comp in predicate_components:
+            predicate_class:Predicate = predicate_class_mappings.get(comp["actionname"], None)
+            if predicate_class is None:
+                logger.warning(f"Unknown predicate type `{comp['actionname']}`")
+                continue
+            try:
+                matcher = predicate_class.compile(comp["actionvalue"])
+            except ValueError as ex:
+                # a predicate that can't be evaluated means the rule can never match as intended
+                logger.warning(f"Rejecting rule {doc.get('ruleid')}, invalid `{comp['actionname']}` predicate: {ex}")
+                return None
+            predicates.append((comp["actionname"], predicate_class, matcher))
+
+        # all predicates have to hold, so evaluating the cheap ones first doesn't change the
+        # outcome, it just turns down most requests before the expensive ones run.
+        # the sort is stable, predicates that cost the same keep their stored order.
+        predicates.sort(key=lambda p: (getattr(p[2], "cost", COST_DEFAULT), PREDICATE_TIMINGS.estimate(p[0])))
+
+        results = []
+        deferred = []
+        for comp in components:
+            if comp.get("ispredicate"):
+                continue
+            result_class:Result = result_class_mappings.get(comp["actionname"], None)
+            if result_class is None:
+                logger.warning(f"Unknown result action `{comp['actionname']}`")
+                continue
+            try:
+                parameter = result_class.parse(comp["actionvalue"])
+            except Exception as ex:
+                logger.warning(f"Invalid parameter for result `{comp['actionname']}` in rule {doc.get('ruleid')}: {ex}")
+                continue
+            entry = (comp.get("componentid"), comp["actionname"], result_class, parameter)
+            (deferred if comp["actionname"] in DEFERRED_RESULTS else results).append(entry)
+
+        results += deferred
+        deterministic = True
+        for _, _, result_class, parameter in results:
+            try:
+                deterministic = result_class.deterministic(parameter)
+            except Exception:
+                deterministic = False
+            if not deterministic:
+                break
+
+        priority = doc.get("priority")
+        return CompiledRule(
+            rule_id=doc.get("ruleid"),
+            priority=priority if isinstance(priority, int) else DEFAULT_PRIORITY,
+            predicates=tuple(predicates),
+            results=tuple(results),
+            deterministic=deterministic,
+        )
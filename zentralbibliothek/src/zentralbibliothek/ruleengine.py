@@ -3,12 +3,15 @@
 
 # aka.ms/dusseldorf
 
-import logging, os
+import logging, os, threading, time
 
+from cachetools import LRUCache
 from zentralbibliothek.dbclient3 import DatabaseClient
 from .models.networkrequest import NetworkRequest
 from .models.predicate import Predicate
 from .models.result import Result
+from .rulebundle import RuleBundle
+from .saferegex import regex_budget
 from azure.monitor.opentelemetry import configure_azure_monitor
 
 if os.environ.get("APPLICATIONINSIGHTS_CONNECTION_STRING"):
@@ -22,8 +25,14 @@ class RuleEngine:
     """
     This class is responsible for calculating what the response to a request should be, based on the 
     rules that have been set up. 
-    """
 
+    The rules of a zone are compiled into a `RuleBundle` with a single query, and cached as a unit.
+    With the storage cache enabled a bundle is rebuilt when the zone's rules change, otherwise it
+    lives for BUNDLE_TTL seconds.
+    """
+    BUNDLE_TTL:float = 1
+    _bundles:LRUCache = LRUCache(maxsize=1024)
+    _bundles_lock = threading.Lock()
 
     @classmethod
     def get_response_from_request(cls, request:NetworkRequest, predicate_class_mappings:dict, result_class_mappings:dict):
@@ -31,70 +40,49 @@ class RuleEngine:
         This is the only method you need to call from your listener. 
         It will always return a response of the same type as `request.default_response`.
         """
-        db = DatabaseClient.get_instance()
-        predicate_sets = db.get_aggregated_rule_predicates_for_zone(request.NetworkProtocol, request.ZoneFqdn)
-        
-        for rule_id, action_name_list, action_value_list in predicate_sets: 
-            if (cls.satisfies_predicate_list(request, action_name_list, action_value_list, predicate_class_mappings)):
-                return cls.make_result_from_rule(rule_id, request, result_class_mappings)
+        bundle = cls.get_rule_bundle(request.NetworkProtocol, request.ZoneFqdn, predicate_class_mappings, result_class_mappings)
+
+        # regexes of all the rules share one time budget per request
+        with regex_budget():
+            rule = bundle.match(request)
+        if rule is not None:
+            return rule.make_response(request)
         return request.default_response
-    
+
     @classmethod
-    def satisfies_predicate_list(cls, request:NetworkRequest, action_names:list, action_value:list, predicate_class_mappings:dict) -> bool:
+    def get_rule_bundle(cls, network_protocol:str, zone_fqdn:str, predicate_class_mappings:dict, result_class_mappings:dict) -> RuleBundle:
         """
-        Internal.
-        
-        Take in a list of predicate action names and a list of corresponding action values, and see if the request
-        fulfills all of them.
+        Get the compiled rules of a zone, building them if they're missing or out of date.
         """
-        for predicate_name, predicate_param in zip(action_names, action_value):
-            predicate_class:Predicate = predicate_class_mappings.get(predicate_name, None)
-            
-            if predicate_class is None:
-                logger.warning(f"Unknown predicate type `{predicate_name}`")
-                continue
-            
-            if not predicate_class.satisfied_by(request, predicate_param):
-                return False
-        return True
-
-    @classmethod
-    def make_result_from_rule(cls, rule_id:str, request:NetworkRequest, result_class_mappings):
         db = DatabaseClient.get_instance()
+        version = db.rules_version(zone_fqdn)
+        key = (network_protocol, zone_fqdn)
 
-        result_set = db.get_aggregated_rule_results(rule_id)
-        result_pairs = zip(result_set[1], result_set[2], result_set[3])
-
-        response_obj = request.default_response
-        result_data = {            
-            'response': response_obj,
-            'zone': request.zone_fqdn,
-            'metadata': {
-                'rule_id': rule_id
-            },
-            'request': request
-        }
+        with cls._bundles_lock:
+            bundle:RuleBundle = cls._bundles.get(key)
+        if bundle is not None and cls._is_current(bundle, version):
+            return bundle
 
-        execute_these_last = []
-
-        for result_component_id, result_action_name, result_parameter in result_pairs:
-            result_action_class:Result = result_class_mappings.get(result_action_name, None)
-            
-            if result_action_class is None:
-                logger.warning(f"Unknown result action `{result_action_name}`")
-                continue
-
-            if result_action_name in ['var']:
-                execute_these_last.append((result_action_class, result_parameter))
-                continue
-
-            result_data['metadata']['component_id'] = result_component_id
-            result_action_class.execute(result_data, result_parameter)
-
-        # do all the ones we pushed to the back
-        for result_action_class, result_parameter in execute_these_last:
-            result_action_class.execute(result_data, result_parameter)
-        
-        return result_data['response']
+        rule_docs = db.get_rules_for_zone(network_protocol, zone_fqdn)
+        bundle = RuleBundle.compile(zone_fqdn, network_protocol, rule_docs, predicate_class_mappings, result_class_mappings, version)
+        with cls._bundles_lock:
+            cls._bundles[key] = bundle
+        return bundle
 
+    @classmethod
+    def invalidate(cls, zone_fqdn:str = None):
+        """
+        Drop the compiled rules of a zone (or of all zones), they'll be rebuilt on the next request.
+        """
+        with cls._bundles_lock:
+            if zone_fqdn is None:
+                cls._bundles.clear()
+                return
+            for key in [k for k in cls._bundles.keys() if k[1] == zone_fqdn]:
+                del cls._bundles[key]
 
+    @classmethod
+    def _is_current(cls, bundle:RuleBundle, version) -> bool:
+        if version is None:
+            return bundle.version is None and time.monotonic() - bundle.built < cls.BUNDLE_TTL
+        return bundle.version == version
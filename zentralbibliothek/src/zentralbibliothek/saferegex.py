@@ -0,0 +1,383 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+# aka.ms/dusseldorf
+
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from .models.matcher import compile_regex
+
+try:
+    import re._parser as _sre_parse
+except ImportError: # python < 3.11
+    import sre_parse as _sre_parse
+
+try:
+    # the `regex` module can time out a search, which `re` can't
+    import regex as _regex_module
+except ImportError:
+    _regex_module = None
+
+logger = logging.getLogger('dssldrf.saferegex')
+
+class RegexLimits:
+    """
+    How much regex work rules may do, see `SafeRegex`.
+
+        timeout           seconds a single search may take
+        request_budget    seconds all searches for one request may take together
+        max_scan          characters all searches for one request may scan together
+        quarantine_after  after this many searches over the timeout in a row, a regex is
+                          quarantined (never matches) for `quarantine_for` seconds; 0 turns
+                          quarantining off
+        sandboxes         worker processes for risky patterns when the `regex` module isn't
+                          installed; 0 runs them inline
+    """
+    def __init__(self, timeout:float = 0.1, request_budget:float = 0.25, max_scan:int = 50_000_000,
+                 quarantine_after:int = 0, quarantine_for:float = 300.0, sandboxes:int = 2) -> None:
+        self.timeout = timeout
+        self.request_budget = request_budget
+        self.max_scan = max_scan
+        self.quarantine_after = quarantine_after
+        self.quarantine_for = quarantine_for
+        self.sandboxes = sandboxes
+
+    @classmethod
+    def from_env(cls) -> "RegexLimits":
+        """
+        Limits configured through the DSSLDRF_REGEX_* environment variables.
+        """
+        return cls(
+            timeout=int(os.environ.get("DSSLDRF_REGEX_TIMEOUT_MS", 100)) / 1000,
+            request_budget=int(os.environ.get("DSSLDRF_REGEX_REQUEST_BUDGET_MS", 250)) / 1000,
+            max_scan=int(os.environ.get("DSSLDRF_REGEX_MAX_SCAN", 50_000_000)),
+            quarantine_after=int(os.environ.get("DSSLDRF_REGEX_QUARANTINE_AFTER", 0)),
+            quarantine_for=float(os.environ.get("DSSLDRF_REGEX_QUARANTINE_S", 300)),
+            sandboxes=int(os.environ.get("DSSLDRF_REGEX_SANDBOXES", 2)),
+        )
+
+
+LIMITS = RegexLimits.from_env()
+
+_counters = Counter()
+_counters_lock = threading.Lock()
+
+def _count(name:str) -> None:
+    with _counters_lock:
+        _counters[name] += 1
+
+def stats() -> dict:
+    """
+    Counters: over_budget (over the timeout), request_budget (skipped because the request ran
+    out of time or scan budget), quarantined (skipped because quarantined), quarantines
+    (regexes put in quarantine) and sandboxed (searches run in a worker process).
+    """
+    with _counters_lock:
+        return dict(_counters)
+
+
+# region per request budget
+
+class _Budget:
+    __slots__ = ("deadline", "scan_left")
+
+    def __init__(self, deadline:float, scan_left:int) -> None:
+        self.deadline = deadline
+        self.scan_left = scan_left
+
+_budget:ContextVar = ContextVar("dssldrf_regex_budget", default=None)
+
+@contextmanager
+def regex_budget(limits:RegexLimits = None):
+    """
+    Give the searches done within this block a shared time and scan budget.
+    Contexts are per thread (and per asyncio task), so every request gets its own.
+
+    >>> with regex_budget():
+    >>>     rule = bundle.match(request)
+    """
+    limits = limits or LIMITS
+    token = _budget.set(_Budget(time.monotonic() + limits.request_budget, limits.max_scan))
+    try:
+        yield
+    finally:
+        _budget.reset(token)
+
+# endregion
+
+
+# region risky patterns
+
+_REPEATS = (_sre_parse.MAX_REPEAT, _sre_parse.MIN_REPEAT)
+_GROUPREFS = (_sre_parse.GROUPREF, _sre_parse.GROUPREF_EXISTS)
+
+def _has_branch(items) -> bool:
+    for op, av in items:
+        if op is _sre_parse.BRANCH:
+            return True
+        if op is _sre_parse.SUBPATTERN and _has_branch(av[-1]):
+            return True
+    return False
+
+def _is_risky(items, in_repeat:bool) -> bool:
+    unbounded = 0
+    for op, av in items:
+        if op in _GROUPREFS:
+            return True
+        if op in _REPEATS:
+            _, high, sub = av
+            if high == _sre_parse.MAXREPEAT:
+                # (a+)+ and (a|ab)* backtrack exponentially
+                if in_repeat or _has_branch(sub):
+                    return True
+                unbounded += 1
+            if _is_risky(sub, in_repeat or high == _sre_parse.MAXREPEAT):
+                return True
+        elif op is _sre_parse.SUBPATTERN:
+            if _is_risky(av[-1], in_repeat):
+                return True
+        elif op is _sre_parse.BRANCH:
+            if any(_is_risky(branch, in_repeat) for branch in av[1]):
+                return True
+        elif op in (_sre_parse.ASSERT, _sre_parse.ASSERT_NOT):
+            if _is_risky(av[1], in_repeat):
+                return True
+    # a.*b.*c backtracks polynomially on long inputs
+    return unbounded > 1
+
+@lru_cache(maxsize=4096)
+def is_risky(pattern:str, flags:int = 0) -> bool:
+    """
+    Whether `pattern` can backtrack catastrophically: nested unbounded repeats, unbounded
+    repeats over alternations, backreferences, or several unbounded repeats in a row.
+    This is a heuristic, patterns it doesn't flag are still timed.
+    """
+    try:
+        return _is_risky(_sre_parse.parse(pattern, flags), False)
+    except Exception:
+        return True
+
+# endregion
+
+
+# region sandbox
+
+def _sandbox_main(conn) -> None:
+    """
+    Internal. Runs in the worker process: search and reply until the pipe closes.
+    """
+    import re
+    compiled = lru_cache(maxsize=256)(re.compile)
+    conn.send("ready")
+    while True:
+        try:
+            pattern, flags, text = conn.recv()
+        except (EOFError, OSError):
+            return
+        conn.send(compiled(pattern, flags).search(text) is not None)
+
+
+class _Sandbox:
+    """
+    A worker process that runs risky searches. When one runs over its timeout the process is
+    killed, since regex matching can't be interrupted otherwise.
+    """
+    START_TIMEOUT = 30.0
+
+    def __init__(self) -> None:
+        self._process = None
+        self._conn = None
+
+    @property
+    def running(self) -> bool:
+        return self._process is not None and self._process.is_alive()
+
+    def start(self) -> None:
+        context = multiprocessing.get_context("spawn")
+        parent, child = context.Pipe()
+        self._process = context.Process(target=_sandbox_main, args=(child,), name="dssldrf-regex-sandbox", daemon=True)
+        self._process.start()
+        child.close()
+        self._conn = parent
+        if not parent.poll(self.START_TIMEOUT) or parent.recv() != "ready":
+            self.kill()
+            raise RuntimeError("regex sandbox didn't start")
+
+    def kill(self) -> None:
+        if self._process is not None:
+            self._process.kill()
+            self._process.join(1)
+        if self._conn is not None:
+            self._conn.close()
+        self._process = None
+        self._conn = None
+
+    def search(self, pattern:str, flags:int, text:str, timeout:float):
+        """
+        Returns whether the pattern was found, or None when it ran out of time.
+        """
+        self._conn.send((pattern, flags, text))
+        if self._conn.poll(timeout):
+            return self._conn.recv()
+        self.kill()
+        return None
+
+
+class _SandboxPool:
+    """
+    The sandboxes, started (and restarted after a kill) in the background so no search has
+    to wait for a process to start.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._idle = queue.Queue()
+        self._size = 0
+        self.broken = False
+
+    def warm(self, size:int) -> None:
+        with self._lock:
+            missing = size - self._size
+            self._size = max(self._size, size)
+        for _ in range(missing):
+            self._restart(_Sandbox())
+
+    def _restart(self, sandbox:_Sandbox) -> None:
+        def start():
+            try:
+                sandbox.start()
+            except Exception as ex:
+                if not self.broken:
+                    logger.warning(f"Failed to start regex sandbox, risky patterns will run inline: {ex}")
+                self.broken = True
+            finally:
+                self._idle.put(sandbox)
+        threading.Thread(target=start, name="dssldrf-regex-sandbox-start", daemon=True).start()
+
+    def search(self, pattern:str, flags:int, text:str, timeout:float):
+        """
+        Returns whether the pattern was found, or None when it ran out of time (waiting for a
+        free sandbox included). Raises RuntimeError when sandboxes can't be started.
+        """
+        if self.broken:
+            raise RuntimeError("regex sandboxes are unavailable")
+        deadline = time.monotonic() + timeout
+        try:
+            sandbox:_Sandbox = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if not sandbox.running:
+            self._restart(sandbox)
+            return None
+        try:
+            return sandbox.search(pattern, flags, text, max(0.0, deadline - time.monotonic()))
+        except Exception:
+            sandbox.kill()
+            raise
+        finally:
+            if sandbox.running:
+                self._idle.put(sandbox)
+            else:
+                self._restart(sandbox)
+
+
+_SANDBOXES = _SandboxPool()
+
+# endregion
+
+
+class SafeRegex:
+    """
+    A user supplied regex that is searched within a time budget, for predicates that run
+    against attacker controlled input (bodies of up to 10MB).
+
+    A search that takes longer than `limits.timeout`, or doesn't fit in what is left of the
+    request's budget (see `regex_budget()`), counts as not found and is counted in `stats()`.
+    When the `regex` module is installed, searches are cut off at the timeout. Otherwise `re`
+    can't be interrupted, so patterns that can backtrack catastrophically (see `is_risky()`)
+    run in a worker process that is killed when it runs over, and the others are timed after
+    the fact.
+
+    Raises ValueError for an invalid pattern, like `compile_regex()`.
+    """
+    def __init__(self, pattern:str, flags:int = 0, limits:RegexLimits = None) -> None:
+        self.pattern = pattern
+        self.flags = flags
+        self.limits = limits
+        self.regex = compile_regex(pattern, flags)
+        self.risky = is_risky(pattern, flags)
+
+        self._timed = None
+        if _regex_module is not None:
+            try:
+                self._timed = _regex_module.compile(pattern, flags)
+            except Exception:
+                pass
+
+        self._strikes = 0
+        self._quarantined_until = 0.0
+
+        limits = limits or LIMITS
+        if self._timed is None and self.risky and limits.sandboxes > 0:
+            _SANDBOXES.warm(limits.sandboxes)
+
+    @property
+    def quarantined(self) -> bool:
+        return self._quarantined_until > time.monotonic()
+
+    def found(self, text:str) -> bool:
+        """
+        Whether the pattern is found in `text`, within budget.
+        """
+        limits = self.limits or LIMITS
+        if self._quarantined_until and self.quarantined:
+            _count("quarantined")
+            return False
+
+        timeout = limits.timeout
+        budget:_Budget = _budget.get()
+        if budget is not None:
+            remaining = budget.deadline - time.monotonic()
+            if remaining <= 0 or len(text) > budget.scan_left:
+                _count("request_budget")
+                return False
+            budget.scan_left -= len(text)
+            timeout = min(timeout, remaining)
+
+        start = time.monotonic()
+        found = self._search(text, timeout, limits)
+        if found is None or time.monotonic() - start > timeout:
+            self._over_budget(limits)
+            return False
+        self._strikes = 0
+        return found
+
+    def _search(self, text:str, timeout:float, limits:RegexLimits):
+        if self._timed is not None:
+            try:
+                return self._timed.search(text, timeout=timeout) is not None
+            except TimeoutError:
+                return None
+        if self.risky and limits.sandboxes > 0:
+            _count("sandboxed")
+            try:
+                return _SANDBOXES.search(self.pattern, self.flags, text, timeout)
+            except Exception as ex:
+                logger.debug(f"Regex sandbox failed, searching inline: {ex}")
+        return self.regex.search(text) is not None
+
+    def _over_budget(self, limits:RegexLimits) -> None:
+        _count("over_budget")
+        self._strikes += 1
+        if limits.quarantine_after and self._strikes >= limits.quarantine_after:
+            self._quarantined_until = time.monotonic() + limits.quarantine_for
+            self._strikes = 0
+            _count("quarantines")
+            logger.warning(f"Quarantined regex `{self.pattern}` for {limits.quarantine_for}s, it ran over budget {limits.quarantine_after} times in a row")
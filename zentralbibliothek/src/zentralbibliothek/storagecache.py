@@ -0,0 +1,343 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+# aka.ms/dusseldorf
+
+import itertools
+import logging
+import threading
+import time
+from typing import Callable
+from pymongo import errors
+from .zoneindex import ZoneIndex
+
+logger = logging.getLogger('dssldrf.storagecache')
+
+# mongo refuses change streams on a standalone server with this code
+_CHANGE_STREAMS_UNSUPPORTED = (40573, 40324)
+
+class StorageCache:
+    """
+    An in-process copy of the `domains`, `zones` and `rules` collections.
+
+    Everything is loaded once on `start()`. After that, a background thread follows a Mongo
+    change stream and applies inserts, updates, replaces and deletes as they happen, so reads on
+    the hot path never touch the network and edits show up within milliseconds.
+    When change streams are unavailable (e.g. a standalone mongod without a replica set) the
+    thread falls back to a full resync every `resync_interval` seconds. While following a stream
+    it still resyncs every `full_resync_interval` seconds, and whenever the stream is invalidated,
+    so an event that got lost can't leave the cache stale until a restart.
+
+    Every change bumps a version: `zone_version(zone)` changes whenever the zone or any of its
+    rules change, `domains_version` whenever a domain changes and `zones_version` whenever a zone
+    is added, changed or removed. Other caches can key on these,
+    or `subscribe()` to be told about changes as they are applied.
+    """
+    COLLECTIONS = ("domains", "zones", "rules")
+
+    def __init__(self, get_db:Callable, resync_interval:float = 5.0, use_change_streams:bool = True, full_resync_interval:float = 300.0) -> None:
+        self._get_db = get_db
+        self.resync_interval = resync_interval
+        self.full_resync_interval = full_resync_interval
+        self.use_change_streams = use_change_streams
+        self.mode:str = "starting"
+
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._ready = threading.Event()
+        self._thread:threading.Thread = None
+        self._subscribers:list = []
+        self._counter = itertools.count(1)
+
+        # domain name -> doc, and the list of names for get_domains()
+        self._domains:dict = {}
+        self._domain_names:tuple = ()
+        self._domain_ids:dict = {}
+
+        # zone fqdn (lowercase) -> doc, plus the reverse index used for lookups
+        self._zones:dict = {}
+        self._zone_ids:dict = {}
+        self.zone_index = ZoneIndex()
+
+        # rule _id -> doc, ruleid -> doc and zone fqdn -> tuple of rule docs
+        self._rules:dict = {}
+        self._rules_by_ruleid:dict = {}
+        self._rules_by_zone:dict = {}
+
+        self._zone_versions:dict = {}
+        self.domains_version:int = 0
+        self.zones_version:int = 0
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def start(self, wait:float = 10.0) -> None:
+        """
+        Start following the database in the background, and wait (at most `wait` seconds) for
+        the initial load to complete.
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="dssldrf-storage-cache", daemon=True)
+        self._thread.start()
+        if not self._ready.wait(wait):
+            logger.warning("storage cache not loaded yet, falling back to database reads")
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def subscribe(self, callback:Callable[[str, str], None]) -> None:
+        """
+        Register `callback(kind, key)` to be called after a change was applied.
+        `kind` is "domain" (key is the domain) or "zone" (key is the zone fqdn, also used for
+        changes to the zone's rules).
+        """
+        self._subscribers.append(callback)
+
+    def put(self, collection:str, doc:dict) -> None:
+        """
+        Write-through for documents this process just stored, so they're visible right away
+        instead of whenever the change stream (or the next resync) catches up.
+        """
+        self._apply({"operationType": "replace", "ns": {"coll": collection}, "documentKey": {"_id": doc["_id"]}, "fullDocument": doc})
+
+    def delete(self, collection:str, _id) -> None:
+        """
+        Write-through for documents this process just deleted.
+        """
+        self._apply({"operationType": "delete", "ns": {"coll": collection}, "documentKey": {"_id": _id}})
+
+    # region reads
+
+    def get_domains(self) -> list:
+        return list(self._domain_names)
+
+    def get_domain(self, domain:str):
+        return self._domains.get(domain)
+
+    def get_zone(self, zone_fqdn:str):
+        return self._zones.get(zone_fqdn.lower())
+
+    def find_zone(self, request_fqdn:str):
+        return self.zone_index.find(request_fqdn)
+
+    def get_rules(self, zone_fqdn:str) -> tuple:
+        return self._rules_by_zone.get(zone_fqdn, ())
+
+    def get_rule(self, rule_id:str):
+        return self._rules_by_ruleid.get(str(rule_id))
+
+    def zone_version(self, zone_fqdn:str) -> int:
+        return self._zone_versions.get(zone_fqdn.lower(), 0)
+
+    # endregion
+
+    # region background thread
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                if self.use_change_streams:
+                    self._follow()
+                else:
+                    self._poll()
+            except errors.OperationFailure as ex:
+                if ex.code in _CHANGE_STREAMS_UNSUPPORTED:
+                    logger.info("change streams are not supported, resyncing the storage cache periodically")
+                    self.use_change_streams = False
+                    continue
+                logger.warning(f"storage cache change stream failed: {ex}")
+            except Exception as ex:
+                logger.warning(f"storage cache failed to sync: {ex}")
+
+            # the stream will be retried, but make sure readers have data in the meantime
+            try:
+                self._load()
+            except Exception as ex:
+                logger.warning(f"storage cache failed to load: {ex}")
+            self._stop.wait(self.resync_interval)
+
+    def _follow(self) -> None:
+        """
+        Internal. Open a change stream, (re)load everything, then apply changes as they come.
+        The stream is opened before loading so no change can slip in between the two.
+        """
+        pipeline = [{"$match": {"ns.coll": {"$in": list(self.COLLECTIONS)}}}]
+        with self._get_db().watch(pipeline, full_document="updateLookup", max_await_time_ms=1000) as stream:
+            self._load()
+            self.mode = "changestream"
+            loaded = time.monotonic()
+            while not self._stop.is_set() and stream.alive:
+                change = stream.try_next()
+                if change is not None:
+                    self._apply(change)
+                    if change.get("operationType") == "invalidate":
+                        # the stream is closed for good, _run() reloads and opens a new one
+                        return
+                if time.monotonic() - loaded >= self.full_resync_interval:
+                    self._load()
+                    loaded = time.monotonic()
+
+    def _poll(self) -> None:
+        self.mode = "poll"
+        while not self._stop.is_set():
+            self._load()
+            self._stop.wait(self.resync_interval)
+
+    # endregion
+
+    # region applying changes
+
+    def _load(self) -> None:
+        """
+        Internal. Full resync, versions are only bumped for what actually changed.
+        """
+        db = self._get_db()
+        domains = list(db.domains.find())
+        zones = list(db.zones.find())
+        rules = list(db.rules.find())
+
+        changed = []
+        with self._lock:
+            old_domains = dict(self._domain_ids)
+            if old_domains != {d["_id"]: d for d in domains}:
+                self._domains = {}
+                self._domain_ids = {}
+                for doc in domains:
+                    self._put_domain(doc)
+                self._domain_names = tuple(self._domains.keys())
+                changed += [("domain", d.get("domain")) for d in domains + list(old_domains.values())]
+                self._bump_domains()
+
+            old_zones = dict(self._zone_ids)
+            new_zones = {z["_id"]: z for z in zones}
+            if old_zones != new_zones:
+                self._zones = {}
+                self._zone_ids = {}
+                for doc in zones:
+                    self._put_zone(doc)
+                self.zone_index.rebuild(z["fqdn"] for z in zones if z.get("fqdn"))
+                self._bump_zones()
+                for _id in set(old_zones) | set(new_zones):
+                    if old_zones.get(_id) != new_zones.get(_id):
+                        changed.append(("zone", (old_zones.get(_id) or new_zones[_id]).get("fqdn")))
+
+            old_by_zone = self._rules_by_zone
+            self._rules = {}
+            self._rules_by_ruleid = {}
+            by_zone:dict = {}
+            for doc in rules:
+                self._rules[doc["_id"]] = doc
+                self._rules_by_ruleid[str(doc.get("ruleid"))] = doc
+                by_zone.setdefault(doc.get("zone"), []).append(doc)
+            self._rules_by_zone = {zone: tuple(docs) for zone, docs in by_zone.items()}
+            for zone in set(old_by_zone) | set(self._rules_by_zone):
+                if old_by_zone.get(zone, ()) != self._rules_by_zone.get(zone, ()):
+                    changed.append(("zone", zone))
+
+            for kind, key in changed:
+                if kind == "zone" and key:
+                    self._bump_zone(key)
+
+        self._ready.set()
+        self._notify(changed)
+
+    def _apply(self, change:dict) -> None:
+        """
+        Internal. Apply a single change stream event.
+        """
+        op = change.get("operationType")
+        coll = change.get("ns", {}).get("coll")
+        _id = change.get("documentKey", {}).get("_id")
+        doc = change.get("fullDocument")
+
+        if op in ("drop", "dropDatabase", "rename", "invalidate"):
+            self._load()
+            return
+        if op not in ("insert", "update", "replace", "delete"):
+            return
+
+        changed = []
+        with self._lock:
+            if coll == "domains":
+                old = self._domain_ids.pop(_id, None)
+                if old is not None:
+                    self._domains.pop(old.get("domain"), None)
+                    changed.append(("domain", old.get("domain")))
+                if doc is not None and op != "delete":
+                    self._put_domain(doc)
+                    changed.append(("domain", doc.get("domain")))
+                self._domain_names = tuple(self._domains.keys())
+                self._bump_domains()
+
+            elif coll == "zones":
+                old = self._zone_ids.pop(_id, None)
+                if old is not None and old.get("fqdn"):
+                    fqdn = old["fqdn"].lower()
+                    # more than one document can carry the same fqdn
+                    if not any(z.get("fqdn", "").lower() == fqdn for z in self._zone_ids.values()):
+                        self._zones.pop(fqdn, None)
+                        self.zone_index.remove(old["fqdn"])
+                    changed.append(("zone", old["fqdn"]))
+                if doc is not None and op != "delete":
+                    self._put_zone(doc)
+                    if doc.get("fqdn"):
+                        self.zone_index.add(doc["fqdn"])
+                        changed.append(("zone", doc["fqdn"]))
+                self._bump_zones()
+
+            elif coll == "rules":
+                old = self._rules.pop(_id, None)
+                if old is not None:
+                    self._rules_by_ruleid.pop(str(old.get("ruleid")), None)
+                    self._set_zone_rules(old.get("zone"), [r for r in self.get_rules(old.get("zone")) if r["_id"] != _id])
+                    changed.append(("zone", old.get("zone")))
+                if doc is not None and op != "delete":
+                    self._rules[_id] = doc
+                    self._rules_by_ruleid[str(doc.get("ruleid"))] = doc
+                    others = [r for r in self.get_rules(doc.get("zone")) if r["_id"] != _id]
+                    self._set_zone_rules(doc.get("zone"), others + [doc])
+                    changed.append(("zone", doc.get("zone")))
+
+            for kind, key in changed:
+                if kind == "zone" and key:
+                    self._bump_zone(key)
+
+        self._notify(changed)
+
+    def _put_domain(self, doc:dict) -> None:
+        self._domain_ids[doc["_id"]] = doc
+        if doc.get("domain"):
+            self._domains[doc["domain"]] = doc
+
+    def _put_zone(self, doc:dict) -> None:
+        self._zone_ids[doc["_id"]] = doc
+        if doc.get("fqdn"):
+            self._zones[doc["fqdn"].lower()] = doc
+
+    def _set_zone_rules(self, zone_fqdn:str, docs:list) -> None:
+        # readers iterate these without a lock, so always swap in a new tuple
+        if docs:
+            self._rules_by_zone[zone_fqdn] = tuple(docs)
+        else:
+            self._rules_by_zone.pop(zone_fqdn, None)
+
+    def _bump_zone(self, zone_fqdn:str) -> None:
+        self._zone_versions[zone_fqdn.lower()] = next(self._counter)
+
+    def _bump_domains(self) -> None:
+        self.domains_version = next(self._counter)
+
+    def _bump_zones(self) -> None:
+        self.zones_version = next(self._counter)
+
+    def _notify(self, changed:list) -> None:
+        for kind, key in dict.fromkeys(c for c in changed if c[1]):
+            for callback in self._subscribers:
+                try:
+                    callback(kind, key)
+                except Exception as ex:
+                    logger.warning(f"storage cache subscriber failed: {ex}")
+
+    # endregion
@@ -0,0 +1,62 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+# aka.ms/dusseldorf
+
+import logging
+import multiprocessing
+import signal
+import socket
+import sys
+import threading
+from typing import Callable
+
+logger = logging.getLogger('dssldrf.workers')
+
+def run_workers(target:Callable, workers:int, name:str = "worker", check_interval:float = 1.0, **kwargs) -> int:
+    """
+    Run `target(reuse_port=True, **kwargs)` in `workers` processes that share a port through
+    SO_REUSEPORT, so the kernel spreads the traffic over them, and supervise them: workers that
+    die are restarted, and all of them are stopped when this process is interrupted or gets
+    SIGTERM (e.g. from systemd).
+
+    `target` must be a module level function, workers are spawned (not forked) so every one sets
+    up its own database client and threads. Returns the exit code for the listener.
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        logger.critical("SO_REUSEPORT isn't available here, run a single worker instead")
+        return -1
+
+    context = multiprocessing.get_context("spawn")
+    kwargs["reuse_port"] = True
+    stop = threading.Event()
+
+    def start(index:int):
+        process = context.Process(target=target, kwargs=kwargs, name=f"{name}-{index}", daemon=True)
+        process.start()
+        return process
+
+    previous = None
+    if threading.current_thread() is threading.main_thread():
+        previous = signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    processes = [start(i) for i in range(workers)]
+    logger.info(f"Started {workers} {name}s")
+    try:
+        while not stop.wait(check_interval):
+            for i, process in enumerate(processes):
+                if not process.is_alive():
+                    logger.warning(f"{name} {i} exited with {process.exitcode}, restarting it")
+                    processes[i] = start(i)
+            sys.stderr.flush()
+            sys.stdout.flush()
+        return 0
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(5)
+        if previous is not None:
+            signal.signal(signal.SIGTERM, previous)
@@ -0,0 +1,114 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+# aka.ms/dusseldorf
+
+import threading
+from typing import Iterable
+
+# key under which a trie node stores the zone that ends at that node.
+# not a string, so no label of a (possibly malformed) request name can clash with it.
+_ZONE = object()
+
+class ZoneIndex:
+    """
+    An in-memory reverse-label trie of zone FQDNs.
+
+    The zone `sahil.ssrf.ms` is stored as the path `ms -> ssrf -> sahil`, so finding the zone
+    for `hello.sahil.ssrf.ms` is a walk over the labels of the request, right to left, keeping
+    the deepest zone seen on the way. That is O(labels) regardless of the number of zones.
+
+    Lookups don't take a lock; writers serialise on an internal lock and `rebuild` swaps in a
+    whole new trie at once.
+    """
+    def __init__(self, zones:Iterable[str] = ()) -> None:
+        self._lock = threading.Lock()
+        self._root:dict = {}
+        self._count:int = 0
+        self.rebuild(zones)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __contains__(self, zone_fqdn:str) -> bool:
+        node = self._root
+        for label in reversed(zone_fqdn.lower().split(".")):
+            node = node.get(label)
+            if node is None:
+                return False
+        return _ZONE in node
+
+    def find(self, request_fqdn:str):
+        """
+        Find the longest zone that `request_fqdn` falls under.
+
+        Returns:
+            str: the fqdn of the zone, as it was added.
+            None: when no zone matches.
+        """
+        node = self._root
+        found = None
+        for label in reversed(request_fqdn.lower().rstrip(".").split(".")):
+            node = node.get(label)
+            if node is None:
+                break
+            found = node.get(_ZONE, found)
+        return found
+
+    def add(self, zone_fqdn:str) -> bool:
+        """
+        Add a zone to the index. Returns False if it was already there.
+        """
+        labels = zone_fqdn.lower().rstrip(".").split(".")
+        with self._lock:
+            node = self._root
+            for label in reversed(labels):
+                node = node.setdefault(label, {})
+            if _ZONE in node:
+                return False
+            node[_ZONE] = zone_fqdn
+            self._count += 1
+            return True
+
+    def remove(self, zone_fqdn:str) -> bool:
+        """
+        Remove a zone from the index, pruning branches that became empty.
+        Returns False if it wasn't there.
+        """
+        labels = zone_fqdn.lower().rstrip(".").split(".")
+        with self._lock:
+            path = [(None, self._root)]
+            node = self._root
+            for label in reversed(labels):
+                node = node.get(label)
+                if node is None:
+                    return False
+                path.append((label, node))
+            if node.pop(_ZONE, None) is None:
+                return False
+            self._count -= 1
+
+            # prune empty nodes from the leaf upwards
+            for i in range(len(path) - 1, 0, -1):
+                label, node = path[i]
+                if node:
+                    break
+                del path[i - 1][1][label]
+            return True
+
+    def rebuild(self, zones:Iterable[str]) -> None:
+        """
+        Replace the contents of the index with `zones`.
+        """
+        root:dict = {}
+        count:int = 0
+        for zone_fqdn in zones:
+            node = root
+            for label in reversed(zone_fqdn.lower().rstrip(".").split(".")):
+                node = node.setdefault(label, {})
+            if _ZONE not in node:
+                node[_ZONE] = zone_fqdn
+                count += 1
+        with self._lock:
+            self._root = root
+            self._count = count
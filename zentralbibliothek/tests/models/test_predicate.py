@@ -2,6 +2,7 @@
 # Licensed under the MIT License.
 
 import pytest
+from zentralbibliothek.models.matcher import ALWAYS, compile_regex, literal_prefix, required_literal
 from zentralbibliothek.models.predicate import Predicate
 
 def test_predicate_successful():
@@ -28,4 +29,44 @@ def test_predicate_missingmethods():
             super().__init__()
 
     with pytest.raises(TypeError):
-        test_predicate = TestPredicate()
\ No newline at end of file
+        test_predicate = TestPredicate()
+
+def test_predicate_default_compile():
+    '''
+    Without a compile override, the matcher defers to satisfied_by.
+    '''
+    class TestPredicate(Predicate):
+        @classmethod
+        def satisfied_by(cls, request, parameter):
+            return request == parameter
+
+    matcher = TestPredicate.compile("expected")
+    assert matcher("expected")
+    assert not matcher("something else")
+
+def test_compile_regex_rejects_invalid_patterns():
+    assert compile_regex("^/a+$").search("/aaa")
+    with pytest.raises(ValueError):
+        compile_regex("(unclosed")
+
+def test_always_matcher():
+    assert ALWAYS("anything")
+
+def test_literal_prefix():
+    assert literal_prefix("^/api/v1/.*") == "/api/v1/"
+    assert literal_prefix(r"^/a\.json$") == "/a.json"
+    # the quantified character is optional, so it's not part of the prefix
+    assert literal_prefix("^/ab*") == "/a"
+    assert literal_prefix("^/ab?c") == "/a"
+    # unanchored or alternations can match anywhere
+    assert literal_prefix("/api") == ""
+    assert literal_prefix("^/a|/b") == ""
+
+def test_required_literal():
+    assert required_literal(r"/files/.*\.json$") == "/files/"
+    assert required_literal(r"^/x/.*\.json$") == ".json"
+    # anything optional, alternated or case insensitive can't be required as is
+    assert required_literal("ab*c") == ""
+    assert required_literal("abc|def") == ""
+    assert required_literal("(?i)admin") == ""
+    assert required_literal("(unclosed") == ""
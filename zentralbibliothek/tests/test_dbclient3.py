@@ -4,9 +4,13 @@
 import os
 import random
 import string
+import time
+import mongomock
 import pytest
+from bson import ObjectId
 from zentralbibliothek.dbclient3 import DatabaseClient
 from zentralbibliothek.utils import Utils
+from zentralbibliothek.zoneindex import ZoneIndex
 
 # only run DB tests if we have a connection string
 # from https://docs.pytest.org/en/6.2.x/skipping.html
@@ -160,3 +164,38 @@ def test_delete_domain(db):
     ret  = db.delete_domain("nonexisting")
     assert ret.acknowledged == True
     assert ret.deleted_count == 0
+
+
+def test_find_zone_miss_outside_domains_skips_database(monkeypatch):
+    # no connection needed: the zone index is already loaded
+    db = DatabaseClient.__new__(DatabaseClient)
+    db._zone_index = ZoneIndex(["sahil.ssrf.ms"])
+    db._zone_index_rebuilt = time.monotonic()
+    updates = []
+    monkeypatch.setattr(db, "get_domains", lambda: ["ssrf.ms"])
+    monkeypatch.setattr(db, "_update_zone_index", lambda: updates.append(1))
+
+    assert db.find_zone_for_request("x.sahil.ssrf.ms") == "sahil.ssrf.ms"
+    assert db.find_zone_for_request("random.evil.com") is None
+    assert updates == []
+    # a new zone could have been created under one of our domains
+    assert db.find_zone_for_request("new.ssrf.ms") is None
+    assert updates == [1]
+
+
+def test_update_zone_index_overlaps_same_second(monkeypatch):
+    db = DatabaseClient.__new__(DatabaseClient)
+    db._db = mongomock.MongoClient().dssldrf
+    monkeypatch.setattr(db, "guarantee_connectivity", lambda: None)
+
+    # two processes create zones in the same second, the later one with the lower id
+    first = ObjectId("65f000000000000000000fff")
+    second = ObjectId("65f000000000000000000001")
+    db._db.zones.insert_one({"_id": first, "fqdn": "first.ssrf.ms"})
+    db._rebuild_zone_index()
+    db._db.zones.insert_one({"_id": second, "fqdn": "second.ssrf.ms"})
+    db._update_zone_index()
+
+    assert db._zone_index.find("x.second.ssrf.ms") == "second.ssrf.ms"
+    assert len(db._zone_index) == 2
+    assert db._zone_index_last_id == first
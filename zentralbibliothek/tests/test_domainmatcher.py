@@ -0,0 +1,30 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from zentralbibliothek.domainmatcher import DomainMatcher
+from zentralbibliothek.utils import Utils
+
+def test_domainmatcher_match():
+    matcher = DomainMatcher(["ssrf.ms", "sub.ssrf.ms", "other.net"])
+    assert matcher.match("ssrf.ms") == "ssrf.ms"
+    assert matcher.match("a.b.SSRF.ms") == "ssrf.ms"
+    assert matcher.match("x.sub.ssrf.ms") == "sub.ssrf.ms"
+    assert matcher.is_valid("foo.other.net.")
+    assert not matcher.is_valid("xssrf.ms")
+    assert not matcher.is_valid("ssrf.ms.evil.com")
+    assert not matcher.is_valid("")
+    assert not DomainMatcher().is_valid("ssrf.ms")
+
+def test_domainmatcher_invalid_names():
+    matcher = DomainMatcher(["ssrf.ms"])
+    assert not matcher.is_valid("_dmarc.ssrf.ms")
+    assert not matcher.is_valid("-a.ssrf.ms")
+    assert not matcher.is_valid("a..ssrf.ms")
+    assert not matcher.is_valid("foo.ssrf.ms:8080")
+
+def test_domainmatcher_agrees_with_utils():
+    names = ["foo.ssrf.ms", "FOO.ssrf.ms", "a..b", "foo.", "_dmarc.ssrf.ms", "-a.b", "a-.b",
+             "a--b.c", "xn--nxasmq6b.com", "xn--abc.com", "1.2.3.4", "a" * 62 + ".b", "a" * 63 + ".b",
+             "bücher.de", ".a", "a b.c", "*.a.b", "x" * 256]
+    for name in names:
+        assert DomainMatcher.valid_name(name) == Utils.valid_dns_label(name), name
@@ -0,0 +1,96 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import threading
+import pytest
+from zentralbibliothek.interactionwriter import InteractionWriter
+
+class Sink:
+    '''
+    Collects batches instead of writing them to the database.
+    '''
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, docs):
+        self.batches.append(list(docs))
+        return len(docs)
+
+    @property
+    def docs(self):
+        return [doc for batch in self.batches for doc in batch]
+
+
+def test_writer_flushes_by_size():
+    sink = Sink()
+    writer = InteractionWriter(sink, batch_size=10, flush_interval=60)
+    for i in range(25):
+        writer.submit({"i": i})
+    writer.close()
+    assert [doc["i"] for doc in sink.docs] == list(range(25))
+    assert all(len(batch) <= 10 for batch in sink.batches)
+
+
+def test_writer_flushes_by_time():
+    sink = Sink()
+    writer = InteractionWriter(sink, batch_size=1000, flush_interval=0.01)
+    writer.submit({"i": 1})
+    for _ in range(100):
+        if sink.docs:
+            break
+        threading.Event().wait(0.01)
+    assert sink.docs == [{"i": 1}]
+    writer.close()
+
+
+def test_writer_drop_oldest():
+    sink = Sink()
+    writer = InteractionWriter(sink, batch_size=1000, flush_interval=60, max_queue=3, policy="drop_oldest")
+    for i in range(5):
+        assert writer.submit({"i": i})
+    writer.close()
+    assert [doc["i"] for doc in sink.docs] == [2, 3, 4]
+    assert writer.stats()["dropped"] == 2
+
+
+def test_writer_sample():
+    sink = Sink()
+    writer = InteractionWriter(sink, batch_size=1000, flush_interval=60, max_queue=2, policy="sample", sample_every=2)
+    accepted = [writer.submit({"i": i}) for i in range(6)]
+    writer.close()
+    # the first two fit, after that only every second overflowing one is kept
+    assert accepted == [True, True, False, True, False, True]
+    assert len(sink.docs) == 2
+
+
+def test_writer_block_times_out():
+    sink = Sink()
+    writer = InteractionWriter(sink, batch_size=1000, flush_interval=60, max_queue=1, policy="block", block_timeout=0.01)
+    assert writer.submit({"i": 1})
+    assert writer.submit({"i": 2}) is False
+    writer.close()
+    assert writer.stats()["dropped"] == 1
+
+
+def test_writer_counts_failures():
+    def failing_sink(docs):
+        raise RuntimeError("db down")
+    writer = InteractionWriter(failing_sink, batch_size=2, flush_interval=60)
+    writer.submit({"i": 1})
+    writer.submit({"i": 2})
+    writer.close()
+    stats = writer.stats()
+    assert stats["failed"] == 2
+    assert stats["written"] == 0
+    assert stats["queue_depth"] == 0
+
+
+def test_writer_rejects_after_close():
+    writer = InteractionWriter(Sink())
+    writer.close()
+    assert writer.submit({"i": 1}) is False
+
+
+def test_writer_unknown_policy():
+    with pytest.raises(ValueError):
+        InteractionWriter(Sink(), policy="yolo")
@@ -0,0 +1,279 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import json
+from zentralbibliothek.models.matcher import COST_BODY, COST_LOOKUP, Dispatch, Matcher, compile_regex, literal_prefix, required_literal
+from zentralbibliothek.models.predicate import Predicate
+from zentralbibliothek.models.result import Result
+from zentralbibliothek.rulebundle import PredicateTimings, RuleBundle, compile_scanner
+
+class Request:
+    '''
+    A minimal request, the bundle only needs these.
+    '''
+    def __init__(self, path, method="get"):
+        self.path = path
+        self.method = method
+        self.zone_fqdn = "zone.test.net"
+
+    @property
+    def default_response(self):
+        return {"body": "", "steps": []}
+
+    @property
+    def response_key(self):
+        return ()
+
+class PathStartsWith(Predicate):
+    @classmethod
+    def satisfied_by(cls, request, parameter):
+        return request.path.startswith(parameter)
+
+class SetBody(Result):
+    @classmethod
+    def deterministic(cls, parameter):
+        return True
+
+    @classmethod
+    def execute(cls, result_data, parameter):
+        result_data["response"]["body"] = parameter
+        result_data["response"]["steps"].append("body")
+        return result_data
+
+class SetJson(Result):
+    @classmethod
+    def parse(cls, parameter):
+        return json.loads(parameter)
+
+    @classmethod
+    def execute(cls, result_data, parameter):
+        result_data["response"]["json"] = parameter
+        return result_data
+
+class Var(Result):
+    @classmethod
+    def execute(cls, result_data, parameter):
+        result_data["response"]["steps"].append("var")
+        return result_data
+
+def _path(request):
+    return request.path
+
+def _method(request):
+    return request.method
+
+class IndexedPath(Predicate):
+    @classmethod
+    def compile(cls, parameter):
+        regex = compile_regex(parameter)
+        prefix = literal_prefix(parameter)
+        return Matcher(test=lambda request: bool(regex.search(request.path)),
+                       dispatch=Dispatch(key="path", value=_path, prefix=prefix or None, contains=required_literal(parameter) or None))
+
+class IndexedMethod(Predicate):
+    @classmethod
+    def compile(cls, parameter):
+        methods = frozenset(parameter.split(","))
+        return Matcher(test=lambda request: request.method in methods,
+                       dispatch=Dispatch(key="method", value=_method, accepts=methods))
+
+PREDICATES = {"path": PathStartsWith}
+INDEXED = {"path": IndexedPath, "method": IndexedMethod}
+RESULTS = {"body": SetBody, "json": SetJson, "var": Var}
+
+def _rule(ruleid, priority, components):
+    return {
+        "ruleid": ruleid,
+        "priority": priority,
+        "rulecomponents": [
+            {"componentid": f"{ruleid}-{i}", "ispredicate": p, "actionname": n, "actionvalue": v}
+            for i, (p, n, v) in enumerate(components)
+        ],
+    }
+
+def _first_match(bundle, request):
+    for rule in bundle.rules:
+        if rule.satisfied_by(request):
+            return rule
+    return None
+
+
+def test_bundle_sorted_by_priority():
+    bundle = RuleBundle.compile("zone.test.net", "http", [
+        _rule("late", 20, [(True, "path", "/"), (False, "body", "late")]),
+        _rule("early", 10, [(True, "path", "/a"), (False, "body", "early")]),
+        _rule("nopriority", None, [(True, "path", "/"), (False, "body", "last")]),
+    ], PREDICATES, RESULTS)
+    assert [r.rule_id for r in bundle.rules] == ["early", "late", "nopriority"]
+    assert _first_match(bundle, Request("/abc")).rule_id == "early"
+    assert _first_match(bundle, Request("/xyz")).rule_id == "late"
+
+
+def test_bundle_skips_rules_without_predicates():
+    bundle = RuleBundle.compile("zone.test.net", "http", [
+        _rule("results-only", 1, [(False, "body", "never")]),
+    ], PREDICATES, RESULTS)
+    assert bundle.rules == ()
+
+
+def test_bundle_ignores_unknown_predicates():
+    bundle = RuleBundle.compile("zone.test.net", "http", [
+        _rule("r", 1, [(True, "nope", "x"), (True, "path", "/a"), (False, "body", "b")]),
+    ], PREDICATES, RESULTS)
+    assert [p[0] for p in bundle.rules[0].predicates] == ["path"]
+
+
+def test_bundle_parses_result_parameters_once():
+    bundle = RuleBundle.compile("zone.test.net", "http", [
+        _rule("r", 1, [(True, "path", "/"), (False, "json", '{"a": 1}'), (False, "json", "not json"), (False, "unknown", "x")]),
+    ], PREDICATES, RESULTS)
+    rule = bundle.rules[0]
+    # the invalid and the unknown results are dropped
+    assert [(r[1], r[3]) for r in rule.results] == [("json", {"a": 1})]
+    assert rule.make_response(Request("/"))["json"] == {"a": 1}
+
+
+def test_bundle_runs_var_last():
+    bundle = RuleBundle.compile("zone.test.net", "http", [
+        _rule("r", 1, [(True, "path", "/"), (False, "var", "a:b"), (False, "body", "hi")]),
+    ], PREDICATES, RESULTS)
+    response = bundle.rules[0].make_response(Request("/"))
+    assert response["body"] == "hi"
+    assert response["steps"] == ["body", "var"]
+
+
+def test_bundle_rejects_rules_with_invalid_predicates():
+    class RegexPath(Predicate):
+        @classmethod
+        def compile(cls, parameter):
+            regex = compile_regex(parameter)
+            return Matcher(test=lambda request: bool(regex.search(request.path)))
+
+        @classmethod
+        def satisfied_by(cls, request, parameter):
+            return cls.compile(parameter)(request)
+
+    bundle = RuleBundle.compile("zone.test.net", "http", [
+        _rule("broken", 1, [(True, "regex", "(unclosed"), (False, "body", "x")]),
+        _rule("fine", 2, [(True, "regex", "^/ok"), (False, "body", "y")]),
+    ], {"regex": RegexPath}, RESULTS)
+    assert [r.rule_id for r in bundle.rules] == ["fine"]
+    assert bundle.rules[0].satisfied_by(Request("/ok"))
+
+
+def test_bundle_index_keeps_priority_order():
+    bundle = RuleBundle.compile("zone.test.net", "http", [
+        _rule("post-api", 1, [(True, "method", "post"), (True, "path", "^/api/"), (False, "body", "a")]),
+        _rule("any-api", 2, [(True, "path", "^/api/v1"), (False, "body", "b")]),
+        _rule("get", 3, [(True, "method", "get,head"), (False, "body", "c")]),
+        _rule("catch-all", 4, [(True, "path", "."), (False, "body", "d")]),
+    ], INDEXED, RESULTS)
+    assert bundle.index
+    assert bundle.match(Request("/api/v1/x", "post")).rule_id == "post-api"
+    assert bundle.match(Request("/api/v1/x", "get")).rule_id == "any-api"
+    assert bundle.match(Request("/api/v2", "get")).rule_id == "get"
+    assert bundle.match(Request("/api/v2", "put")).rule_id == "catch-all"
+    assert bundle.match(Request("", "put")) is None
+
+
+def test_bundle_index_agrees_with_linear_scan():
+    rules = []
+    for i in range(40):
+        components = [(True, "path", f"^/p{i % 7}/" if i % 3 else "x$")]
+        if i % 2:
+            components.append((True, "method", "get" if i % 4 == 1 else "post,put"))
+        rules.append(_rule(f"r{i}", 100 - i, components + [(False, "body", str(i))]))
+    bundle = RuleBundle.compile("zone.test.net", "http", rules, INDEXED, RESULTS)
+
+    for method in ("get", "post", "put", "delete"):
+        for path in ("/p1/a", "/p3/", "/p6/x", "/p9/", "/x", "/p2", ""):
+            request = Request(path, method)
+            assert bundle.match(request) is _first_match(bundle, request)
+
+
+def test_bundle_without_hints_has_no_index():
+    bundle = RuleBundle.compile("zone.test.net", "http", [
+        _rule("r", 1, [(True, "path", "/"), (False, "body", "b")]),
+    ], PREDICATES, RESULTS)
+    assert not bundle.index
+    assert bundle.match(Request("/x")).rule_id == "r"
+
+
+def test_bundle_evaluates_cheap_predicates_first():
+    calls = []
+
+    class Body(Predicate):
+        @classmethod
+        def compile(cls, parameter):
+            return Matcher(test=lambda request: calls.append("body") or False, cost=COST_BODY)
+
+    class Method(Predicate):
+        @classmethod
+        def compile(cls, parameter):
+            return Matcher(test=lambda request: calls.append("method") or request.method == parameter, cost=COST_LOOKUP)
+
+    bundle = RuleBundle.compile("zone.test.net", "http", [
+        _rule("r", 1, [(True, "body", "x"), (True, "path", "/"), (True, "method", "post"), (False, "body", "b")]),
+    ], {"body": Body, "method": Method, "path": PathStartsWith}, RESULTS)
+    assert [p[0] for p in bundle.rules[0].predicates] == ["method", "path", "body"]
+
+    # the method doesn't match, so the body is never looked at
+    assert bundle.match(Request("/", "get")) is None
+    assert calls == ["method"]
+
+
+def test_predicate_timings():
+    timings = PredicateTimings(enabled=True, sample_every=2, alpha=0.5)
+    assert [timings.should_sample() for _ in range(4)] == [True, False, True, False]
+    assert timings.estimate("http.body") == 0.0
+    timings.record("http.body", 4.0)
+    timings.record("http.body", 2.0)
+    assert timings.estimate("http.body") == 3.0
+    assert not PredicateTimings().should_sample()
+
+
+def test_compile_scanner_reports_every_literal_found():
+    scanner, masks = compile_scanner({"admin": 1, "adm": 2, "min": 4, ".php": 8, "nope": 16})
+    found = 0
+    for match in scanner.finditer("/admin/index.php"):
+        found |= masks[match.group(1)]
+    # `adm` starts at the same position as `admin` and `min` overlaps it, both are still reported
+    assert found == 1 | 2 | 4 | 8
+
+
+def test_bundle_scans_for_required_literals():
+    paths = ["^/a/", "bb$", "cc", r"(dd)\1", "(?i)/EE", "^/f", r"\d+/gg", "x*"]
+    bundle = RuleBundle.compile("zone.test.net", "http", [
+        _rule(f"r{i}", i, [(True, "path", path), (False, "body", str(i))]) for i, path in enumerate(paths)
+    ], INDEXED, RESULTS)
+    assert bundle.index
+    for path in ("/a/bb", "/xbb", "/cc", "/dddd", "/ee", "/f", "/1/gg", "/gg", "/zzz", ""):
+        request = Request(path)
+        assert bundle.match(request) is _first_match(bundle, request)
+
+
+def test_bundle_memoizes_deterministic_responses():
+    bundle = RuleBundle.compile("zone.test.net", "http", [
+        _rule("static", 1, [(True, "path", "/static"), (False, "body", "hi")]),
+        _rule("dynamic", 2, [(True, "path", "/"), (False, "body", "hi"), (False, "var", "a:b")]),
+    ], PREDICATES, RESULTS)
+    static, dynamic = bundle.rules
+    assert static.deterministic
+    # Var doesn't say it's deterministic
+    assert not dynamic.deterministic
+
+    response = static.make_response(Request("/static"))
+    assert response["body"] == "hi"
+    assert static.make_response(Request("/static/other")) is response
+    assert dynamic.make_response(Request("/x")) is not dynamic.make_response(Request("/x"))
+
+
+def test_bundle_doesnt_memoize_without_response_key():
+    class Unkeyed(Request):
+        response_key = None
+
+    bundle = RuleBundle.compile("zone.test.net", "http", [
+        _rule("static", 1, [(True, "path", "/"), (False, "body", "hi")]),
+    ], PREDICATES, RESULTS)
+    rule = bundle.rules[0]
+    assert rule.make_response(Unkeyed("/")) is not rule.make_response(Unkeyed("/"))
@@ -0,0 +1,71 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import time
+import pytest
+from zentralbibliothek import saferegex
+from zentralbibliothek.saferegex import RegexLimits, SafeRegex, is_risky, regex_budget
+
+def test_is_risky():
+    assert is_risky("(a+)+$")
+    assert is_risky("(a|ab)*c")
+    assert is_risky(r"(\w)\1")
+    assert is_risky(".*a.*b")
+    assert not is_risky("^/api/.*")
+    assert not is_risky("(?:ab)+c")
+    assert not is_risky("x{2,5}y")
+
+
+def test_saferegex_found():
+    regex = SafeRegex("^/api/v[0-9]")
+    assert regex.found("/api/v1/users")
+    assert not regex.found("/web")
+    with pytest.raises(ValueError):
+        SafeRegex("(unclosed")
+
+
+def test_saferegex_request_budget():
+    limits = RegexLimits(timeout=1, request_budget=1, max_scan=10)
+    regex = SafeRegex("b", limits=limits)
+    before = saferegex.stats().get("request_budget", 0)
+    with regex_budget(limits):
+        assert regex.found("aaaab")
+        # only 5 characters left to scan for this request
+        assert not regex.found("aaaaaab")
+    assert saferegex.stats()["request_budget"] == before + 1
+    # outside of a request there is no shared budget
+    assert regex.found("aaaaaab")
+
+
+def test_saferegex_quarantine():
+    # nothing fits in a zero timeout, so every search is over budget
+    limits = RegexLimits(timeout=0, quarantine_after=2, quarantine_for=60, sandboxes=0)
+    regex = SafeRegex("a", limits=limits)
+    assert not regex.found("a")
+    assert not regex.quarantined
+    assert not regex.found("a")
+    assert regex.quarantined
+
+    limits.timeout = 10
+    assert not regex.found("a")
+    assert saferegex.stats()["quarantines"] >= 1
+
+
+def test_saferegex_stops_catastrophic_backtracking():
+    limits = RegexLimits(timeout=0.5, request_budget=10, sandboxes=1)
+    regex = SafeRegex("(a+)+$", limits=limits)
+    assert regex.risky
+
+    # wait for the sandbox to start (or the regex module to take over)
+    deadline = time.monotonic() + 30
+    while not regex.found("aaa") and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    start = time.monotonic()
+    assert not regex.found("a" * 40 + "!")
+    assert time.monotonic() - start < 5
+    # the sandbox is restarted after being killed
+    deadline = time.monotonic() + 30
+    while not regex.found("aaa") and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert regex.found("aaa")
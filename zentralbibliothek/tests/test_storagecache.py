@@ -0,0 +1,138 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import pytest
+from zentralbibliothek.storagecache import StorageCache
+
+class FakeCollection:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self):
+        return list(self.docs)
+
+class FakeDb:
+    '''
+    Just enough of a database for StorageCache._load().
+    '''
+    def __init__(self):
+        self.domains = FakeCollection([{"_id": 1, "domain": "ssrf.ms", "public_ips": ["1.2.3.4"]}])
+        self.zones = FakeCollection([{"_id": 10, "fqdn": "sahil.ssrf.ms", "domain": "ssrf.ms"}])
+        self.rules = FakeCollection([{"_id": 100, "ruleid": "r1", "zone": "sahil.ssrf.ms", "priority": 1, "rulecomponents": []}])
+
+class FakeStream:
+    '''
+    A change stream that hands out `changes`, then stops the cache.
+    '''
+    def __init__(self, cache, changes):
+        self.cache = cache
+        self.changes = list(changes)
+        self.alive = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def try_next(self):
+        if not self.changes:
+            self.cache.stop()
+            return None
+        change = self.changes.pop(0)
+        if change is not None and change["operationType"] == "invalidate":
+            self.alive = False
+        return change
+
+@pytest.fixture
+def cache():
+    db = FakeDb()
+    cache = StorageCache(lambda: db, use_change_streams=False)
+    cache._load()
+    cache.db = db
+    return cache
+
+
+def test_storagecache_load(cache):
+    assert cache.ready
+    assert cache.get_domains() == ["ssrf.ms"]
+    assert cache.get_domain("ssrf.ms")["public_ips"] == ["1.2.3.4"]
+    assert cache.find_zone("a.b.sahil.ssrf.ms") == "sahil.ssrf.ms"
+    assert cache.get_zone("SAHIL.ssrf.ms")["domain"] == "ssrf.ms"
+    assert [r["ruleid"] for r in cache.get_rules("sahil.ssrf.ms")] == ["r1"]
+    assert cache.get_rule("r1")["_id"] == 100
+
+
+def test_storagecache_resync_only_bumps_what_changed(cache):
+    zone_version = cache.zone_version("sahil.ssrf.ms")
+    domains_version = cache.domains_version
+    cache._load()
+    assert cache.zone_version("sahil.ssrf.ms") == zone_version
+    assert cache.domains_version == domains_version
+
+    cache.db.rules.docs.append({"_id": 101, "ruleid": "r2", "zone": "sahil.ssrf.ms", "rulecomponents": []})
+    cache._load()
+    assert cache.zone_version("sahil.ssrf.ms") > zone_version
+    assert cache.domains_version == domains_version
+
+
+def test_storagecache_apply_zone_changes(cache):
+    seen = []
+    cache.subscribe(lambda kind, key: seen.append((kind, key)))
+    zones_version = cache.zones_version
+
+    cache._apply({"operationType": "insert", "ns": {"coll": "zones"}, "documentKey": {"_id": 11},
+                  "fullDocument": {"_id": 11, "fqdn": "new.ssrf.ms", "domain": "ssrf.ms"}})
+    assert cache.find_zone("x.new.ssrf.ms") == "new.ssrf.ms"
+    assert cache.zones_version > zones_version
+
+    cache._apply({"operationType": "delete", "ns": {"coll": "zones"}, "documentKey": {"_id": 10}})
+    assert cache.find_zone("x.sahil.ssrf.ms") is None
+    assert cache.get_zone("sahil.ssrf.ms") is None
+    assert seen == [("zone", "new.ssrf.ms"), ("zone", "sahil.ssrf.ms")]
+
+
+def test_storagecache_apply_rule_changes(cache):
+    before = cache.zone_version("sahil.ssrf.ms")
+    updated = {"_id": 100, "ruleid": "r1", "zone": "sahil.ssrf.ms", "priority": 5, "rulecomponents": []}
+    cache._apply({"operationType": "update", "ns": {"coll": "rules"}, "documentKey": {"_id": 100}, "fullDocument": updated})
+    assert cache.get_rules("sahil.ssrf.ms") == (updated,)
+    assert cache.zone_version("sahil.ssrf.ms") > before
+
+    cache._apply({"operationType": "delete", "ns": {"coll": "rules"}, "documentKey": {"_id": 100}})
+    assert cache.get_rules("sahil.ssrf.ms") == ()
+    assert cache.get_rule("r1") is None
+
+
+def test_storagecache_apply_domain_changes(cache):
+    before = cache.domains_version
+    cache._apply({"operationType": "replace", "ns": {"coll": "domains"}, "documentKey": {"_id": 1},
+                  "fullDocument": {"_id": 1, "domain": "ssrf.ms", "public_ips": ["5.6.7.8"]}})
+    assert cache.get_domain("ssrf.ms")["public_ips"] == ["5.6.7.8"]
+    assert cache.domains_version > before
+
+    cache._apply({"operationType": "delete", "ns": {"coll": "domains"}, "documentKey": {"_id": 1}})
+    assert cache.get_domains() == []
+
+
+def test_storagecache_follow_resyncs(cache):
+    # a zone the stream never told us about shows up with the periodic resync
+    cache.full_resync_interval = 0
+    cache.db.watch = lambda *args, **kwargs: FakeStream(cache, [None])
+    cache.db.zones.docs.append({"_id": 11, "fqdn": "missed.ssrf.ms", "domain": "ssrf.ms"})
+    cache._follow()
+    assert cache.mode == "changestream"
+    assert cache.find_zone("x.missed.ssrf.ms") == "missed.ssrf.ms"
+
+
+def test_storagecache_follow_invalidate(cache):
+    cache.full_resync_interval = 3600
+    stream = FakeStream(cache, [{"operationType": "invalidate"}, None])
+    cache.db.watch = lambda *args, **kwargs: stream
+    loads = []
+    load = cache._load
+    cache._load = lambda: loads.append(1) or load()
+    cache._follow()
+    # loaded when the stream opened and again for the invalidate, then left for a new stream
+    assert len(loads) == 2
+    assert stream.changes == [None]
@@ -0,0 +1,29 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import os
+import signal
+import threading
+from zentralbibliothek.workers import run_workers
+
+def note_start(path:str, reuse_port:bool):
+    # a worker that exits right away, so it's restarted
+    with open(path, "a") as f:
+        f.write(f"{reuse_port}\n")
+
+def test_workers_restarted_and_stopped(tmp_path):
+    path = str(tmp_path / "starts")
+    timer = threading.Timer(3.0, os.kill, (os.getpid(), signal.SIGTERM))
+    timer.start()
+    try:
+        assert run_workers(note_start, 2, name="test-worker", check_interval=0.1, path=path) == 0
+    finally:
+        timer.cancel()
+
+    with open(path) as f:
+        starts = f.read().split()
+    # both workers started, and at least one of them again
+    assert len(starts) > 2
+    assert set(starts) == {"True"}
+    # and the default handler is back
+    assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
@@ -0,0 +1,56 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from zentralbibliothek.zoneindex import ZoneIndex
+
+def test_zoneindex_exact_and_suffix():
+    index = ZoneIndex(["sahil.ssrf.ms", "other.ssrf.ms"])
+    assert index.find("sahil.ssrf.ms") == "sahil.ssrf.ms"
+    assert index.find("hello.sahil.ssrf.ms") == "sahil.ssrf.ms"
+    assert index.find("a.b.c.other.ssrf.ms") == "other.ssrf.ms"
+    assert len(index) == 2
+
+def test_zoneindex_miss():
+    index = ZoneIndex(["sahil.ssrf.ms"])
+    assert index.find("ssrf.ms") is None
+    assert index.find("xsahil.ssrf.ms") is None
+    assert index.find("sahil.ssrf.ms.evil.com") is None
+    assert index.find("") is None
+
+def test_zoneindex_longest_match_wins():
+    index = ZoneIndex(["ssrf.ms", "inner.zone.ssrf.ms"])
+    assert index.find("a.inner.zone.ssrf.ms") == "inner.zone.ssrf.ms"
+    assert index.find("a.zone.ssrf.ms") == "ssrf.ms"
+
+def test_zoneindex_case_and_trailing_dot():
+    index = ZoneIndex(["Sahil.SSRF.ms"])
+    assert index.find("HELLO.sahil.ssrf.ms.") == "Sahil.SSRF.ms"
+    assert "sahil.ssrf.ms" in index
+
+def test_zoneindex_empty_labels():
+    index = ZoneIndex(["sahil.ssrf.ms"])
+    assert index.find("x..sahil.ssrf.ms") == "sahil.ssrf.ms"
+    assert index.find("..") is None
+    assert index.find("") is None
+    assert index.find("hello.sahil.ssrf.ms.") == "sahil.ssrf.ms"
+
+def test_zoneindex_add_remove():
+    index = ZoneIndex()
+    assert index.add("a.ssrf.ms")
+    assert not index.add("a.ssrf.ms")
+    assert index.add("b.a.ssrf.ms")
+    assert index.remove("b.a.ssrf.ms")
+    assert index.find("x.b.a.ssrf.ms") == "a.ssrf.ms"
+    assert index.remove("a.ssrf.ms")
+    assert not index.remove("a.ssrf.ms")
+    assert index.find("x.b.a.ssrf.ms") is None
+    assert len(index) == 0
+    # pruned all the way up
+    assert index._root == {}
+
+def test_zoneindex_rebuild():
+    index = ZoneIndex(["a.ssrf.ms"])
+    index.rebuild(["b.ssrf.ms", "b.ssrf.ms"])
+    assert index.find("x.a.ssrf.ms") is None
+    assert index.find("x.b.ssrf.ms") == "b.ssrf.ms"
+    assert len(index) == 1